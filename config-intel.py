@@ -69,6 +69,12 @@ POLICY_FILES = ["security_classes",
 EXTRA_DEFS = ['mls_num_sens=1', 'mls_num_cats=1024',
               'target_build_variant=user']
 
+# Cache directory
+# If set, the parsed policy is saved in this directory, and loaded from it on
+# later runs if the policy files and the extra definitions have not changed.
+# Can be overridden on the command line
+# CACHE_DIR = "~/.cache/selint"
+
 # Verbosity level
 # 0: critical [default]
 # 1: error
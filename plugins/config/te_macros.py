@@ -40,3 +40,18 @@ SUGGESTION_THRESHOLD = 0.8
 # Do not suggest these usages
 # WARNING: Be careful what you put in here.
 USAGES_IGNORE = []
+
+# Answer the rule queries with this engine:
+# "index" looks the rules up in an index built from the policy source,
+# "setools" queries the binary policy with setools,
+# "both" uses the setools results and warns about any difference found by
+# the index.
+# Use "index" for faster runs once "both" reports no differences on your
+# policy.
+QUERY_ENGINE = "both"
+
+# Find the macro suggestions with this algorithm:
+# "join" joins the arguments extracted from the rules found in the policy,
+# "worklist" fills the suggestions one rule at a time, forking them when a
+# rule does not fit.
+SUGGESTION_MATCHER = "join"
@@ -18,10 +18,15 @@
 
 # Only analyse rules of these types
 # This must be a tuple: if there is only one element, insert a trailing comma
-SUPPORTED_RULE_TYPES = ("allow",)
+SUPPORTED_RULE_TYPES = ("allow", "allowxperm")
 
 # Report rules that do not obey these neverallow rules
 # The neverallow rules can contain global_macros
+# Extended permission neverallows (neverallowxperm) are checked against the
+# allowxperm rules, and against the allow rules granting the permission (e.g.
+# "ioctl") with no allowxperm rule on the same types and class, which grant
+# every extended permission
 # e.g.
-# NEVERALLOWS = ["neverallow domain type:class permission;"]
+# NEVERALLOWS = ["neverallow domain type:class permission;",
+#                "neverallowxperm domain type:class ioctl { 0x8900-0x89ff };"]
 NEVERALLOWS = ["neverallow adbd shell:process noatsecure;"]
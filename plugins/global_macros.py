@@ -85,10 +85,11 @@ def main(policy, config):
     suggestions = {}
 
     # Prepare macro definition dictionaries
+    global_macro_defs = policy.macros_defined_in(u"global_macros")
     macroset_dict = {}
     macroset_labels = {}
     for m in policy.macro_defs:
-        if policy.macro_defs[m].file_defined.endswith(u"global_macros"):
+        if policy.macro_defs[m] in global_macro_defs:
             exp = policy.macro_defs[m].expand()
             args = frozenset(x for x in exp.split() if x not in u"{}")
             macroset_dict[m] = args
@@ -106,9 +107,12 @@ def main(policy, config):
     sf = SetFitter(macroset_dict)
     # Cache results for set fitting
     cached_fits = {}
+    # Match the whole rule type, e.g. "allow" but not "allowxperm"
+    supported_rule_types = tuple(
+        x + u" " for x in plugin_conf.SUPPORTED_RULE_TYPES)
     for rutc in policy.mapping.rules:
         # Only match supported rules
-        if not rutc.startswith(plugin_conf.SUPPORTED_RULE_TYPES):
+        if not rutc.startswith(supported_rule_types):
             continue
         # Skip rutcs purposefully ignored by the user
         if rutc in plugin_conf.IGNORED_RULES:
@@ -161,7 +165,7 @@ def main(policy, config):
                 macros_at_line = macrousages_dict[r.fileline]
                 # Check that no other macros are involved
                 for m in macros_at_line:
-                    if not m.macro.file_defined.endswith(u"global_macros"):
+                    if m.macro not in global_macro_defs:
                         # There are other macros at play, do not suggest
                         suggest_this = False
                         break
@@ -192,13 +192,16 @@ def main(policy, config):
     mapper = policysource.mapping.Mapper(
         policy.policyconf, policy.attributes, policy.types, policy.classes)
     printouts = []
+    # Match the whole rule type, e.g. "allow" but not "allowxperm"
+    supported_rule_types = tuple(
+        x + u" " for x in plugin_conf.SUPPORTED_RULE_TYPES)
     # Score the rules
     for rls in itervalues(policy.mapping.rules):
         for r in rls:
             # If this rule comes from an ignored path or its type is not
             # supported, ignore it
             if r.fileline.startswith(FULL_IGNORE_PATHS)\
-                    or not r.rule.startswith(plugin_conf.SUPPORTED_RULE_TYPES)\
+                    or not r.rule.startswith(supported_rule_types)\
                     or str(r) in plugin_conf.IGNORED_RULES:
                 continue
             # Generate the corresponding AV/TErule object
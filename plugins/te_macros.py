@@ -23,9 +23,11 @@ from future.utils import iteritems, itervalues
 from builtins import range
 
 import logging
+import multiprocessing
 import os
 import os.path
 import re
+from collections import OrderedDict
 from timeit import default_timer
 import policysource
 import policysource.policy
@@ -49,6 +51,16 @@ FULL_IGNORE_PATHS = None
 # Global variable to hold the supported non-ignored rules mapping
 NON_IGNORED_MAPPING = {}
 
+# Global variable to hold the rule index
+RULE_INDEX = None
+
+# Global variable to hold the policy permission bitmasks
+PERMISSION_MASKS = None
+
+# Global variable to hold the (policy, selected macros, macro usages filelines)
+# inherited by the forked worker processes
+WORKER_ARGS = None
+
 # Regex for a valid argument in m4
 VALID_ARG_R = r"[a-zA-Z0-9_-]+"
 
@@ -162,10 +174,9 @@ def process_macro(m, mapper):
     return (rules, macro_suggestions)
 
 
-def query_for_rule(policy, r):
-    u"""Query a policy for rules matching a given rule.
+def query_setools(policy, r):
+    u"""Query the binary policy with setools for rules matching a given rule.
     The rule may contain regex fields."""
-    global NON_IGNORED_MAPPING
     # Mark whether a query parameter is a regex or a string
     sr = r"[a-zA-Z0-9_-]+" in r.source
     tr = r"[a-zA-Z0-9_-]+" in r.target
@@ -205,9 +216,32 @@ def query_for_rule(policy, r):
     if r.target == u"self":
         # Discard rules whose mask contained "self" as a target,
         # but whose result's source and target are different
-        results = [x for x in query.results() if x.source == x.target]
+        return [x for x in query.results() if x.source == x.target]
+    return list(query.results())
+
+
+def query_for_rule(policy, r):
+    u"""Query a policy for rules matching a given rule.
+    The rule may contain regex fields."""
+    global NON_IGNORED_MAPPING
+    if plugin_conf.QUERY_ENGINE == u"setools":
+        results = query_setools(policy, r)
+    elif plugin_conf.QUERY_ENGINE == u"both":
+        # Use the setools results, but report any difference with the index
+        results = query_setools(policy, r)
+        indexed = RULE_INDEX.query(r)
+        if results is not None and indexed is not None:
+            found = set(str(x) for x in results)
+            indexed_found = set(str(x) for x in indexed)
+            for x in sorted(found - indexed_found):
+                LOG.warning(u"Rule index missed \"%s\" for \"%s\"", x, r)
+            for x in sorted(indexed_found - found):
+                LOG.warning(u"Rule index found extra \"%s\" for \"%s\"",
+                            x, r)
     else:
-        results = list(query.results())
+        results = RULE_INDEX.query(r)
+    if results is None:
+        return None
     filtered_results = []
     # Discard rules coming from explicitly ignored paths
     for x in results:
@@ -229,16 +263,18 @@ def query_for_rule(policy, r):
             if rule.rtype in policysource.mapping.AVRULES:
                 # Check that the permission set of the "x" rule is covered by
                 # non-ignored rules. If not, drop the rule.
-                tmpset = set()
+                masks = policy.permission_masks
+                tmpmask = 0
                 for each in rls:
                     if not each.fileline.startswith(FULL_IGNORE_PATHS):
                         prmstr = MAPPER.rule_split_after_class(each.rule)[1]
-                        tmpset.update(prmstr.strip(u" {};").split())
+                        tmpmask |= masks.mask(
+                            rule.tclass, prmstr.strip(u" {};").split())
                         if x_str in NON_IGNORED_MAPPING:
                             NON_IGNORED_MAPPING[x_str].append(each.fileline)
                         else:
                             NON_IGNORED_MAPPING[x_str] = [each.fileline]
-                if tmpset >= rule.permset:
+                if masks.issubset(rule.get_permmask(masks), tmpmask):
                     # The set of permissions created by non-ignored rules is
                     # sufficient
                     filtered_results.append(x)
@@ -256,6 +292,341 @@ def query_for_rule(policy, r):
     return filtered_results
 
 
+def fit_suggestions(macro_suggestions, overall_rules):
+    u"""Fill the macro suggestions with the rules found in the policy, forking
+    a new suggestion whenever a rule does not fit an existing one.
+
+    Return the set of suggestions scoring at least the threshold."""
+    selected_suggestions = set()
+    tried_usages = set()
+    # While there are new suggestions
+    while macro_suggestions:
+        # Select and remove a suggestion from the set
+        sug = macro_suggestions.pop()
+        newsugs = set()
+        removal_candidates = set()
+        # Try to match all rules from the query to this suggestion
+        for rule in overall_rules:
+            try:
+                sug.add_rule(rule)
+            except ValueError:
+                newsug = sug.fork_and_fit(rule)
+                # If we have a new valid suggestion which has not been
+                # suggested before
+                if newsug and newsug.usage not in tried_usages \
+                        and newsug not in selected_suggestions \
+                        and newsug not in macro_suggestions:
+                    newsugs.add(newsug)
+                    tried_usages.add(newsug.usage)
+            except RuntimeError as e:
+                # This rule does not match any rule in the macro
+                removal_candidates.add(rule)
+            else:
+                tried_usages.add(sug.usage)
+        # This suggestion is now exhausted: if acceptable, move to
+        # selected_suggestions, otherwise do nothing with it
+        if sug.score >= plugin_conf.SUGGESTION_THRESHOLD:
+            selected_suggestions.add(sug)
+        # Filter the newsugs and add to macro_suggestions those that still
+        # need to be processed. Completed ones go to selected_suggestions
+        for newsug in newsugs:
+            if newsug.score == 1:
+                selected_suggestions.add(newsug)
+            else:
+                macro_suggestions.add(newsug)
+        # Remove rules that do not match any rules in the macro
+        # Happens e.g. in cases of multiple occurrences of the same arg,
+        # where the regex version will pick up a rule but the numbered
+        # placeholder version will reject it.
+        for rem in removal_candidates:
+            overall_rules.remove(rem)
+    return selected_suggestions
+
+
+def join_suggestions(initial, overall_rules):
+    u"""Find the macro suggestions fitting the rules found in the policy by
+    joining the arguments extracted from the rules.
+
+    Each rule is matched once against each placeholder rule of the macro, and
+    the matches of each placeholder rule are grouped by their arguments. The
+    placeholder rules are then joined in order, looking up the groups whose
+    arguments agree with the ones bound so far. Every maximal combination,
+    to which no other rule can be added, is a suggestion: these are the
+    suggestions fit_suggestions() finds by forking.
+
+    Return the set of suggestions scoring at least the threshold."""
+    if not initial.placeholder_rules:
+        # The macro does not expand to any supported rule
+        return set()
+    slots = list(initial.extractors)
+    extractors = [initial.extractors[x] for x in slots]
+    slot_args = [sorted(set(x.args)) for x in extractors]
+    # The slots matched by each rule, in order
+    matched = [[] for x in overall_rules]
+    # The rules matching each slot, grouped by arguments
+    # [{((argN, value), ...): [rule index]}]
+    groups = [OrderedDict() for x in slots]
+    for i, rule in enumerate(overall_rules):
+        for q, e in enumerate(extractors):
+            try:
+                args = e.extract(rule)
+            except ValueError:
+                continue
+            matched[i].append(q)
+            binding = tuple(sorted(iteritems(args)))
+            if binding in groups[q]:
+                groups[q][binding].append(i)
+            else:
+                groups[q][binding] = [i]
+    # The groups of each slot indexed by the values of some of their
+    # arguments, built on demand
+    # {(slot, (argN, ...)): {(value, ...): [binding]}}
+    indexes = {}
+
+    def lookup(q, args):
+        u"""Get the groups of a slot agreeing with the bound arguments."""
+        bound = tuple(x for x in slot_args[q] if x in args)
+        if (q, bound) not in indexes:
+            index = {}
+            for binding in groups[q]:
+                values = dict(binding)
+                key = tuple(values[x] for x in bound)
+                if key in index:
+                    index[key].append(binding)
+                else:
+                    index[key] = [binding]
+            indexes[(q, bound)] = index
+        return indexes[(q, bound)].get(tuple(args[x] for x in bound), ())
+
+    def candidate(q, binding, filled):
+        u"""Get the first rule of a group which can fill a slot, i.e. whose
+        previous matching slots are filled, as MacroSuggestion.add_rule()
+        places a rule in the first free slot it matches. The same rule can
+        fill several slots, e.g. a rule with a superset of the permissions
+        of two placeholder rules."""
+        for i in groups[q][binding]:
+            if all(x in filled for x in matched[i] if x < q):
+                return i
+        return None
+
+    nplaceholders = len(initial.placeholder_rules)
+    threshold = plugin_conf.SUGGESTION_THRESHOLD
+    selected_suggestions = set()
+
+    def join(q, args, filled, skipped):
+        u"""Join the slots from q onwards with the slots filled so far."""
+        if (len(filled) + len(slots) - q) / nplaceholders < threshold:
+            # Even filling all the remaining slots cannot reach the threshold
+            return
+        if q == len(slots):
+            # Discard the combination if a rule fits a skipped slot
+            for x in skipped:
+                if any(candidate(x, b, filled) is not None
+                       for b in lookup(x, args)):
+                    return
+            sug = MacroSuggestion(initial.macro, initial.placeholder_rules,
+                                  initial.extractors)
+            sug.fill(dict((slots[x], overall_rules[i])
+                          for x, i in iteritems(filled)), args)
+            if sug.score >= threshold:
+                selected_suggestions.add(sug)
+            return
+        # Skipping the slot is pointless if a rule can fill it without
+        # binding new arguments: the combination would not be maximal
+        skip = True
+        for binding in lookup(q, args):
+            i = candidate(q, binding, filled)
+            if i is None:
+                continue
+            new_args = dict(args)
+            new_args.update(binding)
+            if len(new_args) == len(args):
+                skip = False
+            new_filled = dict(filled)
+            new_filled[q] = i
+            join(q + 1, new_args, new_filled, skipped)
+        if skip:
+            join(q + 1, args, filled, skipped + [q])
+
+    join(0, {}, {}, [])
+    return selected_suggestions
+
+
+def find_subsets(suggestions):
+    u"""Find the suggestions which are a strict subset of another suggestion
+    with an equal or greater score.
+
+    Return a list of MacroSuggestion objects."""
+    # Like MacroSuggestion.__lt__, compare the placeholder rules filled by
+    # the suggestions: give each one an id, and compute the rule id set of
+    # each suggestion once
+    rule_ids = {}
+    rule_sets = []
+    for x in suggestions:
+        rule_sets.append((x, frozenset(
+            rule_ids.setdefault(r, len(rule_ids))
+            for r in x.filled_placeholder_rules)))
+    # Index the suggestions by rule id
+    index = {}
+    for i, (x, rule_set) in enumerate(rule_sets):
+        for r in rule_set:
+            if r in index:
+                index[r].append(i)
+            else:
+                index[r] = [i]
+    subsets = []
+    # For each suggestion
+    for x, rule_set in rule_sets:
+        # If suggestion x is found to be a strict subset of any other,
+        # meaning that its rules are wholly contained in a bigger
+        # suggestion with an equal or greater score, don't suggest it.
+        # Macro_suggestions is originally a set when being filled up, and
+        # suggestions are identified by the macro name and rules they
+        # contain, so there will not be more than one macro suggestion with
+        # the same macro name containing exactly the same rules: therefore
+        # we are only interested in strict subsets (x < y), without "<=".
+        if rule_set:
+            # A superset contains every rule of x: only look at the
+            # suggestions sharing the rule of x with the fewest suggestions
+            candidates = min((index[r] for r in rule_set), key=len)
+        else:
+            candidates = range(len(rule_sets))
+        for i in candidates:
+            y, y_rule_set = rule_sets[i]
+            if len(y_rule_set) > len(rule_set) and x.score <= y.score and\
+                    rule_set < y_rule_set:
+                subsets.append(x)
+                break
+    return subsets
+
+
+def suggest_macro(policy, m, macrousages_filelines):
+    u"""Find the suggested usages of a macro.
+
+    Return a tuple (suggestions, number of policy queries)."""
+    begin = default_timer()
+    # Get the Rule objects contained in the macro expansion and the initial
+    # list of macro suggestions
+    rules, macro_suggestions = process_macro(m, MAPPER)
+    if not rules:
+        print(u"Macro \"{}\" does not expand to any supported".format(m) +
+              u" rule. Consider adding it to the ignored macros.")
+    # Query the policy with regexes
+    overall_rules = []
+    for r in itervalues(rules):
+        results = query_for_rule(policy, r)
+        if results:
+            overall_rules.extend(results)
+    # Try to fill macro suggestions
+    if plugin_conf.SUGGESTION_MATCHER == u"worklist":
+        selected_suggestions = fit_suggestions(
+            macro_suggestions, overall_rules)
+    else:
+        selected_suggestions = join_suggestions(
+            macro_suggestions.pop(), overall_rules)
+    # Discard suggestions that are explictly ignored by the user
+    selected_suggestions = [x for x in selected_suggestions
+                            if x.usage not in plugin_conf.USAGES_IGNORE]
+    # Discard suggestions entirely made up of rules that already come from
+    # a macro expansion
+    suggestions = []
+    for sug in selected_suggestions:
+        added = False
+        for x in sug.rules:
+            for y in NON_IGNORED_MAPPING[str(x)]:
+                if y not in macrousages_filelines:
+                    # We have at least one rule that does not come from a
+                    # macro expansion
+                    suggestions.append(sug)
+                    added = True
+                    break
+            if added:
+                break
+    # Print time info
+    LOG.info(u"Time spent on \"%s\": %ss", m, default_timer() - begin)
+    return (suggestions, len(rules))
+
+
+def suggest_macro_in_worker(task):
+    u"""Find the suggested usages of a macro in a worker process.
+
+    The suggestions reference the macro, and through it the macro expander,
+    which cannot be sent back to the parent: they are returned as plain data
+    instead, i.e. tuples (placeholder rules, {placeholder rule: rule string},
+    args).
+    Return a tuple (macro index, suggestions, number of policy queries,
+    non-ignored rules mapping filled by the queries)."""
+    k, total = task
+    m = WORKER_ARGS[1][k - 1]
+    print(u"Processing \"{}\" ({}/{})...".format(m, k, total))
+    # Only return the part of the mapping filled for this macro
+    NON_IGNORED_MAPPING.clear()
+    suggestions, queries = suggest_macro(WORKER_ARGS[0], m, WORKER_ARGS[2])
+    suggestions = [(x.placeholder_rules, x.filled_rules, x.args)
+                   for x in suggestions]
+    return (k, suggestions, queries, NON_IGNORED_MAPPING)
+
+
+def suggest_macros_parallel(policy, selected_macros, macrousages_filelines,
+                            jobs):
+    u"""Find the suggested usages of the macros in a pool of processes.
+
+    The workers are forked, inheriting the policy and the plugin state.
+    Return a tuple (suggestions, number of policy queries), or None if the
+    macros must be processed sequentially instead."""
+    # pylint: disable=global-statement
+    global WORKER_ARGS
+    try:
+        context = multiprocessing.get_context(u"fork")
+    except AttributeError:
+        # Python 2 always forks on POSIX systems
+        context = multiprocessing
+    except ValueError:
+        LOG.warning(u"Cannot fork worker processes, processing the macros "
+                    u"sequentially...")
+        return None
+    if plugin_conf.QUERY_ENGINE != u"index":
+        # Load the binary policy once, instead of once per worker
+        policy.policy
+    suggestions = set()
+    total_queries = 0
+    tasks = [(k, len(selected_macros))
+             for k in range(1, len(selected_macros) + 1)]
+    WORKER_ARGS = (policy, selected_macros, macrousages_filelines)
+    pool = context.Pool(jobs)
+    try:
+        # Macros take very different times to process: hand them out one
+        # at a time
+        for k, sugs, queries, mapping in pool.imap_unordered(
+                suggest_macro_in_worker, tasks):
+            # Rebuild the suggestions around our own macro object
+            m = selected_macros[k - 1]
+            extractors = None
+            for placeholder_rules, rules, args in sugs:
+                sug = MacroSuggestion(m, placeholder_rules, extractors)
+                # The suggestions of a macro share the same extractors
+                extractors = sug.extractors
+                sug.fill(dict((r, IndexedRule(MAPPER.rule_factory(x)))
+                              for r, x in iteritems(rules)), args)
+                suggestions.add(sug)
+            total_queries += queries
+            # Merge the non-ignored rules mapping
+            for x, filelines in iteritems(mapping):
+                if x in NON_IGNORED_MAPPING:
+                    NON_IGNORED_MAPPING[x].extend(
+                        y for y in filelines
+                        if y not in NON_IGNORED_MAPPING[x])
+                else:
+                    NON_IGNORED_MAPPING[x] = filelines
+    finally:
+        pool.terminate()
+        pool.join()
+        WORKER_ARGS = None
+    LOG.debug(u"Processed %d macros with %d processes",
+              len(selected_macros), jobs)
+    return (suggestions, total_queries)
+
+
 def main(policy, config):
     u"""Suggest usages of te_macros where appropriate."""
     # Check that we have been fed a valid policy
@@ -276,6 +647,16 @@ def main(policy, config):
     FULL_IGNORE_PATHS = tuple(os.path.join(config.FULL_BASE_DIR, p)
                               for p in plugin_conf.RULE_IGNORE_PATHS)
 
+    # Compare the rule permissions as bitmasks
+    global PERMISSION_MASKS
+    PERMISSION_MASKS = policy.permission_masks
+
+    # Index the policy rules to answer the queries, unless they are answered
+    # by setools alone
+    global RULE_INDEX
+    if plugin_conf.QUERY_ENGINE != u"setools":
+        RULE_INDEX = RuleIndex(policy)
+
     global NON_IGNORED_MAPPING
 
     # Save the suggestions
@@ -283,15 +664,17 @@ def main(policy, config):
 
     total_queries = 0
     begin = default_timer()
-    part = begin
     # Only consider te_macros not purposefully ignored
-    selected_macros = [x for x in itervalues(policy.macro_defs) if
-                       x.file_defined.endswith(u"te_macros") and not
-                       x.name in plugin_conf.MACRO_IGNORE]
+    selected_macros_set = set(
+        x for x in policy.macros_defined_in(u"te_macros")
+        if x.name not in plugin_conf.MACRO_IGNORE)
+    # Process the macros in definition order
+    selected_macros = [x for x in itervalues(policy.macro_defs)
+                       if x in selected_macros_set]
     # Create a dictionary of selected macro usages
     macrousages_dict = {}
     for m in policy.macro_usages:
-        if m.macro in selected_macros:
+        if m.macro in selected_macros_set:
             macrousages_dict[str(m)] = m
     # Create a dictionary of filelines -> macro usages
     macrousages_filelines = {}
@@ -304,92 +687,26 @@ def main(policy, config):
 
     macros_found = 0
     macros_used = 0
-    for k, m in enumerate(selected_macros, start=1):
-        print(u"Processing \"{}\" ({}/{})...".format(
-            m, k, len(selected_macros)))
-        # Get the Rule objects contained in the macro expansion and the initial
-        # list of macro suggestions
-        rules, macro_suggestions = process_macro(m, MAPPER)
-        if not rules:
-            print(u"Macro \"{}\" does not expand to any supported".format(m) +
-                  u" rule. Consider adding it to the ignored macros.")
-        # Query the policy with regexes
-        total_queries += len(rules)
-        overall_rules = []
-        for r in itervalues(rules):
-            results = query_for_rule(policy, r)
-            if results:
-                overall_rules.extend(results)
-        # Try to fill macro suggestions
-        selected_suggestions = set()
-        tried_usages = set()
-        # While there are new suggestions
-        while macro_suggestions:
-            # Select and remove a suggestion from the set
-            sug = macro_suggestions.pop()
-            newsugs = set()
-            removal_candidates = set()
-            # Try to match all rules from the query to this suggestion
-            for rule in overall_rules:
-                try:
-                    sug.add_rule(rule)
-                except ValueError:
-                    newsug = sug.fork_and_fit(rule)
-                    # If we have a new valid suggestion which has not been
-                    # suggested before
-                    if newsug and newsug.usage not in tried_usages \
-                            and newsug not in selected_suggestions \
-                            and newsug not in macro_suggestions:
-                        newsugs.add(newsug)
-                        tried_usages.add(newsug.usage)
-                except RuntimeError as e:
-                    # This rule does not match any rule in the macro
-                    removal_candidates.add(rule)
-                else:
-                    tried_usages.add(sug.usage)
-            # This suggestion is now exhausted: if acceptable, move to
-            # selected_suggestions, otherwise do nothing with it
-            if sug.score >= plugin_conf.SUGGESTION_THRESHOLD:
-                selected_suggestions.add(sug)
-            # Filter the newsugs and add to macro_suggestions those that still
-            # need to be processed. Completed ones go to selected_suggestions
-            for newsug in newsugs:
-                if newsug.score == 1:
-                    selected_suggestions.add(newsug)
-                else:
-                    macro_suggestions.add(newsug)
-            # Remove rules that do not match any rules in the macro
-            # Happens e.g. in cases of multiple occurrences of the same arg,
-            # where the regex version will pick up a rule but the numbered
-            # placeholder version will reject it.
-            for rem in removal_candidates:
-                overall_rules.remove(rem)
-        # Discard suggestions that are explictly ignored by the user
-        selected_suggestions = [x for x in selected_suggestions
-                                if x.usage not in plugin_conf.USAGES_IGNORE]
-        # Discard suggestions entirely made up of rules that already come from
-        # a macro expansion
-        for sug in selected_suggestions:
-            added = False
-            for x in sug.rules:
-                for y in NON_IGNORED_MAPPING[str(x)]:
-                    if y not in macrousages_filelines:
-                        # We have at least one rule that does not come from a
-                        # macro expansion
-                        global_suggestions.add(sug)
-                        added = True
-                        break
-                if added:
-                    break
-        # Print time info
-        oldpart = part
-        part = default_timer()
-        LOG.info(u"Time spent on \"%s\": %ss", m, part - oldpart)
+    jobs = getattr(config, u"JOBS", None)
+    results = None
+    if jobs is not None and jobs > 1:
+        results = suggest_macros_parallel(
+            policy, selected_macros, macrousages_filelines, jobs)
+    if results is not None:
+        global_suggestions, total_queries = results
+    else:
+        for k, m in enumerate(selected_macros, start=1):
+            print(u"Processing \"{}\" ({}/{})...".format(
+                m, k, len(selected_macros)))
+            suggestions, queries = suggest_macro(
+                policy, m, macrousages_filelines)
+            global_suggestions.update(suggestions)
+            total_queries += queries
     # Check how many usages have been fully recognized
     if config.VERBOSITY == 4:
         found_usages = [x.usage for x in global_suggestions if x.score == 1]
         for x, n in iteritems(macrousages_dict):
-            if n.macro not in selected_macros:
+            if n.macro not in selected_macros_set:
                 continue
             macros_used += 1
             if x not in found_usages:
@@ -397,20 +714,7 @@ def main(policy, config):
             else:
                 macros_found += 1
     # Discard suggestions which are a subset of another with the same score
-    removal_candidates = []
-    # For each suggestion
-    for x in global_suggestions:
-        # If suggestion x is found to be a strict subset of any other,
-        # meaning that its rules are wholly contained in a bigger
-        # suggestion with an equal or greater score, don't suggest it.
-        # Macro_suggestions is originally a set when being filled up, and
-        # suggestions are identified by the macro name and rules they
-        # contain, so there will not be more than one macro suggestion with
-        # the same macro name containing exactly the same rules: therefore
-        # we are only interested in strict subsets (x < y), without "<=".
-        if any(x < y for y in global_suggestions if x.score <= y.score):
-            removal_candidates.append(x)
-    for x in removal_candidates:
+    for x in find_subsets(global_suggestions):
         global_suggestions.remove(x)
     # Discard suggestions whose usage is already in the policy
     # This must be done after removing suggestions which are subsets of
@@ -466,12 +770,16 @@ class MacroSuggestion(object):
     Represents a macro expansion as a list of rules.
     The score expresses the number of rules actually found in the policy."""
 
-    def __init__(self, macro, placeholder_rules):
+    def __init__(self, macro, placeholder_rules, extractors=None):
         self._macro = macro
         self._placeholder_rules = placeholder_rules
-        self._extractors = {}
-        for r in self._placeholder_rules:
-            self._extractors[r] = ArgExtractor(r)
+        if extractors is not None:
+            # Share the extractors of another suggestion for the same macro
+            self._extractors = extractors
+        else:
+            self._extractors = OrderedDict()
+            for r in self._placeholder_rules:
+                self._extractors[r] = ArgExtractor(r)
         self._rules = {}
         self._rules_strings = {}
         self._args = {}
@@ -525,6 +833,24 @@ class MacroSuggestion(object):
             # If we got here, we found no matching rule at all
             raise RuntimeError(u"Invalid rule: \"{}\"".format(rule))
 
+    def fill(self, rules, args):
+        u"""Mark several rules in the macro expansion as found in the policy,
+        all at once.
+
+        Arguments:
+        rules - a dictionary {placeholder rule: rule}
+        args  - the arguments extracted from the rules, as a dictionary
+                {positional name: value}
+        """
+        for r, rule in iteritems(rules):
+            self._rules[r] = rule
+            self._rules_strings[r] = str(rule)
+        self.args.update(args)
+        if self.rules:
+            score = len(self.rules) / len(self.placeholder_rules)
+            score *= len(self.args) / self.macro.nargs
+            self._score = score
+
     def fork_and_fit(self, rule):
         u"""Fork the current state of the macro suggestion, and modify it to fit
         a new rule which would not normally fit because of mismatching args.
@@ -558,6 +884,12 @@ class MacroSuggestion(object):
         u"""Get the M4Macro object relative to the macro being suggested."""
         return self._macro
 
+    @property
+    def extractors(self):
+        u"""Get the ArgExtractors of the placeholder rules, as a dictionary
+        {placeholder rule: ArgExtractor}."""
+        return self._extractors
+
     @property
     def placeholder_rules(self):
         u"""Get the list of valid rules contained in the macro expansion with
@@ -607,6 +939,17 @@ class MacroSuggestion(object):
             retstr += expansion.format(*args) + "\n"
         return retstr
 
+    @property
+    def filled_placeholder_rules(self):
+        u"""Get the placeholder rules matched by a rule in the policy."""
+        return self._rules_strings.keys()
+
+    @property
+    def filled_rules(self):
+        u"""Get the rules found in the policy as strings, as a dictionary
+        {placeholder rule: rule string}."""
+        return self._rules_strings
+
     def __eq__(self, other):
         u"""Check whether this suggestion is a duplicate of another."""
         return self.macro.name == other.macro.name and\
@@ -667,13 +1010,14 @@ class ArgExtractor(object):
         for blk in self.regex_blocks:
             if VALID_ARG_R in blk:
                 self.regex_blocks_c[blk] = re.compile(blk)
-        # Save pre-computed rule permission set
+        # Save pre-computed rule permission set and bitmask
+        self.regex_permmask = None
         if self.regex_blocks[0] in policysource.mapping.AVRULES:
-            if any(x in self.regex_blocks[4] for x in u"{}"):
-                self.regex_perms = set(
-                    self.regex_blocks[4].strip(u"{}").split())
-            else:
-                self.regex_perms = set([self.regex_blocks[4]])
+            self.regex_perms = frozenset(
+                self.regex_blocks[4].strip(u"{}").split())
+            if self.regex_blocks[3] not in self.regex_blocks_c:
+                self.regex_permmask = PERMISSION_MASKS.mask(
+                    self.regex_blocks[3], self.regex_perms)
         else:
             self.regex_perms = None
         # Save the argument names as "argN"
@@ -792,7 +1136,16 @@ class ArgExtractor(object):
             ################ Match an AV rule ################
             # Block 4 is the permission set
             # Match a (super)set of what is required by the regex
-            if not self.regex_perms <= rule.perms:
+            regex_mask = self.regex_permmask
+            if regex_mask is None:
+                # The class is a regex, get the mask for the rule class
+                regex_mask = PERMISSION_MASKS.mask(rule_blocks[3],
+                                                   self.regex_perms)
+            rule_mask = getattr(rule, u"permmask", None)
+            if rule_mask is None:
+                # The setools rules have no precomputed mask
+                rule_mask = PERMISSION_MASKS.mask(rule_blocks[3], rule.perms)
+            if not PERMISSION_MASKS.issubset(regex_mask, rule_mask):
                 # If the perms in the rule are not at least those in
                 # the regex
                 return None
@@ -832,3 +1185,212 @@ class ArgExtractor(object):
         ##################################################################
         ######################## All blocks match ########################
         return matches
+
+
+class IndexedRule(object):
+    u"""A policy rule found through the RuleIndex.
+
+    Offers the same interface as the setools rules used by this plugin."""
+    __slots__ = (u"ruletype", u"source", u"target", u"tclass", u"perms",
+                 u"permmask", u"default", u"_filename", u"_str")
+
+    def __init__(self, rule, perms=None):
+        u"""Initialise the rule from an expanded rule object (AVRule,
+        TERule), possibly with a different permission set."""
+        self.ruletype = rule.rtype
+        self.source = rule.source
+        self.target = rule.target
+        self.tclass = rule.tclass
+        if rule.rtype in policysource.mapping.AVRULES:
+            self.perms = frozenset(perms if perms is not None
+                                   else rule.permset)
+            self.permmask = PERMISSION_MASKS.mask(self.tclass, self.perms)
+            self.default = None
+            self._filename = None
+            self._str = rule.up_to_class + u" "
+            if len(self.perms) > 1:
+                self._str += u"{ " + u" ".join(sorted(self.perms)) + u" };"
+            else:
+                self._str += u" ".join(self.perms) + u";"
+        else:
+            self.perms = None
+            self.permmask = None
+            self.default = rule.deftype
+            self._filename = rule.objname
+            self._str = str(rule)
+
+    @property
+    def filename(self):
+        u"""Get the object name of a name transition."""
+        if self._filename is None:
+            raise ValueError(u"Not a name transition")
+        return self._filename
+
+    def __repr__(self):
+        return self._str
+
+
+class RuleIndex(object):
+    u"""In-memory index of the policy rules, to answer the plugin queries
+    with dictionary lookups instead of regex scans of the binary policy.
+
+    The rules are taken from the mapping and reduced to what the binary
+    policy contains: rule sets and complements are split into their types,
+    attributes are kept in the AV rules but expanded to their types in the
+    type transitions, "self" is expanded to each type, the permissions of
+    the AV rules with the same source, target and class are merged, and
+    each type transition is indexed once. Neverallow rules are not indexed.
+    The rules are indexed by rule type and class, and additionally by
+    source, target and default type."""
+    indexed_rule_types = (u"allow", u"auditallow", u"dontaudit",
+                          u"type_transition")
+
+    def __init__(self, policy):
+        self._attributes = policy.attributes
+        # {(rtype, tclass): [IndexedRule]}
+        self._by_class = {}
+        # {(rtype, tclass, type): [IndexedRule]}
+        self._by_source = {}
+        self._by_target = {}
+        self._by_default = {}
+        # The blocks of the original rules, parsed once
+        original_blocks = {}
+        mapper = policysource.mapping.Mapper
+        for rutc, rls in iteritems(policy.mapping.rules):
+            if not rutc.startswith(self.indexed_rule_types):
+                continue
+            rtype, source, target_class = rutc.split(u" ")
+            if rtype not in self.indexed_rule_types:
+                continue
+            target, tclass = target_class.split(u":")
+            if rtype in policysource.mapping.AVRULES:
+                perms = set()
+                for mpr in rls:
+                    if mpr.original_rule not in original_blocks:
+                        original_blocks[mpr.original_rule] = \
+                            mapper.get_rule_blocks(mpr.original_rule)
+                    blocks = original_blocks[mpr.original_rule]
+                    # Skip the expanded rules which are not in the binary
+                    # policy
+                    if not self.__in_binary(source, target, blocks):
+                        continue
+                    perms.update(
+                        mpr.rule[len(rutc):].strip(u" {};").split())
+                if not perms:
+                    continue
+                rules = [IndexedRule(mapper.rule_factory(
+                    rutc + u" " + sorted(perms)[0] + u";"), perms)]
+            elif source in self._attributes or target in self._attributes:
+                # The type transitions are expanded to types in the binary
+                # policy
+                continue
+            else:
+                # The same type transition may come from several places
+                rules = [IndexedRule(mapper.rule_factory(x))
+                         for x in sorted(set(y.rule for y in rls))]
+            for rule in rules:
+                self.__add(self._by_class, (rtype, tclass), rule)
+                self.__add(self._by_source, (rtype, tclass, source), rule)
+                self.__add(self._by_target, (rtype, tclass, target), rule)
+                if rule.default is not None:
+                    self.__add(self._by_default,
+                               (rtype, tclass, rule.default), rule)
+
+    @staticmethod
+    def __add(index, key, rule):
+        u"""Add a rule to the list of an index key."""
+        if key in index:
+            index[key].append(rule)
+        else:
+            index[key] = [rule]
+
+    def __in_binary(self, source, target, blocks):
+        u"""Check whether the binary policy contains an expanded AV rule,
+        given the blocks of the original rule."""
+        if u"self" in blocks[2].strip(u"~{}").split():
+            # "self" is expanded to each type of the source
+            return source == target and source not in self._attributes
+        return self.__in_block(source, blocks[1]) and\
+            self.__in_block(target, blocks[2])
+
+    def __in_block(self, name, block):
+        u"""Check whether a type or attribute is kept from a rule block in
+        the binary policy."""
+        if block.startswith(u"~") or block == u"*" or u"-" in block:
+            # Complements and subtractions are expanded to types
+            return name not in self._attributes
+        return name in block.strip(u"{}").split()
+
+    def query(self, r):
+        u"""Find the rules matching a given rule, whose fields may contain the
+        VALID_ARG_R regex, like a setools TERuleQuery would.
+
+        Return a list of IndexedRule objects, or None if the rule is not
+        supported."""
+        if r.rtype in policysource.mapping.AVRULES:
+            default = None
+        elif r.rtype in policysource.mapping.TERULES:
+            default = self.__field(r.deftype)
+        else:
+            LOG.warning(u"Unsupported rule: \"%s\"", r)
+            return None
+        source = self.__field(r.source)
+        # Like the setools query, match every target for "self" and then
+        # keep the rules whose source and target are the same
+        target = None if r.target == u"self" else self.__field(r.target)
+        tclass = self.__field(r.tclass)
+        if self.__is_literal(tclass):
+            classes = [tclass]
+        else:
+            # The class is a regex: this should never happen
+            classes = sorted(set(x[1] for x in self._by_class
+                                 if x[0] == r.rtype and tclass.search(x[1])))
+        results = []
+        for cls in classes:
+            # Look up the smallest list of candidates
+            candidates = [self._by_class.get((r.rtype, cls), [])]
+            if self.__is_literal(source):
+                candidates.append(
+                    self._by_source.get((r.rtype, cls, source), []))
+            if self.__is_literal(target):
+                candidates.append(
+                    self._by_target.get((r.rtype, cls, target), []))
+            if self.__is_literal(default):
+                candidates.append(
+                    self._by_default.get((r.rtype, cls, default), []))
+            for x in min(candidates, key=len):
+                if not self.__match(source, x.source):
+                    continue
+                if target is None:
+                    if x.source != x.target:
+                        continue
+                elif not self.__match(target, x.target):
+                    continue
+                if default is None:
+                    if not r.permset <= x.perms:
+                        continue
+                elif not self.__match(default, x.default):
+                    continue
+                results.append(x)
+        return results
+
+    @staticmethod
+    def __field(value):
+        u"""Get a query field: a compiled regex if the value contains the
+        VALID_ARG_R regex, the value itself otherwise."""
+        if VALID_ARG_R in value:
+            return re.compile(value)
+        return value
+
+    @staticmethod
+    def __is_literal(field):
+        u"""Check whether a query field is a plain value."""
+        return field is not None and not hasattr(field, u"search")
+
+    @staticmethod
+    def __match(field, value):
+        u"""Match a value against a query field, searching for regexes like
+        setools does."""
+        if not hasattr(field, u"search"):
+            return field == value
+        return field.search(value) is not None
@@ -145,16 +145,18 @@ def query_for_rule(policy, r):
             if rule.rtype in policysource.mapping.AVRULES:
                 # Check that the permission set of the "x" rule is covered by
                 # non-ignored rules. If not, drop the rule.
-                tmpset = set()
+                masks = policy.permission_masks
+                tmpmask = 0
                 for each in rls:
                     if not each.fileline.startswith(FULL_IGNORE_PATHS):
                         prmstr = MAPPER.rule_split_after_class(each.rule)[1]
-                        tmpset.update(prmstr.strip(u" {};").split())
+                        tmpmask |= masks.mask(
+                            rule.tclass, prmstr.strip(u" {};").split())
                         if x_str in NON_IGNORED_MAPPING:
                             NON_IGNORED_MAPPING[x_str].append(each.fileline)
                         else:
                             NON_IGNORED_MAPPING[x_str] = [each.fileline]
-                if tmpset >= rule.permset:
+                if masks.issubset(rule.get_permmask(masks), tmpmask):
                     # The set of permissions created by non-ignored rules is
                     # sufficient
                     filtered_results.append(x)
@@ -295,16 +297,18 @@ def main(policy, config):
                         # existing allow rules and check if the resulting
                         # rule is a superset of the rule we are looking
                         # for
-                        permset = set()
+                        masks = policy.permission_masks
+                        permmask = 0
                         for x in policy.mapping.rules[nrfutc]:
                             x_f = MAPPER.rule_factory(x.rule)
-                            permset.update(x_f.permset)
+                            permmask |= x_f.get_permmask(masks)
                         # If not a subset, print the rule and the missing
                         # permissions
-                        if not nec_rule_full.permset <= permset:
+                        nec_mask = nec_rule_full.get_permmask(masks)
+                        if not masks.issubset(nec_mask, permmask):
                             missing = u" (missing \""
-                            missing += u" ".join(nec_rule_full.permset -
-                                                 permset)
+                            missing += u" ".join(masks.names(
+                                nec_rule_full.tclass, nec_mask & ~permmask))
                             missing += u"\")"
                             missing_rules.append(nec_rule + missing)
                     if nec_rule_full.rtype in policysource.mapping.TERULES:
@@ -364,7 +368,7 @@ def main(policy, config):
             del plugin_conf.REQUIRED_PERMS[rm]
     for rutc in policy.mapping.rules:
         # Filter the rules by type (beginning of the "rule up to class")
-        if not rutc.startswith(u"allow"):
+        if not rutc.startswith(u"allow "):
             continue
         # Get the rule class and pre-class part
         pre_cls, cls = rutc.split(u":")
@@ -34,15 +34,17 @@ REQUIRED_RULES = plugin_conf.SUPPORTED_RULE_TYPES
 def get_user_rules(expander, mapper):
     u"""Get the user-supplied rules from the configuration file.
 
-    Return a dictionary {RUTC: AVRule}"""
+    Return a dictionary {RUTC: AVRule/XpermRule}"""
     supplied_rules = {}
+    rules = []
     for r in plugin_conf.NEVERALLOWS:
         # Convert the rules to unicode
         # If this is Python 2 and this is a str, convert to unicode
         if isinstance(r, str) and (sys.version_info < (3, 0)):
             r = r.decode("utf-8")
-        # Expand the possible global_macros in the rule
-        exp_r = expander.expand(r)
+        rules.append(r)
+    # Expand the possible global_macros in the rules, all at once
+    for exp_r in expander.expand_many(rules):
         # If the expansion failed, process the next rule
         if not exp_r:
             continue
@@ -58,6 +60,17 @@ def get_user_rules(expander, mapper):
     return supplied_rules
 
 
+def check_xperms(user_rule, xperms, rls):
+    u"""Report the rules granting the extended permissions xperms if they
+    include any permission in the user-specified neverallowxperm rule."""
+    neverallowed = xperms.intersection(user_rule.xperms)
+    if neverallowed:
+        print(u"Rule grants neverallowed {}: \"{}\"".format(
+            user_rule.xtype, neverallowed))
+        for r in rls:
+            print(u"    " + str(r))
+
+
 def main(policy, config):
     u"""Check that the policy obeys custom user-defined neverallow rules."""
     # Check that we have been fed a valid policy
@@ -71,23 +84,44 @@ def main(policy, config):
     # Process the user-submitted neverallow rules into a dictionary of
     # {RUTC: AVRule} for easier handling
     user_rules = get_user_rules(policy._expander, mapper)
+    masks = policy.permission_masks
+    # Match the whole rule type, e.g. "allow" but not "allowxperm"
+    supported_rule_types = tuple(
+        x + u" " for x in plugin_conf.SUPPORTED_RULE_TYPES)
+    # The allowxperm rules are only mapped if they are supported
+    check_allowxperm = u"allowxperm " in supported_rule_types
     # Check the rules
     for rutc, rls in iteritems(policy.mapping.rules):
-        if not rutc.startswith(plugin_conf.SUPPORTED_RULE_TYPES):
+        if not rutc.startswith(supported_rule_types):
+            continue
+        # If an allowxperm rule matches some user-specified neverallowxperm
+        # rule, check the extended permissions as interval sets
+        if rutc.startswith(u"allowxperm "):
+            if rutc in user_rules:
+                check_xperms(user_rules[rutc],
+                             policy.mapping.xperms(rutc), rls)
+            continue
+        # The allowxperm base corresponding to the allow rule, e.g.
+        # "allow a b:c" -> "allowxperm a b:c"
+        xperm_rutc = u"allowxperm" + rutc[len(u"allow"):]
+        if rutc not in user_rules and xperm_rutc not in user_rules:
             continue
+        allowed_mask = 0
+        for r in rls:
+            # Generate the AVrule object for the allow rule coming from
+            # the policy
+            rule = mapper.rule_factory(r.rule)
+            # Combine the permissions
+            allowed_mask |= rule.get_permmask(masks)
+        tclass = rutc.rsplit(u":", 1)[1]
         # If an allow rule matches some user-specified neverallow rule
         if rutc in user_rules:
-            allowed_perms = set()
-            for r in rls:
-                # Generate the AVrule object for the allow rule coming from
-                # the policy
-                rule = mapper.rule_factory(r.rule)
-                # Combine the permissions
-                allowed_perms.update(rule.permset)
             # If the rule allows any permission in the neverallow, report it
-            if allowed_perms & user_rules[rutc].permset:
+            neverallowed = allowed_mask & user_rules[rutc].get_permmask(masks)
+            if neverallowed:
+                allowed_perms = masks.names(tclass, allowed_mask)
                 print(u"Rule grants neverallowed permissions: \"{}\"".format(
-                    u" ".join(allowed_perms & user_rules[rutc].permset)))
+                    u" ".join(masks.names(tclass, neverallowed))))
                 full_rule = rutc + " "
                 if len(allowed_perms) > 1:
                     full_rule += u"{ " + u" ".join(allowed_perms) + u" };"
@@ -96,3 +130,12 @@ def main(policy, config):
                 print(u"  " + full_rule)
                 for r in rls:
                     print(u"    " + str(r))
+        # An allow rule granting e.g. the "ioctl" permission, with no
+        # allowxperm rule restricting it, grants every ioctl
+        if xperm_rutc in user_rules and check_allowxperm and \
+                xperm_rutc not in policy.mapping.rules:
+            xtype = user_rules[xperm_rutc].xtype
+            if allowed_mask & masks.mask(tclass, [xtype]):
+                check_xperms(user_rules[xperm_rutc],
+                             policysource.mapping.XpermSet().complement(),
+                             rls)
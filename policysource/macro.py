@@ -27,9 +27,15 @@ from builtins import range
 
 import os
 import re
+import uuid
+import select
 import tempfile
 import subprocess
 import logging
+import threading
+import multiprocessing
+import concurrent.futures
+import queue
 
 
 class Error(Exception):
@@ -55,14 +61,545 @@ class M4FreezeFileError(Error):
     pass
 
 
+class M4UnsupportedError(Error):
+    """Exception raised by the M4Interpreter if the input requires m4 features
+    which it does not implement"""
+    pass
+
+
+class M4CoprocessError(Error):
+    """Exception raised by the M4Coprocess if the m4 process dies or stops
+    answering"""
+    pass
+
+
+class M4Coprocess(object):
+    """Class wrapping a long-lived m4 process reading requests from stdin.
+
+    Each request is followed by a sentinel marker, which m4 copies to its
+    output as-is: the reply is everything up to the sentinel. Since m4 keeps
+    its state across requests, texts which may change it must not be sent to
+    the coprocess (see can_expand())."""
+    # Seconds to wait for m4 to produce more output before giving up
+    timeout = 10
+    # Number of bytes which can be written to a pipe without blocking
+    pipe_buf = getattr(select, u"PIPE_BUF", 512)
+    # Builtins whose effects outlast the request calling them
+    regex_state_builtins = re.compile(
+        r"\b(?:builtin|changecom|changequote|debugfile|debugmode|define|"
+        r"divert|include|indir|m4exit|m4wrap|popdef|pushdef|sinclude|"
+        r"traceoff|traceon|undefine|undivert)\b")
+
+    def __init__(self, freeze_file):
+        """Start a m4 process reloading the given freeze file."""
+        # Setup logger
+        self.log = logging.getLogger(self.__class__.__name__)
+        # Unique sentinel, which cannot clash with a macro name
+        self._sentinel = u"@@SELINT_{}@@".format(uuid.uuid4().hex)
+        # Run m4 in interactive mode, so that output is unbuffered
+        self.command = [u"m4", u"-i", u"-R", freeze_file, u"-"]
+        self.log.debug(u"$ %s", u" ".join(self.command))
+        try:
+            self._process = subprocess.Popen(
+                self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        except OSError as e:
+            raise M4CoprocessError(u"Could not start m4: {}".format(e))
+
+    def close(self):
+        """Terminate the m4 process."""
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.close()
+            except (IOError, OSError):
+                pass
+            try:
+                self._process.kill()
+            except OSError:
+                pass
+        self._process.wait()
+        self._process.stdout.close()
+        self._process.stderr.close()
+
+    def __del__(self):
+        """Terminate the m4 process"""
+        if hasattr(self, u"_process"):
+            self.close()
+
+    @classmethod
+    def can_expand(cls, text):
+        """Check whether a text can be expanded by the coprocess, giving the
+        same expansion as a separate m4 run."""
+        return cls.is_balanced(text) and not cls.changes_state(text)
+
+    @classmethod
+    def changes_state(cls, text):
+        """Check whether a text may change the m4 state, e.g. by defining a
+        macro, which would affect the expansion of the following requests.
+
+        The check is conservative: a builtin name is matched even when it is
+        quoted or in a comment."""
+        return cls.regex_state_builtins.search(text) is not None
+
+    @staticmethod
+    def is_balanced(text):
+        """Check whether a text has balanced quotes and parentheses, and does
+        not end in a comment.
+
+        m4 waits for more input after an unclosed quote or macro argument
+        list, so such a text would stall the coprocess until the timeout; a
+        comment at the end would swallow the sentinel marker.
+        The check is conservative: parentheses are counted even when they do
+        not follow a macro name."""
+        quotes = 0
+        parens = 0
+        comment = False
+        for char in text:
+            if comment:
+                # Comments run to the end of the line
+                comment = char != u"\n"
+            elif char == u"`":
+                quotes += 1
+            elif char == u"'":
+                quotes = max(quotes - 1, 0)
+            elif quotes:
+                continue
+            elif char == u"#":
+                comment = True
+            elif char == u"(":
+                parens += 1
+            elif char == u")":
+                parens = max(parens - 1, 0)
+        return not quotes and not parens and not comment
+
+    def _exchange(self, request, stream, marker):
+        """Send a request to the m4 process and read its reply from one of its
+        output streams, until the marker is found.
+
+        Writing and reading are interleaved, so that large requests cannot
+        deadlock on a full pipe. Return the data read before the marker."""
+        request = request.encode("utf-8")
+        marker = marker.encode("utf-8")
+        stdin = self._process.stdin.fileno()
+        stderr = self._process.stderr.fileno()
+        reply_fd = stream.fileno()
+        data = {reply_fd: b"", stderr: b""}
+        while not data[reply_fd].endswith(marker):
+            wlist = [stdin] if request else []
+            rlist, wlist, _ = select.select(
+                list(data), wlist, [], self.timeout)
+            if not rlist and not wlist:
+                raise M4CoprocessError(u"Timed out waiting for m4")
+            if wlist:
+                # Writing at most PIPE_BUF bytes never blocks
+                try:
+                    written = os.write(stdin, request[:self.pipe_buf])
+                except (IOError, OSError) as e:
+                    raise M4CoprocessError(
+                        u"Could not write to m4: {}".format(e))
+                request = request[written:]
+            for fdesc in rlist:
+                chunk = os.read(fdesc, 65536)
+                if not chunk:
+                    raise M4CoprocessError(u"m4 exited unexpectedly")
+                data[fdesc] += chunk
+        if reply_fd != stderr and data[stderr]:
+            # Report any warnings m4 has printed in the meantime
+            self.log.warning(u"%s", data[stderr].decode("utf-8").rstrip())
+        return data[reply_fd][:-len(marker)].decode("utf-8")
+
+    @staticmethod
+    def _request(text, marker):
+        """Get the request expanding a text followed by a marker."""
+        # The empty quotes terminate any token at the end of the text, and
+        # dnl discards the newline, so that nothing is added to the
+        # expansion. If the text ends in dnl, the whole line is discarded
+        return text + u"`'dnl\n" + marker
+
+    def expand(self, text):
+        """Expand a string of text with the m4 process."""
+        marker = self._sentinel + u"\n"
+        return self._exchange(self._request(text, marker),
+                              self._process.stdout, marker)
+
+    def expand_many(self, texts):
+        """Expand a list of strings of text with the m4 process in a single
+        request.
+
+        Return the list of expansions, with None for any text whose expansion
+        could not be told apart from the others."""
+        if not texts:
+            return []
+        markers = [u"{}{}\n".format(self._sentinel, i)
+                   for i in range(len(texts))]
+        request = u"".join(self._request(t, m)
+                           for t, m in zip(texts, markers))
+        output = self._exchange(request, self._process.stdout, markers[-1])
+        return split_expansions(output + markers[-1], markers)
+
+    def dump(self, text):
+        """Dump the definition of a m4 macro with the m4 process."""
+        marker = self._sentinel + u"\n"
+        # dumpdef prints to stderr: mark the end of the reply on stderr too,
+        # and discard the rest of the line so that nothing goes to stdout
+        request = u"dumpdef(`{}')errprint(`{}')dnl\n".format(text, marker)
+        return self._exchange(request, self._process.stderr, marker)
+
+    def dump_many(self, texts):
+        """Dump the definitions of a list of m4 macros with the m4 process in
+        a single request.
+
+        Return the list of definitions, with None for any definition which
+        could not be told apart from the others."""
+        if not texts:
+            return []
+        markers = [u"{}{}\n".format(self._sentinel, i)
+                   for i in range(len(texts))]
+        request = u"".join(u"dumpdef(`{}')errprint(`{}')".format(t, m)
+                           for t, m in zip(texts, markers)) + u"dnl\n"
+        output = self._exchange(request, self._process.stderr, markers[-1])
+        return split_expansions(output + markers[-1], markers)
+
+
+def split_expansions(output, markers):
+    """Split the output of a batch of m4 expansions, each one terminated by its
+    own marker.
+
+    Return the list of expansions, with None for each expansion which cannot
+    be isolated because its own or the previous marker is missing."""
+    expansions = []
+    start = 0
+    previous_missing = False
+    for marker in markers:
+        end = output.find(marker, start)
+        if end == -1:
+            # This expansion runs into the next one
+            expansions.append(None)
+            previous_missing = True
+        else:
+            if previous_missing:
+                # This expansion includes the previous one
+                expansions.append(None)
+                previous_missing = False
+            else:
+                expansions.append(output[start:end])
+            start = end + len(marker)
+    return expansions
+
+
+class M4Interpreter(object):
+    """Class providing an in-process interpreter for the subset of m4 used by
+    SEAndroid macro files.
+
+    The interpreter supports quoting, comments, macro definitions with $N,
+    $#, $* and $@ substitution, and the define, undefine, pushdef, popdef,
+    ifdef, ifelse, shift and dnl builtins. Any other builtin raises a
+    M4UnsupportedError, so that the caller can resort to the real m4."""
+    # Builtins implemented by the interpreter
+    supported_builtins = frozenset([
+        u"define", u"undefine", u"pushdef", u"popdef", u"ifdef", u"ifelse",
+        u"shift", u"dnl", u"__gnu__", u"__unix__"])
+    # GNU m4 builtins not implemented by the interpreter
+    unsupported_builtins = frozenset([
+        u"__file__", u"__line__", u"__program__", u"builtin", u"changecom",
+        u"changequote", u"debugmode", u"debugfile", u"decr", u"defn",
+        u"divert", u"divnum", u"dumpdef", u"errprint", u"esyscmd", u"eval",
+        u"format", u"include", u"incr", u"index", u"indir", u"len",
+        u"m4exit", u"m4wrap", u"maketemp", u"mkstemp", u"patsubst",
+        u"regexp", u"sinclude", u"substr", u"syscmd", u"sysval",
+        u"traceoff", u"traceon", u"translit", u"undivert"])
+    # Builtins which are only recognized when followed by arguments
+    blind_builtins = frozenset([
+        u"define", u"undefine", u"pushdef", u"popdef", u"ifdef", u"ifelse",
+        u"shift", u"builtin", u"decr", u"defn", u"errprint", u"esyscmd",
+        u"eval", u"format", u"include", u"incr", u"index", u"indir", u"len",
+        u"m4wrap", u"maketemp", u"mkstemp", u"patsubst", u"regexp",
+        u"sinclude", u"substr", u"syscmd", u"translit"])
+    # Maximum number of macro calls in a single expansion, to detect
+    # infinite recursion
+    max_calls = 100000
+    # m4 tokens
+    regex_word = re.compile(r"[_a-zA-Z][_a-zA-Z0-9]*")
+    regex_text = re.compile(r"[^_a-zA-Z`#(),]+")
+    regex_quotes = re.compile(r"[`']")
+    regex_argref = re.compile(r"\$(?:([0-9]+)|([#*@]))")
+
+    def __init__(self, macro_files=None, extra_defs=None):
+        """Initialize the interpreter, defining macros as
+        "m4 -D extra_defs... macro_files..." would.
+
+        Raise M4UnsupportedError if the files use unsupported features."""
+        # Setup logger
+        self.log = logging.getLogger(self.__class__.__name__)
+        # The macro definitions, as stacks of definitions
+        # Builtins are represented by a tuple ("builtin", name)
+        self._macros = {}
+        for name in self.supported_builtins | self.unsupported_builtins:
+            self._macros[name] = [(u"builtin", name)]
+        # The input being processed
+        self._input = u""
+        self._pos = 0
+        self._calls = 0
+        # The definitions changed by the current expansion, to be restored
+        # when it ends: {name: stack of definitions, or None if undefined}
+        self._journal = None
+        # Process the command line definitions
+        for definition in extra_defs or []:
+            name, _, value = definition.partition(u"=")
+            self._macros[name] = [value]
+        # Process the macro files, discarding the output and keeping the
+        # definitions
+        for macro_file in macro_files or []:
+            with open(macro_file, u"r", encoding=u'utf-8') as mfile:
+                self.__expand(mfile.read())
+
+    def expand(self, text):
+        """Expand a string of text with the current macro definitions.
+
+        Like a separate m4 run on the macro files, each expansion starts
+        from the definitions of the macro files: any macro (re)defined or
+        undefined by the text is restored afterwards.
+        Raise M4UnsupportedError if the text uses unsupported features."""
+        self._journal = {}
+        try:
+            return self.__expand(text)
+        finally:
+            for name, definitions in self._journal.items():
+                if definitions is None:
+                    self._macros.pop(name, None)
+                else:
+                    self._macros[name] = definitions
+            self._journal = None
+
+    def __expand(self, text):
+        """Expand a string of text, keeping any change to the definitions."""
+        self._input = text
+        self._pos = 0
+        self._calls = 0
+        try:
+            return self.__scan()
+        except RuntimeError:
+            # Maximum recursion depth exceeded
+            raise M4UnsupportedError(u"Macros nested too deeply")
+        finally:
+            self._input = u""
+
+    def __scan(self):
+        """Process the input until its end, returning the output."""
+        output = []
+        while True:
+            token = self.__next_token()
+            if token is None:
+                return u"".join(output)
+            kind, value = token
+            if kind == u"word" and value in self._macros:
+                if self.__call(value):
+                    continue
+            output.append(value)
+
+    def __next_token(self):
+        """Read the next token from the input.
+
+        Return a tuple (kind, text), where kind is "word" for names, "text"
+        for quoted strings (without the outer quotes), comments and other
+        text, or the character itself for parentheses and commas.
+        Return None at the end of the input."""
+        pos = self._pos
+        text = self._input
+        if pos >= len(text):
+            return None
+        char = text[pos]
+        if char == u"`":
+            # Quoted string, possibly containing nested quotes
+            level = 1
+            end = pos + 1
+            while level:
+                match = self.regex_quotes.search(text, end)
+                if not match:
+                    raise M4UnsupportedError(u"End of input in string")
+                level += 1 if match.group() == u"`" else -1
+                end = match.end()
+            self._pos = end
+            return (u"text", text[pos + 1:end - 1])
+        if char == u"#":
+            # Comment, copied as-is up to the end of the line
+            end = text.find(u"\n", pos)
+            if end == -1:
+                # m4 fails at the end of input in a comment
+                raise M4UnsupportedError(u"End of input in comment")
+            end += 1
+            self._pos = end
+            return (u"text", text[pos:end])
+        if char in u"(),":
+            self._pos = pos + 1
+            return (char, char)
+        match = self.regex_word.match(text, pos)
+        if match:
+            self._pos = match.end()
+            return (u"word", match.group())
+        match = self.regex_text.match(text, pos)
+        self._pos = match.end()
+        return (u"text", match.group())
+
+    def __push(self, text):
+        """Push text back to the input, to be rescanned."""
+        if text:
+            self._input = text + self._input[self._pos:]
+            self._pos = 0
+
+    def __call(self, name):
+        """Call a macro, pushing its expansion back to the input.
+
+        Return False if the macro is a builtin which needs arguments and has
+        not been given any, in which case its name is plain text."""
+        definition = self._macros[name][-1]
+        builtin = definition[1] if isinstance(definition, tuple) else None
+        has_args = self._input.startswith(u"(", self._pos)
+        if builtin in self.blind_builtins and not has_args:
+            return False
+        if builtin in self.unsupported_builtins:
+            raise M4UnsupportedError(
+                u"Unsupported builtin \"{}\"".format(builtin))
+        self._calls += 1
+        if self._calls > self.max_calls:
+            raise M4UnsupportedError(u"Too many macro calls")
+        if has_args:
+            self._pos += 1
+            args = self.__collect_args()
+        else:
+            args = []
+        if builtin:
+            self.__push(self.__builtin(builtin, args))
+        else:
+            self.__push(self.__substitute(definition, name, args))
+        return True
+
+    def __collect_args(self):
+        """Collect the arguments of a macro call, expanding macros in them.
+
+        The opening parenthesis must have already been consumed."""
+        args = []
+        current = []
+        level = 0
+        skip_whitespace = True
+        while True:
+            if skip_whitespace:
+                # Unquoted leading whitespace is not part of an argument
+                while self._input[self._pos:self._pos + 1].isspace():
+                    self._pos += 1
+                skip_whitespace = False
+            token = self.__next_token()
+            if token is None:
+                raise M4UnsupportedError(u"End of input in argument list")
+            kind, value = token
+            if kind == u"word" and value in self._macros:
+                if self.__call(value):
+                    continue
+            elif kind == u"(":
+                level += 1
+            elif kind == u")":
+                if not level:
+                    args.append(u"".join(current))
+                    return args
+                level -= 1
+            elif kind == u"," and not level:
+                args.append(u"".join(current))
+                current = []
+                skip_whitespace = True
+                continue
+            current.append(value)
+
+    @staticmethod
+    def __substitute(body, name, args):
+        """Substitute the argument references in a macro body."""
+        def reference(match):
+            """Get the value of an argument reference."""
+            if match.group(1) is not None:
+                i = int(match.group(1))
+                if i == 0:
+                    return name
+                return args[i - 1] if i <= len(args) else u""
+            if match.group(2) == u"#":
+                return str(len(args))
+            if match.group(2) == u"*":
+                return u",".join(args)
+            return u",".join(u"`" + x + u"'" for x in args)
+        return M4Interpreter.regex_argref.sub(reference, body)
+
+    def __save(self, name):
+        """Save the definitions of a macro in the journal before the first
+        change of the current expansion."""
+        if self._journal is not None and name not in self._journal:
+            if name in self._macros:
+                self._journal[name] = list(self._macros[name])
+            else:
+                self._journal[name] = None
+
+    def __builtin(self, name, args):
+        """Run a supported builtin, returning its expansion."""
+        if name in (u"define", u"pushdef"):
+            self.__save(args[0])
+            body = args[1] if len(args) > 1 else u""
+            if name == u"pushdef" and args[0] in self._macros:
+                self._macros[args[0]].append(body)
+            elif args[0] in self._macros:
+                # define replaces the topmost definition
+                self._macros[args[0]][-1] = body
+            else:
+                self._macros[args[0]] = [body]
+        elif name in (u"undefine", u"popdef"):
+            for arg in args:
+                if arg not in self._macros:
+                    continue
+                self.__save(arg)
+                if name == u"popdef" and len(self._macros[arg]) > 1:
+                    self._macros[arg].pop()
+                else:
+                    del self._macros[arg]
+        elif name == u"ifdef":
+            if len(args) >= 2:
+                if args[0] in self._macros:
+                    return args[1]
+                return args[2] if len(args) > 2 else u""
+        elif name == u"ifelse":
+            # Compare pairs of arguments, as GNU m4 does:
+            # ifelse(a, b, equal, [c, d, equal, ...] [not equal])
+            if len(args) < 3:
+                return u""
+            while True:
+                if args[0] == args[1]:
+                    return args[2]
+                if len(args) == 3:
+                    return u""
+                if len(args) in (4, 5):
+                    return args[3]
+                args = args[3:]
+        elif name == u"shift":
+            return u",".join(u"`" + x + u"'" for x in args[1:])
+        elif name == u"dnl":
+            # Discard the input up to and including the next newline
+            end = self._input.find(u"\n", self._pos)
+            self._pos = len(self._input) if end == -1 else end + 1
+        return u""
+
+
 class M4MacroExpander(object):
     """Class providing a way to expand m4 macros."""
+    # Number of times the m4 coprocess is restarted after a failure, before
+    # reverting to one m4 run per expansion for good
+    max_coprocess_restarts = 3
 
-    def __init__(self, macro_files, tmpdir, extra_defs):
+    def __init__(self, macro_files, tmpdir, extra_defs, coprocess=True,
+                 interpreter=True, freeze_file=None):
         """Initialize a macro expander.
 
         Create a freeze file with the supplied macro definition files,
-        and set it up to be used to expand m4 macros."""
+        and set it up to be used to expand m4 macros.
+        If an existing M4FreezeFile is supplied, use it instead.
+        If coprocess is True, expand macros with a single long-lived m4
+        process instead of running m4 once per expansion.
+        If interpreter is True, expand macros in-process whenever possible,
+        resorting to m4 only for unsupported features."""
         # Setup logger
         self.log = logging.getLogger(self.__class__.__name__)
         # Setup temporary directory
@@ -81,8 +618,10 @@ class M4MacroExpander(object):
             self._tmpdir_managed = True
         # Setup freeze file
         try:
-            self.freeze_file = M4FreezeFile(
-                macro_files, self.tmpdir, extra_defs)
+            if freeze_file is None:
+                freeze_file = M4FreezeFile(
+                    macro_files, self.tmpdir, extra_defs)
+            self.freeze_file = freeze_file
         except M4FreezeFileError as e:
             # We failed to generate the freeze file, abort
             self.log.error(u"%s", e.message)
@@ -98,10 +637,34 @@ class M4MacroExpander(object):
         # Define the expansion command
         self.expansion_command = [u"m4", u"-R",
                                   self.freeze_file.freeze_file, self.tmp]
+        # Expansions computed in advance by prefetch()
+        self._prefetched = {}
+        # Definitions dumped in advance by prefetch_dumps()
+        self._dumps = {}
+        # Start the m4 coprocess, if requested
+        self._coprocess = None
+        self._coprocess_restarts = 0
+        if coprocess:
+            try:
+                self._coprocess = M4Coprocess(self.freeze_file.freeze_file)
+            except M4CoprocessError as e:
+                self.log.warning(u"%s", e)
+                self.log.warning(u"Falling back to one m4 run per expansion")
+        # Load the macro definitions in the in-process interpreter, if
+        # requested
+        self._interpreter = None
+        if interpreter:
+            try:
+                self._interpreter = M4Interpreter(macro_files, extra_defs)
+            except (M4UnsupportedError, IOError) as e:
+                self.log.debug(u"%s", e)
+                self.log.debug(u"Cannot use the m4 interpreter, using m4")
 
     def __del__(self):
         """Clean up the temporary file, the freeze file and the
         temporary directory"""
+        # Stop the coprocess
+        self.__stop_coprocess()
         # Remove the temporary file
         try:
             os.remove(self.tmp)
@@ -124,8 +687,47 @@ class M4MacroExpander(object):
                 self.log.debug(u"Trying to remove the temporary directory"
                                u" \"%s\"... done!", self.tmpdir)
 
+    def __stop_coprocess(self):
+        """Terminate the m4 coprocess, if running."""
+        if getattr(self, u"_coprocess", None) is not None:
+            self._coprocess.close()
+            self._coprocess = None
+
+    def __coprocess_failed(self, error):
+        """Handle a coprocess failure by restarting it, or by reverting to
+        one m4 run per call if it keeps failing."""
+        self.log.warning(u"%s", error)
+        self.__stop_coprocess()
+        if self._coprocess_restarts < self.max_coprocess_restarts:
+            self._coprocess_restarts += 1
+            self.log.warning(u"The m4 coprocess failed, restarting it...")
+            try:
+                self._coprocess = M4Coprocess(self.freeze_file.freeze_file)
+            except M4CoprocessError as e:
+                self.log.warning(u"%s", e)
+            else:
+                return
+        self.log.warning(u"The m4 coprocess failed, falling back to one m4 "
+                         u"run per expansion")
+
+    def __use_coprocess(self, text):
+        """Check whether a text can be sent to the m4 coprocess."""
+        return self._coprocess is not None and M4Coprocess.can_expand(text)
+
     def expand(self, text):
         """Expand a string of text representing a m4 macro."""
+        if text in self._prefetched:
+            return self._prefetched[text]
+        if self._interpreter is not None:
+            try:
+                return self._interpreter.expand(text)
+            except M4UnsupportedError as e:
+                self.log.debug(u"%s, expanding \"%s\" with m4", e, text)
+        if self.__use_coprocess(text):
+            try:
+                return self._coprocess.expand(text)
+            except M4CoprocessError as e:
+                self.__coprocess_failed(e)
         # Write the macro to the temporary file
         with open(self.tmp, u"w", encoding=u'utf-8') as mfile:
             mfile.write(text)
@@ -140,8 +742,148 @@ class M4MacroExpander(object):
             expansion = expansion.decode("utf-8")
         return expansion
 
+    def expand_many(self, texts):
+        """Expand a list of strings of text representing m4 macros with a
+        single m4 run.
+
+        Return the list of expansions, in the same order. As with expand(),
+        an expansion is None if m4 failed to expand the corresponding text."""
+        texts = list(texts)
+        if self._interpreter is not None:
+            # Expand in-process what we can, and only the rest with m4
+            expansions = []
+            remaining = []
+            for text in texts:
+                try:
+                    expansions.append(self._interpreter.expand(text))
+                except M4UnsupportedError:
+                    expansions.append(None)
+                    remaining.append(text)
+            if remaining:
+                self.log.debug(u"Expanding %d texts with m4", len(remaining))
+                remaining = iter(self.__expand_many_m4(remaining))
+                expansions = [x if x is not None else next(remaining)
+                              for x in expansions]
+            return expansions
+        return self.__expand_many_m4(texts)
+
+    def __expand_many_m4(self, texts):
+        """Expand a list of strings of text with a single m4 run."""
+        # Texts which may change the m4 state are expanded individually, so
+        # that they cannot affect the expansion of the others
+        stateless = [not M4Coprocess.changes_state(x) for x in texts]
+        if not all(stateless):
+            batch = iter(self.__expand_many_m4(
+                [x for x, s in zip(texts, stateless) if s]))
+            return [next(batch) if s else self.expand(x)
+                    for x, s in zip(texts, stateless)]
+        expansions = None
+        if self._coprocess is not None:
+            # Unbalanced texts are expanded individually below
+            balanced = [M4Coprocess.is_balanced(x) for x in texts]
+            try:
+                expansions = iter(self._coprocess.expand_many(
+                    [x for x, b in zip(texts, balanced) if b]))
+            except M4CoprocessError as e:
+                self.__coprocess_failed(e)
+                expansions = None
+            else:
+                expansions = [next(expansions) if b else None
+                              for b in balanced]
+        if expansions is None:
+            # Separate the texts with unique markers, which m4 copies to the
+            # output as-is
+            sentinel = u"@@SELINT_{}".format(uuid.uuid4().hex)
+            markers = [u"\n{}{}@@\n".format(sentinel, i)
+                       for i in range(len(texts))]
+            with open(self.tmp, u"w", encoding=u'utf-8') as mfile:
+                for text, marker in zip(texts, markers):
+                    mfile.write(text + marker)
+            try:
+                output = subprocess.check_output(self.expansion_command)
+            except subprocess.CalledProcessError as e:
+                # Some text broke the whole run: expand them one by one
+                self.log.debug(u"%s", e.output)
+                expansions = [None] * len(texts)
+            else:
+                expansions = split_expansions(output.decode("utf-8"),
+                                              markers)
+        # Expand individually any text which could not be told apart from
+        # the others, e.g. because of unbalanced quotes or parentheses
+        for i, expansion in enumerate(expansions):
+            if expansion is None:
+                expansions[i] = self.expand(texts[i])
+        return expansions
+
+    def prefetch(self, texts):
+        """Expand a collection of texts with a single m4 run, and keep the
+        expansions to answer later calls to expand() without running m4."""
+        texts = [x for x in set(texts) if x not in self._prefetched]
+        for text, expansion in zip(texts, self.expand_many(texts)):
+            if expansion is not None:
+                self._prefetched[text] = expansion
+        self.log.debug(u"Prefetched %d expansions", len(texts))
+
+    def forget_prefetched(self):
+        """Drop the expansions computed by prefetch()."""
+        self._prefetched = {}
+
+    def dump_many(self, texts):
+        """Dump the definitions of a list of m4 macros with a single m4 run.
+
+        Return the list of definitions, in the same order."""
+        texts = list(texts)
+        definitions = None
+        if self._coprocess is not None and \
+                all(M4Coprocess.is_balanced(x) for x in texts):
+            try:
+                definitions = self._coprocess.dump_many(texts)
+            except M4CoprocessError as e:
+                self.__coprocess_failed(e)
+        if definitions is None:
+            # dumpdef prints to stderr: separate the definitions with unique
+            # markers printed on stderr as well
+            sentinel = u"@@SELINT_{}".format(uuid.uuid4().hex)
+            markers = [u"{}{}@@\n".format(sentinel, i)
+                       for i in range(len(texts))]
+            with open(self.tmp, u"w", encoding=u'utf-8') as mfile:
+                for text, marker in zip(texts, markers):
+                    mfile.write(u"dumpdef(`{}')errprint(`{}')".format(
+                        text, marker))
+            try:
+                output = subprocess.check_output(self.expansion_command,
+                                                 stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                self.log.debug(u"%s", e.output)
+                definitions = [None] * len(texts)
+            else:
+                definitions = split_expansions(output.decode("utf-8"),
+                                               markers)
+        # Dump individually any definition which could not be told apart
+        for i, definition in enumerate(definitions):
+            if definition is None:
+                definitions[i] = self.dump(texts[i])
+        return definitions
+
+    def prefetch_dumps(self, texts):
+        """Dump the definitions of a collection of m4 macros with a single m4
+        run, and keep them to answer later calls to dump() without running
+        m4."""
+        texts = [x for x in set(texts) if x not in self._dumps]
+        for text, definition in zip(texts, self.dump_many(texts)):
+            if definition is not None:
+                self._dumps[text] = definition
+        self.log.debug(u"Prefetched %d macro definitions", len(texts))
+
     def dump(self, text):
         """Dump the definition of a m4 macro."""
+        if text in self._dumps:
+            return self._dumps[text]
+        if self.__use_coprocess(text):
+            try:
+                return self._coprocess.dump(text)
+            except M4CoprocessError as e:
+                self.__coprocess_failed(e)
         # Write the command to a temporary file
         with open(self.tmp, u"w", encoding=u'utf-8') as mfile:
             mfile.write(u"dumpdef(`{}')".format(text))
@@ -174,6 +916,108 @@ class M4MacroExpander(object):
         return self._tmp
 
 
+class M4MacroExpanderPool(object):
+    """Class providing a pool of independent M4MacroExpander workers, to
+    expand m4 macros concurrently.
+
+    The workers share the freeze file of a template expander, but each has
+    its own scratch file and m4 coprocess. Workers are started on demand, up
+    to the maximum number of workers."""
+
+    def __init__(self, expander, workers=None):
+        """Initialize a pool of expanders sharing the freeze file of the
+        supplied expander.
+
+        The number of workers defaults to the number of CPUs."""
+        # Setup logger
+        self.log = logging.getLogger(self.__class__.__name__)
+        if not workers:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+        self.workers = workers
+        # Keep the template expander alive as long as its freeze file is in
+        # use, so that its temporary directory is removed last
+        self._template = expander
+        self._expanders = []
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def __del__(self):
+        """Stop the workers"""
+        if hasattr(self, u"_executor"):
+            self.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def shutdown(self):
+        """Wait for the pending calls, and stop all the workers."""
+        self._executor.shutdown(wait=True)
+        self._idle = queue.Queue()
+        # Remove the workers before the template expander
+        del self._expanders[:]
+
+    def __acquire(self):
+        """Get an idle expander, starting a new one if possible."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._expanders) < self.workers:
+                freeze_file = self._template.freeze_file
+                expander = M4MacroExpander(
+                    freeze_file.files, None, freeze_file.extra_defs,
+                    freeze_file=freeze_file)
+                self._expanders.append(expander)
+                self.log.debug(u"Started expander %d/%d",
+                               len(self._expanders), self.workers)
+                return expander
+        return self._idle.get()
+
+    def __run(self, fn, *args, **kwargs):
+        """Call fn with an idle expander as its first argument."""
+        expander = self.__acquire()
+        try:
+            return fn(expander, *args, **kwargs)
+        finally:
+            self._idle.put(expander)
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(expander, *args, **kwargs) to be run by an idle
+        expander, as concurrent.futures.Executor.submit() does.
+
+        Return a Future representing the result of the call."""
+        return self._executor.submit(self.__run, fn, *args, **kwargs)
+
+    def map(self, fn, *iterables):
+        """Call fn(expander, *args) for each tuple of arguments taken from
+        the iterables, concurrently.
+
+        Return an iterator over the results, in order."""
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return (f.result() for f in futures)
+
+    def expand_many(self, texts):
+        """Expand a list of strings of text, splitting them evenly among the
+        workers.
+
+        Return the list of expansions, in the same order."""
+        texts = list(texts)
+        size = max(1, -(-len(texts) // self.workers))
+        chunks = [texts[i:i + size] for i in range(0, len(texts), size)]
+        expansions = []
+        for chunk in self.map(M4MacroExpander.expand_many, chunks):
+            expansions.extend(chunk)
+        return expansions
+
+
 class M4FreezeFile(object):
 
     """Class for handling an m4 freeze file."""
@@ -253,16 +1097,29 @@ class M4Macro(object):
         """Get the macro name."""
         return self._name
 
+    def __placeholder_call(self):
+        """Get the macro call with numbered placeholder arguments."""
+        placeholders = []
+        for i in range(self.nargs):
+            placeholders.append(u"@@ARG{}@@".format(i))
+        return self.name + u"(" + u", ".join(placeholders) + u")"
+
+    def pending_m4_call(self, args=None):
+        """Get the text that m4 still has to expand before expand(args) can
+        be computed, or None if no m4 run is needed.
+
+        This allows expanding many macros in advance with a single m4 run
+        (see M4MacroExpander.prefetch())."""
+        if self.nargs == 0:
+            return self.name if not self._expansion else None
+        if args is None or len(args) != len(self.args):
+            return None
+        if not self.expansion_static:
+            return self.name + u"(" + u", ".join(args) + u")"
+        return self.__placeholder_call() if not self._expansion else None
+
     def expand(self, args=None):
         """Get the macro expansion using the provided arguments."""
-        # Check whether the M4 expansion is static (simple variable
-        # substitution) or dynamic (ifelses, ...)
-        if self._expansion_static is None:
-            # If the macro definition contains any m4 operator
-            if any(s in self.dump for s in M4Macro.operators):
-                self._expansion_static = False
-            else:
-                self._expansion_static = True
         if self.nargs == 0:
             # Ignore supplied arguments
             # Macro without arguments: the expansion is static. Save it for
@@ -289,11 +1146,7 @@ class M4Macro(object):
             # perform Python string formatting all the other times.
             if not self._expansion:
                 # Get the expansion with placeholders, if we don't have it
-                placeholders = []
-                for i in range(self.nargs):
-                    placeholders.append(u"@@ARG{}@@".format(i))
-                tmp = self.name + u"(" + u", ".join(placeholders) + u")"
-                expansion = self._expander.expand(tmp)
+                expansion = self._expander.expand(self.__placeholder_call())
                 # Double all curly brackets to make them literal
                 expansion = re.sub(r"([{}])", r"\1\1", expansion)
                 # Substitute @@ARGN@@ with {N} to format the argument for
@@ -307,6 +1160,14 @@ class M4Macro(object):
     def expansion_static(self):
         """Check whether the macro expansion is static (simple string
         substitution) or dynamic (variable length depending on arguments)."""
+        # Check whether the M4 expansion is static (simple variable
+        # substitution) or dynamic (ifelses, ...)
+        if self._expansion_static is None:
+            # If the macro definition contains any m4 operator
+            if any(s in self.dump for s in M4Macro.operators):
+                self._expansion_static = False
+            else:
+                self._expansion_static = True
         return self._expansion_static
 
     @property
@@ -345,21 +1206,27 @@ class M4Macro(object):
         return tmp
 
     def __eq__(self, other):
+        if self is other:
+            return True
         # If they have the same representation
-        # And the same expansion
         # And they are defined in the same file
         # And they have the same number of arguments
         # And the same comments
+        # And the same expansion (checked last, since it may call m4)
         return str(self) == str(other)\
-            and self.expand() == other.expand()\
             and self.file_defined == other.file_defined\
             and self.nargs == other.nargs\
             and len(self.comments) == len(other.comments)\
-            and u"".join(self.comments) == u"".join(other.comments)
+            and u"".join(self.comments) == u"".join(other.comments)\
+            and self.expand() == other.expand()
 
     def __ne__(self, other):
         return not self == other
 
+    def __hash__(self):
+        # A macro is identified by its name and the file defining it
+        return hash((self.name, self.file_defined))
+
 
 class MacroInPolicy(object):
 
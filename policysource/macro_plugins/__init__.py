@@ -23,9 +23,11 @@ u"""Plugin module implementing file-specific macro parsing functions"""
 # Necessary for Python 2/3 compatibility
 from __future__ import absolute_import
 from future.utils import itervalues
+from io import open
 
 import os
 from os import path
+import re
 import sys
 import keyword
 import inspect
@@ -56,6 +58,7 @@ class M4MacroParser(object):
 
     The class handles a list of specific macro files through a plugin
     architecture defined in the macro_plugin module."""
+    regex_macrodef = re.compile(r'^define\(\`([^\']+)\'')
 
     def __init__(self, tmpdir=None, extra_defs=None):
         u"""Initialize plugin architecture.
@@ -121,6 +124,17 @@ class M4MacroParser(object):
             self.log.info(u"Parsed macros from \"%s\"", single_file)
         return f_macros
 
+    def __find_macro_names__(self, files):
+        u"""Find the names of all the macros defined in the given files."""
+        names = set()
+        for single_file in files:
+            with open(single_file, u'r', encoding=u'utf-8') as macro_file:
+                for line in macro_file:
+                    match = self.regex_macrodef.search(line)
+                    if match:
+                        names.add(match.group(1))
+        return names
+
     def expects(self):
         u"""Returns a list of files that the parser can handle."""
         return self.plugins.keys()
@@ -135,6 +149,9 @@ class M4MacroParser(object):
             self.log.error(u"%s", e.message)
             macros = None
         else:
+            # Dump all macro definitions with a single m4 run
+            self.macro_expander.prefetch_dumps(
+                self.__find_macro_names__(files))
             # Parse each file, using the macro expander
             macros = {}
             for single_file in files:
@@ -152,4 +169,8 @@ class M4MacroParser(object):
                 else:
                     # We don't have a parser for this file
                     self.log.debug(u"No parser for \"%s\"", single_file)
+            # Fill in the definition of every macro from the dumps, and check
+            # whether its expansion is static
+            for macro in itervalues(macros):
+                macro.expansion_static
         return macros
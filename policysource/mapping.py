@@ -23,20 +23,46 @@ it was defined."""
 
 # Necessary for Python 2/3 compatibility
 from __future__ import absolute_import
-from io import open
+from builtins import range
+from io import open, BytesIO
+from future.utils import iteritems
 
 import logging
+import os
 import re
+import bisect
+import mmap
+from array import array
+import struct
+import zlib
+import multiprocessing
+from collections import OrderedDict
+try:
+    import collections.abc as collections_abc
+except ImportError:
+    import collections as collections_abc
 
 # TODO: source from config file
 ONLY_MAP_RULES = (u"allow", u"auditallow", u"dontaudit",
-                  u"neverallow", u"type_transition")
+                  u"neverallow", u"type_transition", u"allowxperm",
+                  u"auditallowxperm", u"dontauditxperm", u"neverallowxperm")
 
 
 # TODO: source from config file?
 AVRULES = (u"allow", u"auditallow", u"dontaudit", u"neverallow")
 TERULES = (u"type_transition", u"type_change",
            u"type_member", u"typebounds")
+XPERMRULES = (u"allowxperm", u"auditallowxperm", u"dontauditxperm",
+              u"neverallowxperm")
+
+# The Mapper whose policy.conf segments are being mapped, inherited by the
+# forked worker processes
+_SEGMENT_MAPPER = None
+
+
+def _map_segment(segment):
+    """Map a policy.conf segment in a worker process."""
+    return _SEGMENT_MAPPER.map_segment(*segment)
 
 
 class Mapping(object):
@@ -64,10 +90,803 @@ class Mapping(object):
     def __init__(self, rules, lines):
         self.rules = rules
         self.lines = lines
+        # The secondary indexes, built on demand
+        self._index = None
+
+    @property
+    def index(self):
+        """Get the secondary indexes on the rules, building them the first
+        time they are needed."""
+        if self._index is None:
+            self._index = MappingIndex(self.rules)
+        return self._index
+
+    def find(self, rtype=None, source=None, target=None, tclass=None,
+             perm=None, filename=None):
+        """Find the rules matching all the given criteria.
+
+        Each criterion is checked independently on the rules sharing a
+        "ruletype source target:class" base, e.g. a base matches
+        perm="read" and filename="a.te" if one of its rules grants "read"
+        and one of its rules was found in "a.te".
+        Return a set of "ruletype source target:class" strings, which are
+        keys of the rules dictionary."""
+        criteria = ((self.index.by_rtype, rtype),
+                    (self.index.by_source, source),
+                    (self.index.by_target, target),
+                    (self.index.by_class, tclass),
+                    (self.index.by_perm, perm),
+                    (self.index.by_file, filename))
+        matches = [index.get(value, frozenset())
+                   for index, value in criteria if value is not None]
+        if not matches:
+            return set(self.rules)
+        # Intersect the smallest sets first
+        matches.sort(key=len)
+        return set(matches[0]).intersection(*matches[1:])
+
+    def xperms(self, rutc):
+        """Get the extended permissions granted by the xperm rules with the
+        given "ruletype source target:class" base, as an XpermSet."""
+        xperms = XpermSet()
+        for mpr in self.rules.get(rutc, []):
+            # e.g. "allowxperm a b:c ioctl { 0x8900-0x8906 };"
+            block = mpr.rule[len(rutc) + 1:-1].split(u" ", 1)[1]
+            xperms = xperms.union(XpermSet.from_block(block))
+        return xperms
+
+    def rules_from_file(self, filename):
+        """Get the list of MappedRules found in a file."""
+        return self.index.file_rules.get(filename, [])
+
+    def without(self, rule_types):
+        """Get a view of the mapping hiding the rules of the given types.
+
+        The view shares the underlying dictionaries, nothing is copied."""
+        hidden = tuple(x + u" " for x in rule_types)
+        return Mapping(FilteredRules(self.rules, hidden),
+                       FilteredLines(self.lines, hidden))
+
+    def save(self, path):
+        """Save the mapping to a file, in the MappingFile binary format."""
+        MappingFile.write(path, self.rules, self.lines)
+
+    @staticmethod
+    def load(path, verify=False):
+        """Load a mapping saved to a file.
+
+        The file is memory-mapped, and the rules and lines are read from it
+        on demand. If verify is True, the whole file is read once to check
+        that it is not corrupted."""
+        mapping_file = MappingFile(path, verify)
+        return Mapping(StoredRules(mapping_file), StoredLines(mapping_file))
+
+
+class MappingIndex(object):
+    """Secondary indexes on the rules of a mapping.
+
+    The indexes map a rule type, source type, target type, class, permission
+    or origin file to the set of "ruletype source target:class" bases of
+    the matching rules."""
+
+    def __init__(self, rules):
+        self.by_rtype = {}
+        self.by_source = {}
+        self.by_target = {}
+        self.by_class = {}
+        self.by_perm = {}
+        self.by_file = {}
+        # The MappedRules found in each origin file
+        self.file_rules = {}
+        for rutc, mapped_rules in iteritems(rules):
+            # Split the base, e.g. "allow a b:c"
+            rtype, source, target_class = rutc.split(u" ")
+            target, tclass = target_class.split(u":")
+            self.__add(self.by_rtype, rtype, rutc)
+            self.__add(self.by_source, source, rutc)
+            self.__add(self.by_target, target, rutc)
+            self.__add(self.by_class, tclass, rutc)
+            for mpr in mapped_rules:
+                filename = Mapping.get_fileline_file(mpr.fileline)
+                self.__add(self.by_file, filename, rutc)
+                if filename in self.file_rules:
+                    self.file_rules[filename].append(mpr)
+                else:
+                    self.file_rules[filename] = [mpr]
+                # Only AV rules have permissions, e.g. "allow a b:c { d e };"
+                if rtype in AVRULES:
+                    perms = mpr.rule[len(rutc) + 1:-1].strip(u"{} ")
+                    for perm in perms.split(u" "):
+                        self.__add(self.by_perm, perm, rutc)
+
+    @staticmethod
+    def __add(index, key, rutc):
+        """Add a base to the set of an index key."""
+        if key in index:
+            index[key].add(rutc)
+        else:
+            index[key] = set([rutc])
+
+
+class SymbolTable(object):
+    """Table of interned strings.
+
+    Each distinct string is stored only once, and is assigned a small integer
+    id, in order of insertion."""
+    __slots__ = (u"_ids", u"_symbols")
+
+    def __init__(self):
+        self._ids = {}
+        self._symbols = []
+
+    def intern(self, symbol):
+        """Get the canonical copy of a string, adding it to the table if it
+        is not there yet."""
+        i = self._ids.get(symbol)
+        if i is None:
+            self._ids[symbol] = len(self._symbols)
+            self._symbols.append(symbol)
+            return symbol
+        return self._symbols[i]
+
+    def get_id(self, symbol):
+        """Get the id of a string, adding it to the table if needed."""
+        i = self._ids.get(symbol)
+        if i is None:
+            i = self._ids[symbol] = len(self._symbols)
+            self._symbols.append(symbol)
+        return i
+
+    def get_symbol(self, i):
+        """Get the string with the given id."""
+        return self._symbols[i]
+
+    def symbols(self):
+        """Get the list of strings, in order of insertion."""
+        return list(self._symbols)
+
+    def __contains__(self, symbol):
+        return symbol in self._ids
+
+    def __len__(self):
+        return len(self._symbols)
+
+
+class LazyRule(object):
+    """A rule stored in its unexpanded form, as the options of its subject,
+    object and class blocks."""
+    __slots__ = (u"rtype", u"subjects", u"objects", u"tails",
+                 u"original_rule", u"fileline")
+
+    def __init__(self, rtype, subjects, objects, tails):
+        """Initialize a LazyRule.
+
+        rtype    - the rule type, e.g. "allow"
+        subjects - the subject types, as a (tuple, frozenset) pair
+        objects  - the object types, as a (tuple, frozenset) pair, or None
+                   if the object is "self"
+        tails    - an ordered dictionary {class: tail}, where the tail
+                   completes the rule after the class, e.g. " { read };"
+        """
+        self.rtype = rtype
+        self.subjects = subjects
+        self.objects = objects
+        self.tails = tails
+        self.original_rule = None
+        self.fileline = None
+
+    def expansions(self):
+        """Generate the expanded (source, target, class) tuples, in the order
+        the Mapper expands them."""
+        if self.rtype not in TERULES:
+            for cls in self.tails:
+                for sub in self.subjects[0]:
+                    if self.objects is None:
+                        yield (sub, sub, cls)
+                        continue
+                    for obj in self.objects[0]:
+                        yield (sub, obj, cls)
+        else:
+            for sub in self.subjects[0]:
+                for obj in self.objects[0]:
+                    for cls in self.tails:
+                        yield (sub, obj, cls)
+
+    def bases(self):
+        """Generate the expanded "ruletype source target:class" bases, in
+        the order the Mapper expands them."""
+        rtype = self.rtype + u" "
+        for sub, obj, cls in self.expansions():
+            yield rtype + sub + u" " + obj + u":" + cls
+
+
+class LazyRules(collections_abc.Mapping):
+    """Rules dictionary storing each rule once in its unexpanded form.
+
+    The expanded MappedRules of a "ruletype source target:class" base are
+    generated when the base is looked up, by checking the target against the
+    object sets of the rules indexed under the source. Iterating over the
+    dictionary generates all the bases."""
+
+    def __init__(self):
+        # The rules, in the order they are found
+        self._rules = []
+        # The rules by (rule type, class), grouped by subject and object
+        # sets: {(rtype, class): {subjects: {objects: [(n, LazyRule)]}}},
+        # where n is the position of the rule and objects is None for "self"
+        self._by_class = {}
+        # The subject groups of _by_class containing each subject type or
+        # attribute: {(rtype, class): {subject: [{objects: [...]}]}}
+        self._by_source = {}
+        # The number of bases, computed on demand
+        self._len = None
+
+    def add(self, rule):
+        """Add a LazyRule."""
+        entry = (len(self._rules), rule)
+        self._rules.append(rule)
+        subjects = rule.subjects[1]
+        objects = rule.objects[1] if rule.objects is not None else None
+        for cls in rule.tails:
+            key = (rule.rtype, cls)
+            if key not in self._by_class:
+                self._by_class[key] = {}
+                self._by_source[key] = {}
+            groups = self._by_class[key]
+            if subjects not in groups:
+                groups[subjects] = {}
+                # The rules sharing a subject set are indexed once
+                by_source = self._by_source[key]
+                for sub in subjects:
+                    if sub in by_source:
+                        by_source[sub].append(groups[subjects])
+                    else:
+                        by_source[sub] = [groups[subjects]]
+            group = groups[subjects]
+            if objects in group:
+                group[objects].append(entry)
+            else:
+                group[objects] = [entry]
+        self._len = None
+
+    def __lookup(self, rtype, source, target, tclass):
+        """Get the (n, LazyRule) tuples of the rules expanding to a base, in
+        the order they are found."""
+        matching = []
+        for group in self._by_source.get((rtype, tclass), {}).get(source, ()):
+            for objects, entries in iteritems(group):
+                if objects is None:
+                    if target == source:
+                        matching.extend(entries)
+                elif target in objects:
+                    matching.extend(entries)
+        if len(matching) > 1:
+            matching.sort(key=lambda x: x[0])
+        return matching
+
+    def __matching(self, key):
+        """Get the (tail, LazyRule) tuples of the rules expanding to a
+        base."""
+        try:
+            rtype, source, target_class = key.split(u" ")
+            target, tclass = target_class.split(u":")
+        except (AttributeError, ValueError):
+            return []
+        return [(x.tails[tclass], x)
+                for _, x in self.__lookup(rtype, source, target, tclass)]
+
+    def __getitem__(self, key):
+        matching = self.__matching(key)
+        if not matching:
+            raise KeyError(key)
+        return [MappedRule(key + tail, x.original_rule, x.fileline)
+                for tail, x in matching]
+
+    def __contains__(self, key):
+        return bool(self.__matching(key))
+
+    def __iter__(self):
+        for key, _ in self.__first_expansions():
+            yield key
+
+    def __first_expansions(self):
+        """Generate the (base, matching (n, LazyRule) tuples) of each base,
+        when the first rule expanding to it is found."""
+        for n, rule in enumerate(self._rules):
+            rtype = rule.rtype + u" "
+            for sub, obj, cls in rule.expansions():
+                matching = self.__lookup(rule.rtype, sub, obj, cls)
+                # Only the first rule expanding to the base generates it
+                if matching[0][0] == n:
+                    yield (rtype + sub + u" " + obj + u":" + cls, matching)
+
+    def iteritems(self):
+        """Generate the (base, [MappedRule]) items in a single pass over the
+        rules, without a lookup for each base."""
+        for key, matching in self.__first_expansions():
+            tclass = key[key.rindex(u":") + 1:]
+            yield (key, [MappedRule(key + x.tails[tclass], x.original_rule,
+                                    x.fileline) for _, x in matching])
+
+    def itervalues(self):
+        """Generate the [MappedRule] values in a single pass over the
+        rules."""
+        for _, value in self.iteritems():
+            yield value
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(1 for x in self)
+        return self._len
+
+
+class FilteredRules(collections_abc.Mapping):
+    """Read-only view of a rules dictionary, hiding the rules whose key
+    starts with one of the given prefixes."""
+
+    def __init__(self, rules, hidden):
+        self._rules = rules
+        self._hidden = hidden
+        self._len = None
+
+    def __getitem__(self, key):
+        if key.startswith(self._hidden):
+            raise KeyError(key)
+        return self._rules[key]
+
+    def __contains__(self, key):
+        return not key.startswith(self._hidden) and key in self._rules
+
+    def __iter__(self):
+        return (k for k in self._rules if not k.startswith(self._hidden))
+
+    def iteritems(self):
+        """Generate the (key, value) items, using the single pass of the
+        underlying dictionary if it has one."""
+        return ((k, v) for k, v in iteritems(self._rules)
+                if not k.startswith(self._hidden))
+
+    def itervalues(self):
+        """Generate the values, using the single pass of the underlying
+        dictionary if it has one."""
+        return (v for _, v in self.iteritems())
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+        return self._len
+
+
+class FilteredLines(collections_abc.Mapping):
+    """Read-only view of a lines dictionary, hiding the original rules which
+    start with one of the given prefixes, and the filelines left empty."""
+
+    def __init__(self, lines, hidden):
+        self._lines = lines
+        self._hidden = hidden
+        self._len = None
+
+    def __getitem__(self, key):
+        rules = [x for x in self._lines[key] if not x.startswith(self._hidden)]
+        if not rules:
+            raise KeyError(key)
+        return rules
+
+    def __iter__(self):
+        for key, rules in iteritems(self._lines):
+            if not all(x.startswith(self._hidden) for x in rules):
+                yield key
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+        return self._len
+
+
+class LineIndex(collections_abc.Mapping):
+    """Lines dictionary storing, instead of the original rules, where they
+    are in the policy.conf file.
+
+    Each original rule is stored as the (offset, length) byte span of the
+    group of policy.conf lines it was found in, and its index among the
+    rules of the group. The rules are read back from the file on demand.
+
+    The file is kept memory-mapped for as long as the index exists, so that
+    the rules can still be read after the file is removed, e.g. when the
+    SourcePolicy which created the policy.conf is deleted."""
+
+    def __init__(self, path):
+        self._data = None
+        self.path = path
+        # The records of the original rules. Records are numbered from 1,
+        # and each record links to the previous record of the same
+        # fileline, or to 0
+        self._offsets = array(u"L")
+        self._lengths = array(u"L")
+        self._indexes = array(u"L")
+        self._previous = array(u"L")
+        # The last record of each fileline
+        self._last = {}
+
+    @property
+    def path(self):
+        """Get the path of the policy.conf file."""
+        return self._path
+
+    @path.setter
+    def path(self, path):
+        """Set the path of the policy.conf file, and map the file."""
+        self._path = path
+        if self._data is not None and not isinstance(self._data, bytes):
+            self._data.close()
+        self._data = None
+        with open(path, u"rb") as policy_conf:
+            if os.fstat(policy_conf.fileno()).st_size:
+                self._data = mmap.mmap(policy_conf.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            else:
+                # Empty files cannot be mapped
+                self._data = b""
+
+    def __getstate__(self):
+        # The file is mapped again when the path is set after unpickling
+        state = self.__dict__.copy()
+        state[u"_data"] = None
+        return state
+
+    def add(self, fileline, offset, length, index):
+        """Add the record of an original rule found at fileline."""
+        self._offsets.append(offset)
+        self._lengths.append(length)
+        self._indexes.append(index)
+        self._previous.append(self._last.get(fileline, 0))
+        self._last[fileline] = len(self._offsets)
+
+    def records(self, fileline):
+        """Get the (offset, length, index) records of the original rules
+        found at fileline, in order."""
+        records = []
+        i = self._last[fileline]
+        while i:
+            records.append((self._offsets[i - 1], self._lengths[i - 1],
+                            self._indexes[i - 1]))
+            i = self._previous[i - 1]
+        records.reverse()
+        return records
+
+    def __getitem__(self, key):
+        if self._data is None:
+            self.path = self._path
+        rules = []
+        for offset, length, index in self.records(key):
+            group = self._data[offset:offset + length].decode(u"utf-8")
+            rules.append(Mapper.split_group(group.splitlines())[index])
+        return rules
+
+    def __contains__(self, key):
+        return key in self._last
+
+    def __iter__(self):
+        return iter(self._last)
+
+    def __len__(self):
+        return len(self._last)
+
+
+class MappingFile(object):
+    """A mapping saved in a compact binary format, memory-mapped.
+
+    The file contains, after a header with the counts, little-endian 32 bit
+    integer arrays and a string blob, each 4-byte aligned:
+    - the offsets of the strings in the blob, plus the end offset;
+    - the UTF-8 encoded strings;
+    - the rules records (key, first mapped rule, number of mapped rules);
+    - the indices of the rules records, sorted by key;
+    - the mapped rules records (rule, original rule, fileline);
+    - the lines records (key, first original rule, number of rules);
+    - the indices of the lines records, sorted by key;
+    - the original rules of the lines.
+    Every string is stored once, and referenced by its index.
+    A truncated file is rejected when it is opened, as its size does not
+    match the counts in the header. The header also holds the CRC-32 of the
+    rest of the file, which is checked on request, since it reads the whole
+    file."""
+    magic = b"SELMAP\0\0"
+    version = 2
+    header = struct.Struct(u"<8s8I")
+    uint = struct.Struct(u"<I")
+    record = struct.Struct(u"<3I")
+    # Size of the chunks read from the file to compute its CRC-32
+    checksum_chunk = 1 << 20
+
+    def __init__(self, path, verify=False):
+        """Memory-map a mapping file.
+
+        If verify is True, also check the CRC-32 of the file."""
+        invalid = u"Invalid mapping file \"{}\"".format(path)
+        with open(path, u"rb") as mfile:
+            try:
+                self._mmap = mmap.mmap(mfile.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except ValueError:
+                # The file is empty
+                raise ValueError(invalid)
+        try:
+            fields = self.header.unpack_from(self._mmap, 0)
+        except struct.error:
+            fields = (None,)
+        if fields[0] != self.magic or fields[1] != self.version:
+            self._mmap.close()
+            raise ValueError(invalid)
+        (self.n_strings, blob_size, self.n_rules, self.n_mapped_rules,
+         self.n_lines, self.n_line_rules, checksum) = fields[2:]
+        # Compute the offsets of the arrays
+        self._strings = self.header.size
+        self._blob = self._strings + 4 * (self.n_strings + 1)
+        self._rules = self._blob + blob_size + (-blob_size % 4)
+        self._sorted_rules = self._rules + 12 * self.n_rules
+        self._mapped_rules = self._sorted_rules + 4 * self.n_rules
+        self._lines = self._mapped_rules + 12 * self.n_mapped_rules
+        self._sorted_lines = self._lines + 12 * self.n_lines
+        self._line_rules = self._sorted_lines + 4 * self.n_lines
+        if (self._line_rules + 4 * self.n_line_rules != len(self._mmap) or
+                (verify and self.__file_checksum() != checksum)):
+            self._mmap.close()
+            raise ValueError(invalid)
+
+    @staticmethod
+    def __checksum(data):
+        """Get the CRC-32 of some bytes, as an unsigned integer."""
+        return zlib.crc32(data) & 0xffffffff
+
+    def __file_checksum(self):
+        """Get the CRC-32 of the file after the header, as an unsigned
+        integer.
+
+        The file is read in chunks through a memoryview, without copying
+        it."""
+        view = memoryview(self._mmap)
+        try:
+            crc = 0
+            for start in range(self.header.size, len(view),
+                               self.checksum_chunk):
+                crc = zlib.crc32(view[start:start + self.checksum_chunk], crc)
+        finally:
+            # The memory map cannot be closed while it is exported
+            view.release()
+        return crc & 0xffffffff
+
+    def __string_bytes(self, i):
+        """Get the encoded string with the given index."""
+        start, end = struct.unpack_from(u"<2I", self._mmap,
+                                        self._strings + 4 * i)
+        return self._mmap[self._blob + start:self._blob + end]
+
+    def string(self, i):
+        """Get the string with the given index."""
+        return self.__string_bytes(i).decode(u"utf-8")
+
+    def __find(self, records, sorted_records, count, key):
+        """Binary search a key in a sorted array of records.
+
+        Return the record, or None if the key is not found."""
+        try:
+            key = key.encode(u"utf-8")
+        except AttributeError:
+            return None
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            index = self.uint.unpack_from(self._mmap,
+                                          sorted_records + 4 * middle)[0]
+            record = self.record.unpack_from(self._mmap, records + 12 * index)
+            found = self.__string_bytes(record[0])
+            if found == key:
+                return record
+            if found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def find_rule(self, key):
+        """Get the (key, first, count) record of a rule key, or None."""
+        return self.__find(self._rules, self._sorted_rules, self.n_rules, key)
+
+    def find_line(self, key):
+        """Get the (key, first, count) record of a fileline, or None."""
+        return self.__find(self._lines, self._sorted_lines, self.n_lines, key)
+
+    def rule_keys(self):
+        """Generate the rule keys, in order."""
+        for i in range(self.n_rules):
+            yield self.string(self.record.unpack_from(
+                self._mmap, self._rules + 12 * i)[0])
+
+    def line_keys(self):
+        """Generate the filelines, in order."""
+        for i in range(self.n_lines):
+            yield self.string(self.record.unpack_from(
+                self._mmap, self._lines + 12 * i)[0])
+
+    def mapped_rules(self, record):
+        """Get the MappedRules of a rule record."""
+        mapped_rules = []
+        for i in range(record[1], record[1] + record[2]):
+            rule, original_rule, fileline = self.record.unpack_from(
+                self._mmap, self._mapped_rules + 12 * i)
+            mapped_rules.append(MappedRule(self.string(rule),
+                                           self.string(original_rule),
+                                           self.string(fileline)))
+        return mapped_rules
+
+    def line_rules(self, record):
+        """Get the original rules of a line record."""
+        return [self.string(self.uint.unpack_from(
+            self._mmap, self._line_rules + 4 * i)[0])
+                for i in range(record[1], record[1] + record[2])]
+
+    @staticmethod
+    def write(path, rules, lines):
+        """Write the rules and lines dictionaries of a mapping to a file."""
+        symbols = SymbolTable()
+        get_id = symbols.get_id
+        # Build the records
+        rules_records = []
+        mapped_rules = []
+        for rutc, rls in iteritems(rules):
+            rules_records.append((get_id(rutc), len(mapped_rules), len(rls)))
+            for x in rls:
+                mapped_rules.append((get_id(x.rule), get_id(x.original_rule),
+                                     get_id(x.fileline)))
+        lines_records = []
+        line_rules = []
+        for fileline, original_rules in iteritems(lines):
+            lines_records.append((get_id(fileline), len(line_rules),
+                                  len(original_rules)))
+            line_rules.extend(get_id(x) for x in original_rules)
+        # Build the string blob
+        encoded = [symbols.get_symbol(i).encode(u"utf-8")
+                   for i in range(len(symbols))]
+        offsets = [0]
+        for x in encoded:
+            offsets.append(offsets[-1] + len(x))
+        blob = b"".join(encoded)
+        if len(blob) >= 2 ** 32:
+            raise ValueError(u"The mapping is too large to be saved")
+        blob += b"\0" * (-len(blob) % 4)
+        # Sort the records by key, comparing the encoded keys like a search
+        sorted_rules = sorted(range(len(rules_records)),
+                              key=lambda i: encoded[rules_records[i][0]])
+        sorted_lines = sorted(range(len(lines_records)),
+                              key=lambda i: encoded[lines_records[i][0]])
+        body = BytesIO()
+        body.write(MappingFile.__pack(offsets))
+        body.write(blob)
+        body.write(MappingFile.__pack(
+            [x for record in rules_records for x in record]))
+        body.write(MappingFile.__pack(sorted_rules))
+        body.write(MappingFile.__pack(
+            [x for record in mapped_rules for x in record]))
+        body.write(MappingFile.__pack(
+            [x for record in lines_records for x in record]))
+        body.write(MappingFile.__pack(sorted_lines))
+        body.write(MappingFile.__pack(line_rules))
+        body = body.getvalue()
+        with open(path, u"wb") as mfile:
+            mfile.write(MappingFile.header.pack(
+                MappingFile.magic, MappingFile.version, len(encoded),
+                offsets[-1], len(rules_records), len(mapped_rules),
+                len(lines_records), len(line_rules),
+                MappingFile.__checksum(body)))
+            mfile.write(body)
+
+    @staticmethod
+    def __pack(integers):
+        """Pack a list of integers as little-endian 32 bit integers."""
+        return struct.pack(u"<{}I".format(len(integers)), *integers)
+
+
+class StoredRules(collections_abc.Mapping):
+    """Rules dictionary read on demand from a MappingFile."""
+
+    def __init__(self, mapping_file):
+        self._file = mapping_file
+
+    def __getitem__(self, key):
+        record = self._file.find_rule(key)
+        if record is None:
+            raise KeyError(key)
+        return self._file.mapped_rules(record)
+
+    def __contains__(self, key):
+        return self._file.find_rule(key) is not None
+
+    def __iter__(self):
+        return self._file.rule_keys()
+
+    def __len__(self):
+        return self._file.n_rules
+
+
+class StoredLines(collections_abc.Mapping):
+    """Lines dictionary read on demand from a MappingFile."""
+
+    def __init__(self, mapping_file):
+        self._file = mapping_file
+
+    def __getitem__(self, key):
+        record = self._file.find_line(key)
+        if record is None:
+            raise KeyError(key)
+        return self._file.line_rules(record)
+
+    def __contains__(self, key):
+        return self._file.find_line(key) is not None
+
+    def __iter__(self):
+        return self._file.line_keys()
+
+    def __len__(self):
+        return self._file.n_lines
+
+
+class PermissionMasks(object):
+    """Per-class permission bitmasks.
+
+    Each permission of a class is assigned a bit, so that sets of permissions
+    on the same class can be represented as integers, and combined and
+    compared with bitwise operations."""
+
+    def __init__(self, classes):
+        """Initialize the bitmasks from a dictionary {class: set(perms)}."""
+        # Bit index of each permission, per class
+        self._bits = {}
+        # Permission name of each bit, per class
+        self._names = {}
+        # Bitmasks of the permission sets already seen
+        self._masks = {}
+        for tclass, perms in iteritems(classes):
+            for perm in sorted(perms):
+                self.__bit(tclass, perm)
+
+    def __bit(self, tclass, perm):
+        """Get the bit index of a permission in a class.
+
+        Permissions unknown to the class are assigned new bits, so that the
+        bitmasks behave exactly like the sets of names."""
+        bits = self._bits.setdefault(tclass, {})
+        if perm not in bits:
+            names = self._names.setdefault(tclass, [])
+            bits[perm] = len(names)
+            names.append(perm)
+        return bits[perm]
+
+    def mask(self, tclass, perms):
+        """Get the bitmask of a set of permissions on a class."""
+        key = (tclass, frozenset(perms))
+        if key not in self._masks:
+            mask = 0
+            for perm in key[1]:
+                mask |= 1 << self.__bit(tclass, perm)
+            self._masks[key] = mask
+        return self._masks[key]
+
+    def names(self, tclass, mask):
+        """Get the permission names in a bitmask, in bit order."""
+        names = self._names.get(tclass, [])
+        return [x for i, x in enumerate(names) if mask >> i & 1]
+
+    @staticmethod
+    def issubset(mask, other):
+        """Check if all the permissions in mask are also in other."""
+        return not mask & ~other
 
 
 class MappedRule(object):
     """A rule with associated origin file/line information."""
+    # There may be millions of these: do not give each one a __dict__
+    __slots__ = (u"rule", u"original_rule", u"fileline")
 
     def __init__(self, rule, original_rule, fileline):
         """Initialize a MappedRule.
@@ -92,6 +911,8 @@ class TERule(object):
     """A TE rule.
 
     Currently only supports type transitions and name transitions."""
+    __slots__ = (u"_str", u"_rtype", u"_source", u"_target", u"_tclass",
+                 u"_deftype", u"_objname")
 
     def __init__(self, blocks):
         """Initialise the rule from a list of blocks."""
@@ -127,7 +948,7 @@ class TERule(object):
         if len(blocks) == 6:
             objname = blocks[5].strip(u"\"\'")
             self._str += u" \"" + objname + u"\";"
-            self._objname = (index + 2, index + 2 + len(objname))
+            self._objname = (index + 1, index + 1 + len(objname))
         else:
             self._str += u";"
             self._objname = None
@@ -196,6 +1017,9 @@ class TERule(object):
 
 class AVRule(object):
     """An AV rule."""
+    __slots__ = (u"_rtype", u"_source", u"_target", u"_tclass", u"_perms",
+                 u"_permset", u"_permmask", u"_masks", u"_up_to_class",
+                 u"_str")
 
     def __init__(self, blocks):
         """Initialise the rule from a list of blocks.
@@ -226,6 +1050,9 @@ class AVRule(object):
         # Block 4 is the set of permissions
         self._perms = blocks[4]
         self._permset = frozenset(blocks[4].strip(u"{}").split())
+        # The permission bitmask, computed on first use
+        self._permmask = None
+        self._masks = None
 
     @property
     def rtype(self):
@@ -260,6 +1087,14 @@ class AVRule(object):
         """Get the rule permissions as a set."""
         return self._permset
 
+    def get_permmask(self, masks):
+        """Get the rule permissions as a bitmask, given a PermissionMasks
+        object."""
+        if masks is not self._masks:
+            self._permmask = masks.mask(self._tclass, self._permset)
+            self._masks = masks
+        return self._permmask
+
     @property
     def up_to_class(self):
         """Print a representation of the rule up to the class.
@@ -293,13 +1128,261 @@ class AVRule(object):
         return hash(str(self))
 
 
+class XpermSet(object):
+    """An immutable set of extended permissions (e.g. ioctl numbers).
+
+    The set is stored as a sorted tuple of disjoint, non-adjacent (first,
+    last) intervals, so that the set operations run in O(intervals)."""
+    __slots__ = (u"intervals",)
+    # Extended permissions are 16 bit values
+    maximum = 0xffff
+
+    def __init__(self, intervals=()):
+        """Initialize the set from any iterable of (first, last) intervals."""
+        merged = []
+        for first, last in sorted(intervals):
+            if first > last or first < 0 or last > self.maximum:
+                raise ValueError(u"Invalid extended permission range "
+                                 u"\"{}-{}\"".format(first, last))
+            if merged and first <= merged[-1][1] + 1:
+                if last > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], last)
+            else:
+                merged.append((first, last))
+        self.intervals = tuple(merged)
+
+    @staticmethod
+    def from_block(block):
+        """Parse an extended permission block, e.g. "0x8910",
+        "{ 0x8900-0x8906 0x8910 }" or "~{ 0x8910 }".
+
+        Raises ValueError if the block is invalid."""
+        intervals = []
+        for word in block.strip(u"~{}").split():
+            try:
+                if u"-" in word:
+                    first, last = word.split(u"-")
+                    intervals.append((int(first, 0), int(last, 0)))
+                else:
+                    intervals.append((int(word, 0), int(word, 0)))
+            except ValueError:
+                raise ValueError(
+                    u"Invalid extended permission \"{}\"".format(word))
+        xperms = XpermSet(intervals)
+        if block.startswith(u"~"):
+            return xperms.complement()
+        return xperms
+
+    def complement(self):
+        """Get the set of the extended permissions not in this set."""
+        intervals = []
+        start = 0
+        for first, last in self.intervals:
+            if first > start:
+                intervals.append((start, first - 1))
+            start = last + 1
+        if start <= self.maximum:
+            intervals.append((start, self.maximum))
+        return XpermSet(intervals)
+
+    def union(self, other):
+        """Get the union of two sets."""
+        return XpermSet(self.intervals + other.intervals)
+
+    def intersection(self, other):
+        """Get the intersection of two sets."""
+        intervals = []
+        i = j = 0
+        while i < len(self.intervals) and j < len(other.intervals):
+            first = max(self.intervals[i][0], other.intervals[j][0])
+            last = min(self.intervals[i][1], other.intervals[j][1])
+            if first <= last:
+                intervals.append((first, last))
+            # Advance the interval which ends first
+            if self.intervals[i][1] < other.intervals[j][1]:
+                i += 1
+            else:
+                j += 1
+        return XpermSet(intervals)
+
+    def difference(self, other):
+        """Get the extended permissions in this set but not in the other."""
+        return self.intersection(other.complement())
+
+    def overlaps(self, other):
+        """Check whether two sets have any extended permission in common."""
+        return bool(self.intersection(other))
+
+    def issubset(self, other):
+        """Check whether every extended permission of this set is also in the
+        other."""
+        return not self.difference(other)
+
+    def __contains__(self, value):
+        i = bisect.bisect_right(self.intervals, (value, self.maximum + 1))
+        return i > 0 and self.intervals[i - 1][1] >= value
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.intervals)
+
+    def __bool__(self):
+        return bool(self.intervals)
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        words = []
+        for first, last in self.intervals:
+            if first == last:
+                words.append(u"0x{:04x}".format(first))
+            else:
+                words.append(u"0x{:04x}-0x{:04x}".format(first, last))
+        if len(words) == 1:
+            return words[0]
+        return u"{ " + u" ".join(words) + u" }"
+
+    def __eq__(self, other):
+        return self.intervals == other.intervals
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.intervals)
+
+
+class XpermRule(object):
+    """An extended permission rule, e.g. an allowxperm rule."""
+    __slots__ = (u"_rtype", u"_source", u"_target", u"_tclass", u"_xtype",
+                 u"_xperms")
+
+    def __init__(self, blocks):
+        """Initialise the rule from a list of blocks.
+
+        e.g.: blocks =
+        ["allowxperm", "appdomain", "self", "udp_socket", "ioctl",
+         "{ 0x8900-0x8906 0x8910 }"]
+        """
+        if len(blocks) != 6:
+            # Invalid number of blocks
+            raise ValueError(
+                u"Invalid number of blocks ({})".format(len(blocks)))
+        if not all(blocks):
+            # If any of the blocks is empty or none
+            raise ValueError(u"Invalid block(s)")
+        self._rtype = blocks[0]
+        self._source = blocks[1]
+        self._target = blocks[2]
+        self._tclass = blocks[3]
+        # Block 4 is the extended permission type, e.g. "ioctl"
+        self._xtype = blocks[4]
+        # Block 5 is the set of extended permissions
+        self._xperms = XpermSet.from_block(blocks[5])
+
+    @property
+    def rtype(self):
+        """Get the rule type."""
+        return self._rtype
+
+    @property
+    def source(self):
+        """Get the rule source."""
+        return self._source
+
+    @property
+    def target(self):
+        """Get the rule target."""
+        return self._target
+
+    @property
+    def tclass(self):
+        """Get the rule class."""
+        return self._tclass
+
+    @property
+    def xtype(self):
+        """Get the extended permission type, e.g. "ioctl"."""
+        return self._xtype
+
+    @property
+    def xperms(self):
+        """Get the extended permissions as an XpermSet."""
+        return self._xperms
+
+    @property
+    def up_to_class(self):
+        """Print a representation of the rule up to the class.
+        e.g.:
+        "allowxperm appdomain self:udp_socket"
+        """
+        return u"{0.rtype} {0.source} {0.target}:{0.tclass}".format(self)
+
+    def __repr__(self):
+        return u"{0.up_to_class} {0.xtype} {0.xperms};".format(self)
+
+    def __eq__(self, other):
+        return self.up_to_class == other.up_to_class and\
+            self.xtype == other.xtype and self.xperms == other.xperms
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+class BlockCache(object):
+    """Bounded cache of rule block expansions, with hit/miss counters.
+
+    When the cache is full, the oldest expansions are dropped first."""
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._expansions = OrderedDict()
+
+    def get(self, key):
+        """Get a cached expansion, or None."""
+        options = self._expansions.get(key)
+        if options is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return options
+
+    def put(self, key, options):
+        """Cache an expansion."""
+        if len(self._expansions) >= self.size:
+            self._expansions.popitem(last=False)
+        self._expansions[key] = options
+
+
 class Mapper(object):
     """Class implementing the element to origin file/line mapper."""
     supported_rules = ONLY_MAP_RULES
+    # Maximum number of block expansions cached for each policy
+    block_cache_size = 65536
+    # Block expansion caches, shared by all Mappers working on the same
+    # policy tables: {(id(attributes), id(types), id(classes)):
+    # ((attributes, types, classes), BlockCache)}
+    # The tables are referenced to keep their ids valid
+    _block_caches = OrderedDict()
+    # Maximum number of policies whose caches are kept
+    block_caches_kept = 2
     # Valid characters to follow a complement sign ("~"), used when parsing a
     # rule into blocks. Tested the "char in complementable" approach to be
     # 15 times faster than the regex re.match(r'a-zA-Z{', char) approach.
     complementable = u"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ{"
+    # Characters which need the full rule parser: the complement sign, and
+    # whitespace other than spaces (i.e. the characters of str.isspace()).
+    # A single character class is much faster to search than r"[^\S ]|~".
+    regex_rule_unusual = re.compile(
+        u"[~\t\n\x0b\x0c\r\x1c-\x1f\x85\xa0\u1680\u2000-\u200a\u2028"
+        u"\u2029\u202f\u205f\u3000]")
+    # Split a rule at the curly brackets, keeping them
+    regex_rule_brackets = re.compile(r"([{}])")
+    regex_spaces = re.compile(r" +")
 
     def __init__(self, policy_conf, attributes, types, classes):
         # Check validity of the policy
@@ -312,30 +1395,196 @@ class Mapper(object):
         self.attributes = attributes
         self.types = types
         self.classes = classes
-
-    def get_mapping(self, map_neverallows=True):
+        # Share the block expansion cache with the other Mappers working on
+        # the same policy
+        key = (id(attributes), id(types), id(classes))
+        if key not in Mapper._block_caches:
+            Mapper._block_caches[key] = ((attributes, types, classes),
+                                         BlockCache(self.block_cache_size))
+            while len(Mapper._block_caches) > self.block_caches_kept:
+                Mapper._block_caches.popitem(last=False)
+        self.block_cache = Mapper._block_caches[key][1]
+        # The block expansions with their frozensets, for lazy rules
+        self._option_sets = {}
+
+    def get_mapping(self, map_neverallows=True, lines=None, workers=None,
+                    lazy=False):
         """Parse the policy and map every supported rule to its origin
         file/line.
 
+        The policy is read line by line from the policy.conf file, or from
+        any iterable of lines if supplied. When read from the policy.conf
+        file, the original rules of the mapping lines are read back from the
+        file on demand.
+        If more than one worker is requested, the policy.conf file is split
+        in per-file segments which are mapped by a pool of processes.
+        If lazy is True, the rules are not expanded in advance: they are
+        stored once in a LazyRules dictionary, which expands them on demand.
         Return a Mapping object."""
         # Map neverallows if required
         if not map_neverallows:
             self.supported_rules = tuple([
-                x for x in self.supported_rules if x != u"neverallow"])
-        # Initialise variables
+                x for x in self.supported_rules
+                if x not in (u"neverallow", u"neverallowxperm")])
+        if lines is None:
+            # Lazy rules are cheap to build, map them sequentially
+            if workers is not None and workers > 1 and not lazy:
+                mapping = self.__get_mapping_parallel(workers)
+                if mapping is not None:
+                    return mapping
+        mapping_rules = LazyRules() if lazy else {}
+        # Store each distinct rule, original rule and file/line string once.
+        # The table is only needed while mapping, the rules keep the strings
+        symbols = SymbolTable()
+        if lines is None:
+            # Stream the policy.conf file, indexing the original rules
+            # instead of storing them
+            mapping_lines = LineIndex(self.policy_conf)
+            with open(self.policy_conf, u"rb") as policy_conf:
+                self.__map_lines(policy_conf, mapping_rules, mapping_lines,
+                                 symbols, offset=0)
+        else:
+            mapping_lines = {}
+            self.__map_lines(lines, mapping_rules, mapping_lines, symbols)
+        self.log.debug(u"Block expansion cache: %d hits, %d misses",
+                       self.block_cache.hits, self.block_cache.misses)
+        # Generate the Mapping object
+        return Mapping(mapping_rules, mapping_lines)
+
+    def map_segment(self, start, end):
+        """Map the rules in a segment of the policy.conf file, given as a
+        range of byte offsets.
+
+        Return a tuple (symbols, rules, lines, complete), where "symbols" is
+        the list of strings found in the segment, in order of insertion, and
+        "rules" is the rules dictionary as a list of items, with every string
+        replaced by its index in "symbols", and "lines" is a list of
+        (fileline, records) items of the LineIndex.
+        "complete" is False if the segment ends in the middle of a rule."""
+        with open(self.policy_conf, u"rb") as policy_conf:
+            policy_conf.seek(start)
+            segment = policy_conf.read(end - start)
         mapping_rules = {}
-        mapping_lines = {}
+        mapping_lines = LineIndex(self.policy_conf)
+        symbols = SymbolTable()
+        complete = self.__map_lines(BytesIO(segment), mapping_rules,
+                                    mapping_lines, symbols, offset=start)
+        # Integers are much cheaper than strings and objects to send back
+        get_id = symbols.get_id
+        rules = [(get_id(rule), [(get_id(x.rule), get_id(x.original_rule),
+                                  get_id(x.fileline)) for x in mapped_rules])
+                 for rule, mapped_rules in iteritems(mapping_rules)]
+        lines = [(get_id(fileline), mapping_lines.records(fileline))
+                 for fileline in mapping_lines]
+        return (symbols.symbols(), rules, lines, complete)
+
+    def __find_segments(self):
+        """Split the policy.conf file in per-file segments, at the new file
+        synclines.
+
+        Return a list of (start, end) byte offsets."""
+        boundaries = [0]
+        offset = 0
+        previous_line_is_syncline = False
+        with open(self.policy_conf, u"rb") as policy_conf:
+            for line in policy_conf:
+                # Recognize synclines the same way __map_lines does
+                if previous_line_is_syncline:
+                    previous_line_is_syncline = False
+                elif line.startswith(b'#line '):
+                    if line.startswith(b'#line 1 "') and offset:
+                        boundaries.append(offset)
+                    previous_line_is_syncline = True
+                offset += len(line)
+        boundaries.append(offset)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def __get_mapping_parallel(self, workers):
+        """Map the policy.conf file segments in a pool of processes, and
+        merge the partial mappings in file order.
+
+        The workers are forked, inheriting this Mapper and its policy tables.
+        Return a Mapping object, or None if the policy must be mapped
+        sequentially instead."""
+        # pylint: disable=global-statement
+        global _SEGMENT_MAPPER
+        try:
+            context = multiprocessing.get_context(u"fork")
+        except AttributeError:
+            # Python 2 always forks on POSIX systems
+            context = multiprocessing
+        except ValueError:
+            self.log.warning(u"Cannot fork worker processes, mapping the "
+                             u"policy sequentially...")
+            return None
+        segments = self.__find_segments()
+        mapping_rules = {}
+        mapping_lines = LineIndex(self.policy_conf)
+        symbols = SymbolTable()
+        # Hand out segments in chunks, to balance the load without paying
+        # the communication cost for every small file
+        chunksize = max(1, len(segments) // (workers * 4))
+        _SEGMENT_MAPPER = self
+        pool = context.Pool(workers)
+        try:
+            results = pool.imap(_map_segment, segments, chunksize)
+            for i, (strings, rules, lines, complete) in enumerate(results):
+                # A rule spanning two segments cannot be mapped separately
+                if not complete and i < len(segments) - 1:
+                    self.log.warning(u"Policy rule spans more than one file, "
+                                     u"mapping the policy sequentially...")
+                    return None
+                # Interning the segment strings in file order assigns the
+                # same ids a sequential run would
+                strings = [symbols.intern(x) for x in strings]
+                for fileline, records in lines:
+                    fileline = strings[fileline]
+                    for record in records:
+                        mapping_lines.add(fileline, *record)
+                for rule, mapped_rules in rules:
+                    rule = strings[rule]
+                    mapped_rules = [MappedRule(strings[x], strings[y],
+                                               strings[z])
+                                    for x, y, z in mapped_rules]
+                    if rule in mapping_rules:
+                        mapping_rules[rule].extend(mapped_rules)
+                    else:
+                        mapping_rules[rule] = mapped_rules
+        finally:
+            pool.terminate()
+            pool.join()
+            _SEGMENT_MAPPER = None
+        self.log.debug(u"Mapped %d policy segments with %d processes",
+                       len(segments), workers)
+        return Mapping(mapping_rules, mapping_lines)
+
+    def __map_lines(self, lines, mapping_rules, mapping_lines, symbols,
+                    offset=None):
+        """Map the rules found in the given lines, adding them to the
+        dictionaries supplied. The rules are added unexpanded if
+        mapping_rules is a LazyRules dictionary.
+
+        If an offset is supplied, the lines are UTF-8 encoded lines of the
+        policy.conf file starting at that byte offset, and mapping_lines is
+        a LineIndex.
+        Return False if the lines end in the middle of a rule."""
+        lazy = isinstance(mapping_rules, LazyRules)
+        # Initialise variables
         group = []
+        # The byte offset where the current group starts
+        group_start = offset
         current_file = u""
         current_line = 0
         previous_line_is_syncline = False
         new_file_syncline = re.compile(r'#line 1 "([^"]+)"')
         new_line_syncline = re.compile(r'#line ([0-9]+)')
-        # Read policy.conf file
-        with open(self.policy_conf, encoding=u'utf-8') as policy_conf:
-            file_content = policy_conf.read().splitlines()
-        # Process each line in the policy.conf file
-        for line in file_content:
+        # Process each line in the policy
+        for line in lines:
+            # Keep track of the byte offset of the line
+            if offset is not None:
+                line_start = offset
+                offset += len(line)
+                line = line.decode(u"utf-8")
             # If the previous line was not a syncline, this may be a
             # regular non-macro line or a syncline itself
             if not previous_line_is_syncline:
@@ -374,53 +1623,95 @@ class Mapper(object):
             if u"#" in line:
                 line = line.split(u"#")[0].strip()
             # Append the current line to the group
+            if not group:
+                group_start = line_start if offset is not None else None
             group.append(line)
             # If we have not found the end of the rule yet, read next line
             if not line.endswith(u';'):
                 continue
             # We have found the end of the rule, process it
-            # Join the group as a string
-            l = u" ".join(group)
-            # There may be more than one rule in the group: if so, split them
-            # and process them individually
-            if l.count(u";") > 1:
-                # More than one rule
-                rules = []
-                for x in l.split(u";"):
-                    if x:
-                        # Normalise spaces
-                        rules.append(u" ".join(x.split()) + u";")
-            else:
-                # Normalise spaces
-                rules = [u" ".join(l.split())]
+            rules = Mapper.split_rules(group)
             # Expand the rules
-            for y in rules:
+            for i, y in enumerate(rules):
                 try:
-                    exp_rules = self.expand_rule(y)
+                    if lazy:
+                        exp_rules = self.expand_rule_lazily(y)
+                    else:
+                        exp_rules = self.expand_rule(y)
                 except ValueError as e:
                     self.log.warning(e)
                     self.log.warning(u"Could not expand rule \"%s\" at %s:%s",
                                      y, current_file, current_line)
                 else:
-                    tmp = current_file + u":" + str(current_line)
+                    tmp = symbols.intern(current_file + u":" +
+                                         str(current_line))
+                    y = symbols.intern(y)
                     # Save the original rule found at file:line
                     # There could be more than one rule at file:line:
                     # save them all in the order they are found
-                    if tmp in mapping_lines:
+                    if offset is not None:
+                        # Only save where the rule is in the policy.conf
+                        mapping_lines.add(tmp, group_start,
+                                          offset - group_start, i)
+                    elif tmp in mapping_lines:
                         mapping_lines[tmp].append(y)
                     else:
                         mapping_lines[tmp] = [y]
+                    if lazy:
+                        # Store the rule once, unexpanded
+                        exp_rules.original_rule = y
+                        exp_rules.fileline = tmp
+                        mapping_rules.add(exp_rules)
+                        continue
                     for rule in exp_rules:
                         # Record the file/line mapping for each rule
-                        mpr = MappedRule(exp_rules[rule], y, tmp)
+                        mpr = MappedRule(symbols.intern(exp_rules[rule]), y,
+                                         tmp)
                         if rule not in mapping_rules:
-                            mapping_rules[rule] = [mpr]
+                            mapping_rules[symbols.intern(rule)] = [mpr]
                         else:
                             mapping_rules[rule].append(mpr)
             # Empty the group
             del group[:]
-        # Generate the Mapping object
-        return Mapping(mapping_rules, mapping_lines)
+        return not group
+
+    @staticmethod
+    def split_rules(group):
+        """Split a group of policy lines ending with a semicolon into rules,
+        normalising the spaces.
+
+        Return a list of rules."""
+        # Join the group as a string
+        l = u" ".join(group)
+        # There may be more than one rule in the group: if so, split them
+        # and process them individually
+        if l.count(u";") > 1:
+            # More than one rule
+            rules = []
+            for x in l.split(u";"):
+                if x:
+                    # Normalise spaces
+                    rules.append(u" ".join(x.split()) + u";")
+        else:
+            # Normalise spaces
+            rules = [u" ".join(l.split())]
+        return rules
+
+    @staticmethod
+    def split_group(lines):
+        """Split the policy.conf lines of a group into rules, skipping blank
+        lines, synclines and comments like get_mapping does.
+
+        Return a list of rules."""
+        group = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(u"#"):
+                continue
+            if u"#" in line:
+                line = line.split(u"#")[0].strip()
+            group.append(line)
+        return Mapper.split_rules(group)
 
     @staticmethod
     def rule_factory(string):
@@ -435,6 +1726,8 @@ class Mapper(object):
                 rule = AVRule(blocks)
             elif blocks[0] in TERULES:
                 rule = TERule(blocks)
+            elif blocks[0] in XPERMRULES:
+                rule = XpermRule(blocks)
             else:
                 raise ValueError(u"Unsupported rule")
         else:
@@ -484,12 +1777,71 @@ class Mapper(object):
                 rules = self.__expand_avrule(blocks)
             elif blocks[0] in TERULES:
                 rules = self.__expand_terule(blocks)
+            elif blocks[0] in XPERMRULES:
+                rules = self.__expand_xpermrule(blocks)
             else:
                 raise ValueError(u"Unsupported rule")
         else:
             raise ValueError(u"Unsupported rule")
         return rules
 
+    def expand_rule_lazily(self, rule):
+        """Interpret the attributes, sets, complement sets and complement
+        types of the given rule, without multiplying it out.
+
+        Return a LazyRule without origin information."""
+        if not rule.startswith(Mapper.supported_rules):
+            raise ValueError(u"Unsupported rule")
+        blocks = Mapper.get_rule_blocks(rule)
+        # The first block contains the rule type, e.g. "allow"
+        if blocks[0] in AVRULES:
+            if len(blocks) != 5:
+                raise ValueError(u"Invalid rule")
+            tails = OrderedDict()
+            for cls in self.expand_block(blocks[3], u"class"):
+                perms = self.expand_block(blocks[4], u"perms", for_class=cls)
+                if len(perms) > 1:
+                    tails[cls] = u" { " + u" ".join(perms) + u" };"
+                else:
+                    tails[cls] = u" " + perms[0] + u";"
+        elif blocks[0] in TERULES:
+            if len(blocks) == 6:
+                # It's a name transition
+                add = u" " + blocks[4] + u" " + blocks[5] + u";"
+            elif len(blocks) == 5:
+                # It's a simple type transition
+                add = u" " + blocks[4] + u";"
+            else:
+                raise ValueError(u"Invalid rule")
+            tails = OrderedDict(
+                (cls, add) for cls in self.expand_block(blocks[3], u"class"))
+        elif blocks[0] in XPERMRULES:
+            if len(blocks) != 6:
+                raise ValueError(u"Invalid rule")
+            add = u" " + blocks[4] + u" " + str(
+                self.expand_xperms(blocks[5])) + u";"
+            tails = OrderedDict(
+                (cls, add) for cls in self.expand_block(blocks[3], u"class"))
+        else:
+            raise ValueError(u"Unsupported rule")
+        subjects = self.__option_set(self.expand_block(blocks[1], u"type"))
+        objects = self.expand_block(blocks[2], u"type")
+        # Like the expanded AV rules, a "self" object replaces all objects
+        if blocks[0] not in TERULES and u"self" in objects:
+            objects = None
+        else:
+            objects = self.__option_set(objects)
+        return LazyRule(blocks[0], subjects, objects, tails)
+
+    def __option_set(self, options):
+        """Get a block expansion as a (tuple, frozenset) pair, shared by all
+        the rules with the same expansion."""
+        option_set = self._option_sets.get(options)
+        if option_set is None:
+            option_set = (options, frozenset(options))
+            self._option_sets[options] = option_set
+        return option_set
+
     def __expand_avrule(self, blocks):
         """Expand an AV rule given as a list of blocks.
 
@@ -576,6 +1928,45 @@ class Mapper(object):
                     rules[base] = base + u" " + add
         return rules
 
+    def __expand_xpermrule(self, blocks):
+        """Expand an extended permission rule given as a list of blocks.
+
+        The extended permissions are not multiplied out: each rule keeps
+        them as a canonical interval set, e.g. "{ 0x8900-0x8906 0x8910 }".
+
+        Return a dictionary of rules {base: full} where "base" is the rule
+        as "ruletype subject object:class" and "full" is the full string
+        representation."""
+        if len(blocks) != 6:
+            raise ValueError(u"Invalid rule")
+        # The rule type is block 0 and is static across expansions
+        rtype = blocks[0]
+        subjects = self.expand_block(blocks[1], u"type")
+        objects = self.expand_block(blocks[2], u"type")
+        classes = self.expand_block(blocks[3], u"class")
+        # The extended permission type (e.g. "ioctl") and set are static too
+        add = u" " + blocks[4] + u" " + str(self.expand_xperms(blocks[5])) +\
+            u";"
+        rules = {}
+        for cls in classes:
+            for sub in subjects:
+                # As in AV rules, a "self" object replaces all the objects
+                for obj in ((sub,) if u"self" in objects else objects):
+                    base = rtype + u" " + sub + u" " + obj + u":" + cls
+                    rules[base] = base + add
+        return rules
+
+    def expand_xperms(self, block):
+        """Parse an extended permission block into an XpermSet.
+
+        The parsed sets are cached like the other block expansions."""
+        key = (block, u"xperms", None)
+        xperms = self.block_cache.get(key)
+        if xperms is None:
+            xperms = XpermSet.from_block(block)
+            self.block_cache.put(key, xperms)
+        return xperms
+
     def expand_block(self, block, role, for_class=None):
         """Expand a rule block given its semantic role.
 
@@ -583,11 +1974,16 @@ class Mapper(object):
         inside sets, type/attribute complement (~), complementary sets
         (~{...}) and wildcard (*).
 
-        Valid roles are "type", "class", "perms"."""
+        Valid roles are "type", "class", "perms".
+        Return the alternatives for the block as a sorted tuple."""
         if role not in (u"type", u"class", u"perms"):
             raise ValueError(u"Bad block role \"{}\"".format(role))
-        # The list of alternatives for the block
-        options = None
+        # The expansions are cached, since the same blocks (e.g. "domain")
+        # recur in many rules
+        key = (block, role, for_class)
+        options = self.block_cache.get(key)
+        if options is not None:
+            return options
         # Identify and parse the block
         if block.startswith(u"{"):
             ############## Complex block ################
@@ -610,7 +2006,7 @@ class Mapper(object):
                     # Handle every role (including attributes)
                     add.add(word)
             # Return all items minus the ones that were subtracted
-            options = sorted(add.difference(remove))
+            options = tuple(sorted(add.difference(remove)))
             ##############################################
         elif block.startswith(u"~") or block == u"*":
             ####### Complement or catch-all block ########
@@ -627,18 +2023,19 @@ class Mapper(object):
             # Remove the complemented values
             remove = set(block.strip(u"~{}").split())
             # Return all values minus the ones that were complemented
-            options = sorted(add.difference(remove))
+            options = tuple(sorted(add.difference(remove)))
             ##############################################
         else:
             ################ Simple block ################
             # e.g. "attr1", "type1"
             if role == u"type" and block in self.attributes:
                 # Handle attributes
-                options = sorted(self.attributes[block].union([block]))
+                options = tuple(sorted(self.attributes[block].union([block])))
             else:
                 # Return the simple block
-                options = [block]
+                options = (block,)
             ##############################################
+        self.block_cache.put(key, options)
         return options
 
     @staticmethod
@@ -651,12 +2048,55 @@ class Mapper(object):
         Raises ValueError if the rule is somehow malformed."""
         if rule.count(u"{") != rule.count(u"}"):
             raise ValueError(u"Mismatched separators in \"{}\"".format(rule))
+        # Split the rule in rule_type and rest of the rule
+        rule_type, rule_early_split = rule.split(u" ", 1)
+        # Ignore the final semicolon and the colon between blocks
+        # (e.g. "obj:cls")
+        rule_early_split = rule_early_split.rstrip(u';').replace(u":", u" ")
+        # Most rules have no complements and no whitespace other than
+        # spaces: split them at the curly brackets, instead of character by
+        # character.
+        if not Mapper.regex_rule_unusual.search(rule_early_split):
+            if u"{" not in rule_early_split:
+                # Without sets, spaces are the only separators
+                return [rule_type] + rule_early_split.split()
+            blocks = [rule_type]
+            nest_lvl = 0
+            for part in Mapper.regex_rule_brackets.split(rule_early_split):
+                if part == u"{":
+                    if not nest_lvl:
+                        block = u"{"
+                    nest_lvl += 1
+                elif part == u"}":
+                    nest_lvl -= 1
+                    if nest_lvl < 0:
+                        # Unmatched closing bracket: let the full parser
+                        # report it
+                        break
+                    if not nest_lvl:
+                        # Normalize whitespace inside sets
+                        blocks.append(
+                            Mapper.regex_spaces.sub(u" ", block + u"}"))
+                elif nest_lvl:
+                    # Drop the nested brackets, simplifying the block to a
+                    # single level of brackets
+                    block += part
+                else:
+                    blocks.extend(part.split())
+            else:
+                return blocks
+        return Mapper.__parse_rule_blocks(rule, rule_type, rule_early_split)
+
+    @staticmethod
+    def __parse_rule_blocks(rule, rule_type, rule_early_split):
+        """Split the rest of a rule in blocks character by character,
+        handling complements and nested sets.
+
+        Raises ValueError if the rule is somehow malformed."""
         # The level of curly bracket nesting
         nest_lvl = 0
         # The current block
         block = u""
-        # Split the rule in rule_type and rest of the rule
-        rule_type, rule_early_split = rule.split(u" ", 1)
         # Initialise the list of blocks with the rule type
         blocks = [rule_type]
         # Flag to indicate that a new block must be complemented
@@ -666,9 +2106,8 @@ class Mapper(object):
         # the start of a new block and a valid complementable character,
         # (i.e. "a-zA-Z{"), the new block is complemented.
         complement_next_block = False
-        # Parse the rest of the rule character by character, ignoring the
-        # final semicolon and the colon between blocks (e.g. "obj:cls")
-        for char in rule_early_split.rstrip(u';').replace(u":", u" "):
+        # Parse the rest of the rule character by character
+        for char in rule_early_split:
             # If the previous character was the complement character,
             # but the current one is not the start of a complementable block
             if complement_next_block and char not in Mapper.complementable:
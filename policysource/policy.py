@@ -24,15 +24,26 @@
 from __future__ import absolute_import
 from builtins import range
 from io import open
+from future.utils import iteritems, itervalues
 
-from tempfile import mkdtemp
+from tempfile import mkdtemp, mkstemp
 import subprocess
 import os.path
 import re
 import logging
+import hashlib
+import pickle
+import shutil
+import copy
+import time
+import functools
+import multiprocessing
+import concurrent.futures
 import setools
 import setools.policyrep
 from policysource.macro import MacroInPolicy, M4MacroError
+from policysource.macro import M4MacroExpander
+from policysource.macro import M4FreezeFile, M4FreezeFileError
 import policysource.mapping
 import policysource.macro_plugins
 
@@ -42,20 +53,57 @@ class SourcePolicy(object):
     # pylint: disable=too-many-instance-attributes
     regex_macrodef = re.compile(r'^define\(\`([^\']+)\',')
     regex_usageargstring = r'(\(.*\));?'
-
-    def __init__(self, policyfiles, extra_defs, load_neverallows=False):
+    # m4 builtins which change the m4 state, preventing a file from being
+    # expanded on its own
+    regex_m4_state = re.compile(
+        r'\b(define|undefine|pushdef|popdef|changequote|changecom|divert|'
+        r'undivert|m4wrap|include|sinclude)\(')
+    # A syncline of the m4 output, with or without the file name
+    regex_syncline = re.compile(br'#line ([0-9]+)( "[^"]*")?\n')
+    # Version of the cache format, to be increased whenever the cached
+    # objects change
+    cache_version = 8
+    # Number of parsed policies to keep in the cache, the least recently
+    # used ones are removed. The per-file m4 outputs of --parallelm4 are
+    # kept for as many runs.
+    cache_entries = 4
+    # Regex matching the name of a cache entry
+    regex_cache_key = re.compile(r"^[0-9a-f]{64}$")
+
+    def __init__(self, policyfiles, extra_defs, load_neverallows=False,
+                 cache_dir=None, parallel_m4=False, mapping_jobs=None,
+                 lazy_mapping=False):
         """Construct a SourcePolicy object by parsing the supplied files.
 
         Keyword arguments:
-        policyfiles --  The policy files as a list of absolute paths."""
+        policyfiles  -- The policy files as a list of absolute paths.
+        cache_dir    -- A directory where to cache the parsed policy, keyed
+                        by the content of the policy files and the options.
+        parallel_m4  -- Expand each policy file with a separate m4 process,
+                        in parallel, when creating the policy.conf.
+        mapping_jobs -- The number of processes mapping the policy rules to
+                        their origin file/line.
+        lazy_mapping -- Store the rules unexpanded in the mapping, and
+                        expand them on demand."""
         # Setup logging
         self.log = logging.getLogger(self.__class__.__name__)
         # Setup useful infrastructure
         self._policyconf = None
         # Set up a general-purpose macro expander for internal use
         self._expander = None
+        # The SELinuxPolicy, loaded on demand
+        self._policy = None
+        # The permission bitmasks, computed on demand
+        self._permission_masks = None
+        # The macro definitions by defining file, computed on demand
+        self._macros_by_file = None
+        # The policy this object is a view of, if any
+        self._parent = None
         # Set the extra M4 defs ("-D target_build_variant=user", ...)
         self.extra_defs = extra_defs
+        # Set the cache directory and the m4 mode
+        self._cache_dir = cache_dir
+        self._parallel_m4 = parallel_m4
         # Create a temporary work directory
         self._tmpdir = mkdtemp()
         self.log.debug(u"Created temporary directory \"%s\".", self._tmpdir)
@@ -65,21 +113,34 @@ class SourcePolicy(object):
         if not self._policy_files:
             raise RuntimeError(
                 u"Could not find any policy files to parse, aborting...")
-        # Parse the macros and macro usages in the policy
-        self._macro_defs = self.__find_macro_defs__(self._policy_files)
+        # Load the parsed policy from the cache, if available
+        if cache_dir:
+            cache_key = self.__cache_key__(load_neverallows, lazy_mapping)
+            if self.__load_cache__(cache_dir, cache_key):
+                return
+        # Parse the macros and macro usages in the policy, and create the
+        # policyconf at the same time
+        results = self.__run_pipeline__([
+            (u"macro_defs", functools.partial(
+                self.__find_macro_defs__, self._policy_files), []),
+            (u"macro_usages", functools.partial(
+                self.__find_macro_usages__, self._policy_files),
+             [u"macro_defs"]),
+            # Expand all macro usages in advance, with a single m4 run
+            (u"prefetch", self.__prefetch_macro_expansions__,
+             [u"macro_usages"]),
+            (u"policyconf", functools.partial(
+                self.__create_policyconf__, self._policy_files), [])])
+        self._macro_defs = results[u"macro_defs"]
+        self._macro_usages = results[u"macro_usages"]
+        self._policyconf = results[u"policyconf"]
         if self._macro_defs is None:
             raise RuntimeError(u"Error parsing macro definitions, aborting...")
-        self._macro_usages = self.__find_macro_usages__(self._policy_files,
-                                                        self._macro_defs)
         if self._macro_usages is None:
             raise RuntimeError(u"Error parsing macro usages, aborting...")
-        # Create the policyconf
-        self._policyconf = self.__create_policyconf__(self._policy_files)
         if not self._policyconf:
             raise RuntimeError(
                 u"Could not create the policy.conf file, aborting...")
-        # Create the actual policy instance
-        self._policy = setools.policyrep.SELinuxPolicy(self.policyconf)
         # Initialise some useful variables
         self._attributes = self.__compute_attributes()
         self._types = self.__compute_types()
@@ -87,16 +148,25 @@ class SourcePolicy(object):
         # Build the origin file/line mapping
         mapper = policysource.mapping.Mapper(self.policyconf, self.attributes,
                                              self.types, self.classes)
-        self._mapping = mapper.get_mapping(load_neverallows)
+        self._mapping = mapper.get_mapping(load_neverallows,
+                                           workers=mapping_jobs,
+                                           lazy=lazy_mapping)
         if not self._mapping:
             raise RuntimeError(
                 u"Error creating the file/line mapping, aborting...")
+        # Save the parsed policy in the cache
+        if cache_dir:
+            self.__save_cache__(cache_dir, cache_key)
 
     def __del__(self):
+        # Views do not own any resource
+        if self._parent is not None:
+            return
         # Remove the macro usages and definitions to remove the associated
         # temporary files
         del self._macro_usages
         del self._macro_defs
+        del self._macros_by_file
         # Delete the policy.conf file
         if self.policyconf:
             try:
@@ -118,9 +188,194 @@ class SourcePolicy(object):
                 self.log.debug(u"Trying to remove the temporary directory "
                                u"\"%s\"... done!", self._tmpdir)
 
+    def __run_pipeline__(self, stages):
+        """Run the construction stages concurrently, each as soon as the
+        stages it depends on are done.
+
+        The stages are a list of tuples (name, function, [dependencies]),
+        where the dependencies are names of previous stages. Each function is
+        called with the results of its dependencies.
+        Return a dictionary {name: result}."""
+        futures = {}
+        with concurrent.futures.ThreadPoolExecutor(len(stages)) as executor:
+            for name, function, dependencies in stages:
+                futures[name] = executor.submit(
+                    self.__run_stage__, name, function,
+                    [futures[x] for x in dependencies])
+        return dict((name, f.result()) for name, f in iteritems(futures))
+
+    def __run_stage__(self, name, function, dependencies):
+        """Run a construction stage once its dependencies are done."""
+        args = [x.result() for x in dependencies]
+        start = time.time()
+        if None in args:
+            # A dependency failed, fail as well
+            result = None
+        else:
+            result = function(*args)
+        self.log.info(u"Stage \"%s\" took %.2fs", name, time.time() - start)
+        return result
+
+    def without_neverallows(self):
+        """Get a view of this policy whose mapping hides the neverallow
+        rules, as if it had been constructed with load_neverallows=False.
+
+        The view shares all its data with this policy."""
+        view = copy.copy(self)
+        view._parent = self
+        view._mapping = self._mapping.without([u"neverallow",
+                                               u"neverallowxperm"])
+        return view
+
+    def __cache_key__(self, load_neverallows, lazy_mapping):
+        """Compute the cache key for the policy, as a hash of the policy file
+        names and contents, the extra M4 defs and the mapping flags."""
+        digest = hashlib.sha256()
+        digest.update(u"{}\0{}\0{}\0".format(
+            self.cache_version, load_neverallows,
+            lazy_mapping).encode("utf-8"))
+        for definition in self.extra_defs:
+            digest.update(u"D{}\0".format(definition).encode("utf-8"))
+        for policy_file in self._policy_files:
+            with open(policy_file, u"rb") as pfile:
+                content = pfile.read()
+            digest.update(u"F{}\0{}\0".format(
+                policy_file, len(content)).encode("utf-8"))
+            digest.update(content)
+        return digest.hexdigest()
+
+    def __load_cache__(self, cache_dir, cache_key):
+        """Load the parsed policy from the cache.
+
+        Return True if the policy was found in the cache, False otherwise."""
+        cached = os.path.join(cache_dir, cache_key)
+        if not os.path.isdir(cached):
+            self.log.debug(u"Policy not found in cache \"%s\"", cached)
+            return False
+
+        def persistent_load(pid):
+            """Recreate the macro expander referenced by the macros."""
+            if pid != u"expander":
+                raise pickle.UnpicklingError(u"Unknown object " + pid)
+            if self._expander is None:
+                self._expander = M4MacroExpander(
+                    self.__find_macro_files__(self._policy_files), None,
+                    self.extra_defs)
+            return self._expander
+        try:
+            with open(os.path.join(cached, u"policy.pickle"), u"rb") as cfile:
+                unpickler = pickle.Unpickler(cfile)
+                unpickler.persistent_load = persistent_load
+                state = unpickler.load()
+            fields = (state[u"macro_defs"], state[u"macro_usages"],
+                      state[u"attributes"], state[u"types"],
+                      state[u"classes"], state[u"mapping"])
+            policyconf = os.path.join(self._tmpdir, u"policy.conf")
+            shutil.copyfile(os.path.join(cached, u"policy.conf"), policyconf)
+        # A corrupt or outdated pickle can raise almost anything: just parse
+        # the policy again
+        except Exception as e:  # pylint: disable=broad-except
+            self.log.warning(u"%s", e)
+            self.log.warning(u"Could not load policy from cache \"%s\"",
+                             cached)
+            # Remove the entry, so that it is saved again
+            shutil.rmtree(cached, ignore_errors=True)
+            return False
+        self._policyconf = policyconf
+        (self._macro_defs, self._macro_usages, self._attributes, self._types,
+         self._classes, self._mapping) = fields
+        # The mapping reads the original rules from the copied policy.conf
+        if isinstance(self._mapping.lines, policysource.mapping.LineIndex):
+            self._mapping.lines.path = policyconf
+        # The macro expander is needed anyway for internal use
+        if self._expander is None:
+            persistent_load(u"expander")
+        # Mark the entry as recently used
+        self.__touch_cache_entry__(cached)
+        self.log.info(u"Loaded policy from cache \"%s\"", cached)
+        return True
+
+    def __save_cache__(self, cache_dir, cache_key):
+        """Save the parsed policy in the cache."""
+        cached = os.path.join(cache_dir, cache_key)
+        state = {u"macro_defs": self._macro_defs,
+                 u"macro_usages": self._macro_usages,
+                 u"attributes": self._attributes,
+                 u"types": self._types,
+                 u"classes": self._classes,
+                 u"mapping": self._mapping}
+
+        def persistent_id(obj):
+            """Do not save the macro expander, recreate it on load."""
+            if isinstance(obj, M4MacroExpander):
+                return u"expander"
+            return None
+        tmp_cached = None
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # Fill a temporary directory, and then move it in place, so that
+            # concurrent runs never see a partial cache entry
+            tmp_cached = mkdtemp(dir=cache_dir)
+            with open(os.path.join(tmp_cached, u"policy.pickle"),
+                      u"wb") as cfile:
+                pickler = pickle.Pickler(cfile, pickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = persistent_id
+                pickler.dump(state)
+            shutil.copyfile(self.policyconf,
+                            os.path.join(tmp_cached, u"policy.conf"))
+            os.rename(tmp_cached, cached)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            self.log.warning(u"%s", e)
+            self.log.warning(u"Could not save policy to cache \"%s\"",
+                             cached)
+            if tmp_cached:
+                shutil.rmtree(tmp_cached, ignore_errors=True)
+        else:
+            self.log.info(u"Saved policy to cache \"%s\"", cached)
+        self.__prune_cache__(cache_dir, self.cache_entries)
+
+    @staticmethod
+    def __touch_cache_entry__(path):
+        """Update the modification time of a cache entry, which the cache
+        pruning uses as the time of last use."""
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def __prune_cache__(self, cache_dir, keep):
+        """Remove all but the most recently used entries of a cache
+        directory.
+
+        The entries are named after their key, a SHA-256 hex digest: other
+        files, e.g. the temporary files of an entry being written, are left
+        alone."""
+        try:
+            entries = [os.path.join(cache_dir, x)
+                       for x in os.listdir(cache_dir)
+                       if self.regex_cache_key.match(x)]
+            entries.sort(key=os.path.getmtime, reverse=True)
+        except OSError as e:
+            self.log.warning(u"%s", e)
+            return
+        for entry in entries[keep:]:
+            self.log.debug(u"Removing old cache entry \"%s\"", entry)
+            try:
+                if os.path.isdir(entry):
+                    shutil.rmtree(entry)
+                else:
+                    os.remove(entry)
+            except OSError as e:
+                self.log.warning(u"%s", e)
+
     def __create_policyconf__(self, policy_files):
         """Process the separate policy files with m4 and return a single
         policy.conf file"""
+        if self._parallel_m4:
+            policyconf = self.__create_policyconf_parallel__(policy_files)
+            if policyconf:
+                return policyconf
         # Prepare the output file
         policyconf = os.path.join(self._tmpdir, u"policy.conf")
         # Prepare the m4 command line
@@ -140,6 +395,135 @@ class SourcePolicy(object):
             policyconf = None
         return policyconf
 
+    def __create_policyconf_parallel__(self, policy_files):
+        """Process each policy file with a separate m4 process, in parallel,
+        and concatenate the outputs in a single policy.conf file.
+
+        Each file is expanded against a freeze file of the macro files
+        preceding it, which gives the same output as a single m4 run.
+        If a cache directory is set, the output of each file is cached by
+        content. Return None if the files cannot be expanded separately."""
+        macro_files = self.__find_macro_files__(policy_files)
+        # Hash the content of each file
+        digests = {}
+        for policy_file in policy_files:
+            with open(policy_file, u"rb") as pfile:
+                content = pfile.read()
+            if policy_file not in macro_files and\
+                    self.regex_m4_state.search(content.decode("utf-8")):
+                self.log.info(u"\"%s\" changes the m4 state, cannot expand "
+                              u"the policy files separately", policy_file)
+                return None
+            digests[policy_file] = hashlib.sha256(content).hexdigest()
+        # Pair each file with the macro files preceding it
+        jobs = []
+        preceding = ()
+        for policy_file in policy_files:
+            jobs.append((policy_file, preceding))
+            if policy_file in macro_files:
+                preceding += (policy_file,)
+        # Compute the cache location of each file output
+        if self._cache_dir:
+            cache_dir = os.path.join(self._cache_dir, u"m4")
+            cached = {}
+            for policy_file, prefix in jobs:
+                digest = hashlib.sha256()
+                for item in [self.cache_version] + self.extra_defs +\
+                        [x + digests[x] for x in prefix] +\
+                        [policy_file + digests[policy_file]]:
+                    digest.update(u"{}\0".format(item).encode("utf-8"))
+                cached[policy_file] = os.path.join(cache_dir,
+                                                   digest.hexdigest())
+        else:
+            cache_dir = None
+        freeze_files = {}
+
+        def expand(job):
+            """Expand a single policy file."""
+            policy_file, prefix = job
+            if cache_dir and os.path.isfile(cached[policy_file]):
+                with open(cached[policy_file], u"rb") as cfile:
+                    output = cfile.read()
+                self.__touch_cache_entry__(cached[policy_file])
+                return output
+            command = [u"m4"]
+            for definition in self.extra_defs:
+                command.extend([u"-D", definition])
+            if prefix:
+                command.extend(
+                    [u"-R", freeze_files[prefix].result().freeze_file])
+            command.extend([u"-s", policy_file])
+            output = subprocess.check_output(command)
+            if cache_dir:
+                try:
+                    if not os.path.isdir(cache_dir):
+                        os.makedirs(cache_dir)
+                    # Write and rename, so that a partial file is never read
+                    tmp_fd, tmp_path = mkstemp(dir=cache_dir)
+                    with os.fdopen(tmp_fd, u"wb") as cfile:
+                        cfile.write(output)
+                    os.rename(tmp_path, cached[policy_file])
+                except (IOError, OSError) as e:
+                    self.log.warning(u"%s", e)
+            return output
+        policyconf = os.path.join(self._tmpdir, u"policy.conf")
+        try:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                multiprocessing.cpu_count())
+            with executor:
+                # Create the freeze files which are actually needed
+                for policy_file, prefix in jobs:
+                    if prefix and prefix not in freeze_files and not (
+                            cache_dir and os.path.isfile(
+                                cached[policy_file])):
+                        freeze_files[prefix] = executor.submit(
+                            M4FreezeFile, list(prefix), self._tmpdir,
+                            self.extra_defs,
+                            u"freezefile{}".format(len(freeze_files)))
+                line_start = True
+                with open(policyconf, u"wb") as pcf:
+                    for output in executor.map(expand, jobs):
+                        if not output:
+                            continue
+                        output = self.__join_m4_output__(output, line_start)
+                        pcf.write(output)
+                        line_start = output.endswith(b"\n")
+        except (subprocess.CalledProcessError, M4FreezeFileError) as e:
+            self.log.error(u"%s", e)
+            self.log.error(
+                u"Could not create the policy.conf \"%s\" file", policyconf)
+            policyconf = None
+        if cache_dir and os.path.isdir(cache_dir):
+            self.__prune_cache__(
+                cache_dir, self.cache_entries * len(policy_files))
+        self.log.debug(u"Expanded %d policy files separately",
+                       len(policy_files))
+        return policyconf
+
+    @staticmethod
+    def __join_m4_output__(output, line_start):
+        """Adapt the m4 output of a single policy file to follow the output
+        of the previous files, as in a single m4 run.
+
+        If the previous output does not end with a newline, m4 continues its
+        last line with the first line of this file, without the syncline of
+        this file, and names the file in the syncline of the next line."""
+        first = SourcePolicy.regex_syncline.match(output)
+        if line_start or not first or not first.group(2):
+            return output
+        rest = output[first.end():]
+        newline = rest.find(b"\n") + 1
+        if not newline or newline == len(rest):
+            return rest
+        head, tail = rest[:newline], rest[newline:]
+        following = SourcePolicy.regex_syncline.match(tail)
+        if following:
+            line = following.group(1)
+            tail = tail[following.end():]
+        else:
+            line = str(int(first.group(1)) + 1).encode(u"utf-8")
+        return head + b"#line " + line + first.group(2) + b"\n" + tail
+
     def __find_macro_files__(self, policy_files):
         """Find files that contain m4 macro definitions."""
         # Regex to match the macro definition string
@@ -347,6 +731,22 @@ class SourcePolicy(object):
                                 macro_usages.append(n_m)
         return macro_usages
 
+    def __prefetch_macro_expansions__(self, macro_usages):
+        """Compute the expansion of every macro usage in advance.
+
+        The expansions that require m4 are computed in a single m4 run, so
+        that no macro usage needs to run m4 on its own later."""
+        texts = set()
+        for usage in macro_usages:
+            text = usage.macro.pending_m4_call(usage.args)
+            if text is not None:
+                texts.add(text)
+        self._expander.prefetch(texts)
+        # Save the expansion in each macro usage
+        for usage in macro_usages:
+            usage.expansion
+        self._expander.forget_prefetched()
+
     def __compute_attributes(self):
         """Get the SELinuxPolicy attributes as a dictionary of sets.
 
@@ -390,9 +790,40 @@ class SourcePolicy(object):
         """Get the macros used in the policy source."""
         return self._macro_usages
 
+    @property
+    def macros_by_file(self):
+        """Get the macros defined in the policy source by defining file.
+
+        Returns a dictionary (file, set(M4Macro))."""
+        if self._parent is not None:
+            return self._parent.macros_by_file
+        if self._macros_by_file is None:
+            self._macros_by_file = {}
+            for macro in itervalues(self._macro_defs):
+                if macro.file_defined in self._macros_by_file:
+                    self._macros_by_file[macro.file_defined].add(macro)
+                else:
+                    self._macros_by_file[macro.file_defined] = set([macro])
+        return self._macros_by_file
+
+    def macros_defined_in(self, filename):
+        """Get the macros defined in the policy files whose path ends with
+        the given name, e.g. "te_macros".
+
+        Returns a set of M4Macro objects."""
+        macros = set()
+        for f, file_macros in iteritems(self.macros_by_file):
+            if f.endswith(filename):
+                macros.update(file_macros)
+        return macros
+
     @property
     def policy(self):
         """Get the SELinuxPolicy policy."""
+        if self._parent is not None:
+            return self._parent.policy
+        if self._policy is None:
+            self._policy = setools.policyrep.SELinuxPolicy(self.policyconf)
         return self._policy
 
     @property
@@ -421,6 +852,18 @@ class SourcePolicy(object):
         Returns a dictionary (class, set(permissions))"""
         return self._classes
 
+    @property
+    def permission_masks(self):
+        """Get the per-class permission bitmasks.
+
+        Return a PermissionMasks object."""
+        if self._parent is not None:
+            return self._parent.permission_masks
+        if self._permission_masks is None:
+            self._permission_masks = policysource.mapping.PermissionMasks(
+                self.classes)
+        return self._permission_masks
+
     @property
     def mapping(self):
         """Get the mapping between policy rules and origin file/line.
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+#    Written by Filippo Bonazzi
+#    Copyright (C) 2016 Aalto University
+#
+#    This file is part of the policysource library.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this program.  If not, see
+#    <http://www.gnu.org/licenses/>.
+#
+"""Microbenchmark of Mapper.get_rule_blocks against the character by
+character rule parser.
+
+Usage: bench_rule_blocks.py [policy.conf]
+
+The rules are those of the policy.conf, or of the sample macros in
+tests/macros if none is given."""
+
+# Necessary for Python 2/3 compatibility
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from io import open
+
+import sys
+import timeit
+
+from test_rule_blocks import policy_rules, reference_rule_blocks, \
+    sample_rules
+from policysource.mapping import Mapper
+
+# Number of timed runs, the best one is reported
+REPEAT = 5
+
+
+def bench(function, rules):
+    """Time splitting all the rules with a function.
+
+    Return the best time per rule, in microseconds."""
+    def run():
+        for rule in rules:
+            function(rule)
+    number = max(1, 100000 // len(rules))
+    best = min(timeit.repeat(run, repeat=REPEAT, number=number))
+    return best / number / len(rules) * 1e6
+
+
+def main():
+    """Run the benchmark."""
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], u"r", encoding=u"utf-8") as policy_conf:
+            rules = policy_rules(policy_conf)
+    else:
+        rules = sample_rules()
+    if not rules:
+        print(u"No rules found")
+        return 1
+    reference = bench(reference_rule_blocks, rules)
+    current = bench(Mapper.get_rule_blocks, rules)
+    print(u"{} rules".format(len(rules)))
+    print(u"character parser: {:.2f}us/rule".format(reference))
+    print(u"get_rule_blocks:  {:.2f}us/rule ({:.2f}x)".format(
+        current, reference / current))
+    return 0
+
+
+if __name__ == u"__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#
+#    Written by Filippo Bonazzi
+#    Copyright (C) 2016 Aalto University
+#
+#    This file is part of the policysource library.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this program.  If not, see
+#    <http://www.gnu.org/licenses/>.
+#
+"""Tests of the batched macro expansions against one m4 run per text.
+
+The expansions computed in a batch by M4MacroExpander.expand_many() and
+prefetch() must be the same as those of a separate m4 run for each usage of
+the sample macros in tests/macros, with or without the m4 coprocess and the
+in-process interpreter.
+Likewise, the macro definitions dumped in a batch by dump_many() and
+prefetch_dumps() must be the same as those dumped one at a time."""
+
+# Necessary for Python 2/3 compatibility
+from __future__ import absolute_import
+from future.utils import itervalues
+
+import os
+import os.path
+import sys
+import unittest
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from policysource.macro import M4Macro, M4MacroExpander
+from policysource.macro_plugins import M4MacroParser
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           u"macros")
+SAMPLE_FILES = [os.path.join(SAMPLES_DIR, x) for x in
+                (u"global_macros", u"neverallow_macros", u"te_macros")]
+
+# Texts which cannot be expanded together with the others
+SPECIAL_TEXTS = [
+    u"r_file_perms dnl",
+    u"r_file_perms # comment",
+    u"domain_trans(a, b",
+    u"r_file_perms `unterminated",
+    u"define(`r_file_perms', `x')r_file_perms",
+    u"r_file_perms",
+]
+
+# The expander options to test, as (coprocess, interpreter)
+OPTIONS = [(True, True), (True, False), (False, True), (False, False)]
+
+
+def sample_macros():
+    """Parse the sample macros.
+
+    Return a dictionary {name: M4Macro}."""
+    return M4MacroParser(extra_defs=[]).parse(SAMPLE_FILES)
+
+
+def sample_usages():
+    """Get a usage of each sample macro, with its number of arguments."""
+    usages = []
+    for macro in itervalues(sample_macros()):
+        if macro.nargs:
+            usages.append(u"{}({})".format(macro.name, u", ".join(
+                u"arg{}_t".format(i) for i in range(macro.nargs))))
+        else:
+            usages.append(macro.name)
+    return sorted(usages)
+
+
+@unittest.skipUnless(which(u"m4"), u"GNU m4 is not installed")
+class BatchExpansionTest(unittest.TestCase):
+    """Compare the batched expansions with one m4 run per text."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.texts = sample_usages() + SPECIAL_TEXTS
+        m4 = M4MacroExpander(SAMPLE_FILES, None, [], coprocess=False,
+                             interpreter=False)
+        cls.expected = [m4.expand(x) for x in cls.texts]
+
+    def expanders(self):
+        """Get an expander for each set of options."""
+        for coprocess, interpreter in OPTIONS:
+            yield M4MacroExpander(SAMPLE_FILES, None, [], coprocess=coprocess,
+                                  interpreter=interpreter)
+
+    def test_expand(self):
+        """Expand the texts one at a time."""
+        for expander in self.expanders():
+            self.assertEqual([expander.expand(x) for x in self.texts],
+                             self.expected)
+
+    def test_expand_many(self):
+        """Expand the texts in a batch."""
+        for expander in self.expanders():
+            self.assertEqual(expander.expand_many(self.texts), self.expected)
+
+    def test_prefetch(self):
+        """Check that the prefetched expansions are returned later, without
+        running m4."""
+        for expander in self.expanders():
+            expander.prefetch(self.texts)
+            # pylint: disable=protected-access
+            # Every later m4 run fails, and the expansion is None
+            expander._interpreter = None
+            expander._coprocess = None
+            expander.expansion_command = [u"m4", u"--no-such-option"]
+            for text, expected in zip(self.texts, self.expected):
+                if expected is None:
+                    # Failed expansions are not kept
+                    self.assertNotIn(text, expander._prefetched)
+                    continue
+                self.assertEqual(expander.expand(text), expected)
+            expander.forget_prefetched()
+            self.assertIsNone(expander.expand(self.texts[0]))
+
+
+@unittest.skipUnless(which(u"m4"), u"GNU m4 is not installed")
+class BatchDumpTest(unittest.TestCase):
+    """Compare the batched macro dumps with one m4 run per macro."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.macros = sample_macros()
+        cls.names = sorted(cls.macros)
+        m4 = M4MacroExpander(SAMPLE_FILES, None, [], coprocess=False,
+                             interpreter=False)
+        cls.expected = [m4.dump(x) for x in cls.names]
+
+    def test_dump_many(self):
+        """Dump the definitions in a batch."""
+        for coprocess in (True, False):
+            expander = M4MacroExpander(SAMPLE_FILES, None, [],
+                                       coprocess=coprocess)
+            self.assertEqual(expander.dump_many(self.names), self.expected)
+
+    def test_parsed_macros(self):
+        """Check the definitions prefetched by the macro parser against
+        those of a fresh dump of each macro."""
+        self.assertEqual(len(self.names), 39)
+        for name, dump in zip(self.names, self.expected):
+            macro = self.macros[name]
+            # The macro leaves out the first line ("name:")
+            definition = u"\n".join(dump.splitlines()[1:])
+            self.assertEqual(macro.dump, definition)
+            static = not any(x in definition for x in M4Macro.operators)
+            self.assertEqual(macro.expansion_static, static,
+                             u"Mismatch on macro \"{}\"".format(name))
+
+
+if __name__ == u"__main__":
+    unittest.main()
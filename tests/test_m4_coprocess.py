@@ -0,0 +1,126 @@
+#
+#    Written by Filippo Bonazzi
+#    Copyright (C) 2016 Aalto University
+#
+#    This file is part of the policysource library.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this program.  If not, see
+#    <http://www.gnu.org/licenses/>.
+#
+"""Tests of the m4 coprocess against one m4 run per expansion.
+
+The expansions through the long-lived m4 process must be the same as those
+of a separate m4 run for each text, whatever the texts before them."""
+
+# Necessary for Python 2/3 compatibility
+from __future__ import absolute_import
+
+import os
+import os.path
+import sys
+import unittest
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from policysource.macro import M4Coprocess, M4MacroExpander
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           u"macros")
+SAMPLE_FILES = [os.path.join(SAMPLES_DIR, x) for x in
+                (u"global_macros", u"neverallow_macros", u"te_macros")]
+
+# Texts ending in dnl, which discards the rest of their line
+DNL_TEXTS = [
+    u"r_file_perms dnl",
+    u"r_file_perms dnl\n",
+    u"domain_trans(a, b, c)\ndnl",
+    u"dnl",
+]
+
+# Texts changing the m4 state, each followed by a text which it affects
+STATE_TEXTS = [
+    (u"define(`zz', `q')zz", u"zz"),
+    (u"undefine(`r_file_perms')", u"r_file_perms"),
+    (u"pushdef(`r_file_perms', `x')", u"r_file_perms"),
+    (u"changequote([, ])[r_file_perms]", u"`r_file_perms'"),
+    (u"changecom(`r_')r_file_perms", u"r_file_perms\n"),
+    (u"divert(-1)", u"r_file_perms"),
+]
+
+
+@unittest.skipUnless(which(u"m4"), u"GNU m4 is not installed")
+class M4CoprocessTest(unittest.TestCase):
+    """Compare the coprocess expansions with one m4 run per expansion."""
+
+    def setUp(self):
+        self.coprocess = M4MacroExpander(SAMPLE_FILES, None, [],
+                                         coprocess=True, interpreter=False)
+        # pylint: disable=protected-access
+        self.assertIsNotNone(self.coprocess._coprocess)
+        # Fail fast instead of waiting for a reply which never comes
+        self.coprocess._coprocess.timeout = 2
+        self.m4 = M4MacroExpander(SAMPLE_FILES, None, [], coprocess=False,
+                                  interpreter=False)
+
+    def tearDown(self):
+        # pylint: disable=protected-access
+        self.assertEqual(self.coprocess._coprocess_restarts, 0,
+                         u"The coprocess was restarted")
+        del self.coprocess
+        del self.m4
+
+    def test_dnl(self):
+        """Expand texts ending in dnl."""
+        for text in DNL_TEXTS:
+            self.assertTrue(M4Coprocess.can_expand(text))
+            self.assertEqual(self.coprocess.expand(text),
+                             self.m4.expand(text),
+                             u"Mismatch expanding \"{}\"".format(text))
+        self.assertEqual(self.coprocess.expand_many(DNL_TEXTS),
+                         [self.m4.expand(x) for x in DNL_TEXTS])
+
+    def test_state_isolation(self):
+        """Check that texts changing the m4 state do not affect the
+        following expansions."""
+        for text, after in STATE_TEXTS:
+            self.assertFalse(M4Coprocess.can_expand(text))
+            self.assertTrue(M4Coprocess.can_expand(after))
+            self.assertEqual(self.coprocess.expand(text),
+                             self.m4.expand(text),
+                             u"Mismatch expanding \"{}\"".format(text))
+            self.assertEqual(self.coprocess.expand(after),
+                             self.m4.expand(after),
+                             u"\"{}\" affected \"{}\"".format(text, after))
+        texts = [x for pair in STATE_TEXTS for x in pair]
+        self.assertEqual(self.coprocess.expand_many(texts),
+                         [self.m4.expand(x) for x in texts])
+
+    def test_comment(self):
+        """Expand texts with comments, at the end or not."""
+        texts = [u"r_file_perms # r_file_perms\nr_file_perms",
+                 u"r_file_perms # r_file_perms"]
+        self.assertTrue(M4Coprocess.can_expand(texts[0]))
+        self.assertFalse(M4Coprocess.can_expand(texts[1]))
+        self.assertEqual(self.coprocess.expand_many(texts),
+                         [self.m4.expand(x) for x in texts])
+
+
+if __name__ == u"__main__":
+    unittest.main()
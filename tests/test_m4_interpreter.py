@@ -0,0 +1,172 @@
+#
+#    Written by Filippo Bonazzi
+#    Copyright (C) 2016 Aalto University
+#
+#    This file is part of the policysource library.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this program.  If not, see
+#    <http://www.gnu.org/licenses/>.
+#
+"""Conformance tests of the in-process m4 interpreter against GNU m4.
+
+Every macro defined in the macro files is expanded with placeholder
+arguments by both the M4Interpreter and m4, and the expansions must match.
+The macro files are the samples in tests/macros, or the files listed in the
+SELINT_MACRO_FILES environment variable (separated by os.pathsep), e.g. the
+global_macros, te_macros and neverallow_macros of a policy tree."""
+
+# Necessary for Python 2/3 compatibility
+from __future__ import absolute_import
+from io import open
+
+import os
+import os.path
+import re
+import sys
+import unittest
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from policysource.macro import M4Interpreter, M4MacroExpander
+from policysource.macro import M4UnsupportedError
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           u"macros")
+SAMPLE_FILES = [os.path.join(SAMPLES_DIR, x) for x in
+                (u"global_macros", u"neverallow_macros", u"te_macros")]
+
+# Build variants to test the macro files with
+EXTRA_DEFS = ([], [u"target_build_variant=user"],
+              [u"target_build_variant=eng", u"target_recovery=true"])
+
+regex_define = re.compile(r"define\(`([a-zA-Z_][a-zA-Z0-9_]*)'")
+
+
+def macro_files():
+    """Get the macro files to test."""
+    files = os.environ.get(u"SELINT_MACRO_FILES")
+    if files:
+        return files.split(os.pathsep)
+    return SAMPLE_FILES
+
+
+def defined_macros(files):
+    """Get the names of the macros defined in the files, in order."""
+    names = []
+    for macro_file in files:
+        with open(macro_file, u"r", encoding=u"utf-8") as mfile:
+            for name in regex_define.findall(mfile.read()):
+                if name not in names:
+                    names.append(name)
+    return names
+
+
+@unittest.skipUnless(which(u"m4"), u"GNU m4 is not installed")
+class M4InterpreterConformanceTest(unittest.TestCase):
+    """Compare the M4Interpreter expansions with GNU m4."""
+
+    def check(self, files, extra_defs, texts):
+        """Expand the texts with the interpreter and with m4, and compare
+        the expansions.
+
+        Return the number of texts expanded by the interpreter."""
+        try:
+            interpreter = M4Interpreter(files, extra_defs)
+        except M4UnsupportedError as e:
+            self.skipTest(u"{}".format(e))
+        m4 = M4MacroExpander(files, None, extra_defs, coprocess=False,
+                             interpreter=False)
+        supported = 0
+        for text in texts:
+            try:
+                expansion = interpreter.expand(text)
+            except M4UnsupportedError:
+                # The expander resorts to m4 for these
+                continue
+            supported += 1
+            self.assertEqual(expansion, m4.expand(text),
+                             u"Mismatch expanding \"{}\"".format(text))
+        return supported
+
+    def test_macro_files(self):
+        """Expand every macro with 0-5 placeholder arguments."""
+        files = macro_files()
+        names = defined_macros(files)
+        self.assertTrue(names)
+        texts = []
+        for name in names:
+            texts.append(name)
+            for nargs in range(6):
+                texts.append(u"{}({})".format(name, u", ".join(
+                    u"@@ARG{}@@".format(i) for i in range(nargs))))
+        for extra_defs in EXTRA_DEFS:
+            self.assertTrue(self.check(files, extra_defs, texts))
+
+    def test_constructs(self):
+        """Expand texts exercising quoting, comments and the builtins."""
+        texts = [
+            u"domain_auto_trans(`a', b, c)",
+            u"r_dir_file(`a, b', c)",
+            u"print(a, `b', `c, d')",
+            u"print()",
+            u"allow_all(a, b, file, read, write, open)",
+            u"with_default(a, b)",
+            u"# comment with file_class_set(x)\nfile_class_set",
+            u"`quoted domain_trans(a, b, c)' domain_trans",
+            u"ifelse(a, b, c, a, a, d, e)",
+            u"ifelse(a, b, c, d)",
+            u"ifdef(`domain_trans', yes, no) ifdef(`nomacro', yes, no)",
+            u"shift(a, b, `c')",
+            u"define(`x', `$# $* $@ `$0'')x(a, `b', c)",
+            u"define(`x', y)x dnl ignored\nx",
+            u"pushdef(`x', 1)pushdef(`x', 2)x popdef(`x')x",
+            u"undefine(`r_dir_file')r_dir_file(a, b)",
+            u"unix_socket_connect( a ,  b, c )",
+        ]
+        self.assertEqual(self.check(SAMPLE_FILES, [], texts), len(texts))
+
+    def test_expansions_are_independent(self):
+        """Check that the definitions changed by an expansion do not leak
+        into the following ones, as with separate m4 runs."""
+        texts = [
+            u"undefine(`binder_call')binder_call(a, b)",
+            u"binder_call(a, b)",
+            u"define(`binder_call', `redefined')binder_call(a, b)",
+            u"binder_call(a, b)",
+            u"pushdef(`eng', `pushed')eng(a)",
+            u"eng(a)",
+            u"define(`newmacro', `new')newmacro",
+            u"newmacro",
+        ]
+        self.assertEqual(self.check(SAMPLE_FILES, [], texts), len(texts))
+
+    def test_unterminated(self):
+        """Check that the texts which make m4 fail are not expanded."""
+        texts = [u"abc # unterminated", u"r_file_perms `unterminated"]
+        interpreter = M4Interpreter(SAMPLE_FILES, [])
+        m4 = M4MacroExpander(SAMPLE_FILES, None, [], coprocess=False,
+                             interpreter=False)
+        for text in texts:
+            self.assertIsNone(m4.expand(text))
+            self.assertRaises(M4UnsupportedError, interpreter.expand, text)
+
+
+if __name__ == u"__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+#
+#    Written by Filippo Bonazzi
+#    Copyright (C) 2016 Aalto University
+#
+#    This file is part of the policysource library.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this program.  If not, see
+#    <http://www.gnu.org/licenses/>.
+#
+"""Tests of the pool of m4 expanders against a single expander.
+
+The expansions made concurrently by the workers of the pool must be the
+same, and in the same order, as those made sequentially by one expander."""
+
+# Necessary for Python 2/3 compatibility
+from __future__ import absolute_import
+from io import open
+
+import os
+import os.path
+import re
+import sys
+import unittest
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from policysource.macro import M4MacroExpander, M4MacroExpanderPool
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           u"macros")
+SAMPLE_FILES = [os.path.join(SAMPLES_DIR, x) for x in
+                (u"global_macros", u"neverallow_macros", u"te_macros")]
+
+WORKERS = 3
+
+regex_define = re.compile(r"define\(`([a-zA-Z_][a-zA-Z0-9_]*)'")
+
+
+def sample_texts():
+    """Get a call of each sample macro, with 0-3 placeholder arguments."""
+    texts = []
+    for macro_file in SAMPLE_FILES:
+        with open(macro_file, u"r", encoding=u"utf-8") as mfile:
+            for name in regex_define.findall(mfile.read()):
+                texts.append(name)
+                for nargs in range(1, 4):
+                    texts.append(u"{}({})".format(name, u", ".join(
+                        u"@@ARG{}@@".format(i) for i in range(nargs))))
+    return texts
+
+
+@unittest.skipUnless(which(u"m4"), u"GNU m4 is not installed")
+class M4MacroExpanderPoolTest(unittest.TestCase):
+    """Compare the pool expansions with those of a single expander."""
+
+    def setUp(self):
+        self.expander = M4MacroExpander(SAMPLE_FILES, None, [])
+        self.pool = M4MacroExpanderPool(self.expander, WORKERS)
+        self.texts = sample_texts()
+        self.assertGreater(len(self.texts), WORKERS)
+        self.expected = [self.expander.expand(x) for x in self.texts]
+
+    def tearDown(self):
+        self.pool.shutdown()
+        del self.pool
+        del self.expander
+
+    def started(self):
+        """Get the number of workers started by the pool."""
+        # pylint: disable=protected-access
+        return len(self.pool._expanders)
+
+    def test_map(self):
+        """Expand the texts with map(), in order."""
+        self.assertEqual(
+            list(self.pool.map(M4MacroExpander.expand, self.texts)),
+            self.expected)
+        self.assertTrue(1 <= self.started() <= WORKERS)
+
+    def test_submit(self):
+        """Expand the texts with submit()."""
+        futures = [self.pool.submit(M4MacroExpander.expand, x)
+                   for x in self.texts]
+        self.assertEqual([x.result() for x in futures], self.expected)
+        self.assertTrue(1 <= self.started() <= WORKERS)
+
+    def test_expand_many(self):
+        """Expand the texts with expand_many(), in chunks of every size."""
+        self.assertEqual(self.pool.expand_many(self.texts), self.expected)
+        # Fewer texts than workers, and no texts at all
+        self.assertEqual(self.pool.expand_many(self.texts[:2]),
+                         self.expected[:2])
+        self.assertEqual(self.pool.expand_many([]), [])
+        self.assertTrue(1 <= self.started() <= WORKERS)
+
+    def test_shutdown(self):
+        """Check that shutdown() waits for the pending calls and stops the
+        workers."""
+        futures = [self.pool.submit(M4MacroExpander.expand, x)
+                   for x in self.texts]
+        self.pool.shutdown()
+        self.assertTrue(all(x.done() for x in futures))
+        self.assertEqual(self.started(), 0)
+        self.assertRaises(RuntimeError, self.pool.submit,
+                          M4MacroExpander.expand, self.texts[0])
+
+
+if __name__ == u"__main__":
+    unittest.main()
@@ -0,0 +1,620 @@
+#
+#    Written by Filippo Bonazzi
+#    Copyright (C) 2016 Aalto University
+#
+#    This file is part of the policysource library.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this program.  If not, see
+#    <http://www.gnu.org/licenses/>.
+#
+"""Tests of the mapping module."""
+
+# Necessary for Python 2/3 compatibility
+from __future__ import absolute_import
+
+import logging
+import os
+import os.path
+import pickle
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from future.utils import iteritems, itervalues
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from policysource.mapping import FilteredRules, LazyRule, LazyRules, \
+    LineIndex, Mapper, Mapping, MappingFile, PermissionMasks, TERule, \
+    XpermSet
+
+# A small policy.conf, with rules from several files
+POLICY_CONF = u"""#line 1 "a.te"
+allow a_t b_t:file { read open };
+allow { a_t c_t } b_t:dir search;
+allow domain self:process fork;
+neverallow a_t b_t:file execute;
+#line 1 "b.te"
+allow a_t b_t:file getattr;
+allowxperm a_t b_t:ioctl ioctl { 0x8900-0x8906 0x8910 };
+allow a_t b_t:ioctl ioctl;
+type_transition a_t b_t:file c_t;
+type_transition a_t b_t:file c_t "name";
+#line 10
+allow a_t
+    b_t:dir { read
+    search };
+#line 1 "c.te"
+neverallowxperm domain b_t:ioctl ioctl ~{ 0x8900 };
+dontauditxperm c_t b_t:ioctl ioctl 0x8901;
+"""
+ATTRIBUTES = {u"domain": set([u"a_t", u"c_t"])}
+TYPES = set([u"a_t", u"b_t", u"c_t"])
+CLASSES = {u"file": set([u"read", u"open", u"getattr", u"execute"]),
+           u"dir": set([u"read", u"search"]),
+           u"process": set([u"fork"]),
+           u"ioctl": set([u"ioctl"])}
+
+
+def get_mapping(**kwargs):
+    """Map the sample policy.conf."""
+    return Mapper(u"policy.conf", ATTRIBUTES, TYPES, CLASSES).get_mapping(
+        lines=POLICY_CONF.splitlines(True), **kwargs)
+
+
+def mapping_fields(mapping):
+    """Get the rules and lines of a mapping as plain dictionaries."""
+    rules = dict((k, [(x.rule, x.original_rule, x.fileline) for x in v])
+                 for k, v in iteritems(mapping.rules))
+    return rules, dict((k, list(v)) for k, v in iteritems(mapping.lines))
+
+
+class TERuleTest(unittest.TestCase):
+    """Check the fields of the type transition rules."""
+
+    def test_type_transition(self):
+        """Check the fields of a type transition."""
+        rule = TERule([u"type_transition", u"a", u"b", u"file", u"c"])
+        self.assertEqual(str(rule), u"type_transition a b:file c;")
+        self.assertEqual(rule.rtype, u"type_transition")
+        self.assertEqual(rule.source, u"a")
+        self.assertEqual(rule.target, u"b")
+        self.assertEqual(rule.tclass, u"file")
+        self.assertEqual(rule.deftype, u"c")
+        self.assertIsNone(rule.objname)
+        self.assertFalse(rule.is_name_trans)
+
+    def test_name_transition(self):
+        """Check that the object name of a name transition is sliced
+        without its quotes."""
+        for objname in (u"\"name\"", u"'name'", u"name"):
+            rule = TERule([u"type_transition", u"a", u"b", u"file", u"c",
+                           objname])
+            self.assertEqual(
+                str(rule), u"type_transition a b:file c \"name\";")
+            self.assertEqual(rule.deftype, u"c")
+            self.assertEqual(rule.objname, u"name")
+            self.assertTrue(rule.is_name_trans)
+        rule = Mapper.rule_factory(
+            u"type_transition a b:dir c_dir \"x.y-z\";")
+        self.assertEqual(rule.objname, u"x.y-z")
+
+
+class MapperTest(unittest.TestCase):
+    """Check the mapping of the sample policy.conf."""
+
+    def test_interned(self):
+        """Check that the equal strings of the rules are shared, and that
+        the mapping does not keep the table used to share them."""
+        mapping = get_mapping()
+        self.assertEqual(sorted(mapping.lines),
+                         [u"a.te:1", u"a.te:2", u"a.te:3", u"a.te:4",
+                          u"b.te:1", u"b.te:12", u"b.te:2", u"b.te:3",
+                          u"b.te:4", u"b.te:5", u"c.te:1", u"c.te:2"])
+        strings = {}
+        for mapped_rules in itervalues(mapping.rules):
+            for mpr in mapped_rules:
+                for string in (mpr.original_rule, mpr.fileline):
+                    self.assertIs(strings.setdefault(string, string), string)
+        # e.g. the two rules expanded from "allow { a_t c_t } b_t:dir"
+        self.assertIs(mapping.rules[u"allow a_t b_t:dir"][0].original_rule,
+                      mapping.rules[u"allow c_t b_t:dir"][0].original_rule)
+        self.assertEqual(sorted(vars(mapping)), [u"_index", u"lines",
+                                                 u"rules"])
+
+
+class LogRecords(logging.Handler):
+    """Collect the messages logged by a logger while in a with block."""
+
+    def __init__(self, name):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.logger = logging.getLogger(name)
+        self.level = self.logger.level
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+    def __enter__(self):
+        self.logger.addHandler(self)
+        self.logger.setLevel(logging.DEBUG)
+        return self.messages
+
+    def __exit__(self, *exc_info):
+        self.logger.removeHandler(self)
+        self.logger.setLevel(self.level)
+
+
+class ParallelMappingTest(unittest.TestCase):
+    """Compare the mapping of the policy.conf segments in parallel with
+    the sequential mapping."""
+
+    # More files than workers, and a file visited twice
+    content = POLICY_CONF + u"""#line 1 "d.te"
+allow c_t b_t:file { read getattr };
+#line 1 "a.te"
+#line 8
+allow a_t b_t:file open;
+allow a_t b_t:dir search;
+#line 1 "e.te"
+allow domain b_t:file execute;
+#line 1 "f.te"
+type_transition c_t b_t:file a_t;
+"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, u"wb") as policy_conf:
+            policy_conf.write(self.content.encode(u"utf-8"))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def get_mapping(self, **kwargs):
+        """Map the policy.conf file."""
+        return Mapper(self.path, ATTRIBUTES, TYPES, CLASSES).get_mapping(
+            **kwargs)
+
+    def test_parallel(self):
+        """Check that the parallel mapping equals the sequential one."""
+        for map_neverallows in (True, False):
+            expected = mapping_fields(
+                self.get_mapping(map_neverallows=map_neverallows))
+            self.assertEqual(mapping_fields(self.get_mapping(
+                map_neverallows=map_neverallows,
+                lines=self.content.splitlines(True))), expected)
+            for workers in (2, 4):
+                with LogRecords(u"Mapper") as messages:
+                    mapping = self.get_mapping(
+                        map_neverallows=map_neverallows, workers=workers)
+                self.assertIn(u"Mapped 7 policy segments with {} "
+                              u"processes".format(workers), messages)
+                self.assertEqual(mapping_fields(mapping), expected)
+            self.assertEqual(
+                u"neverallow a_t b_t:file" in expected[0], map_neverallows)
+        self.assertEqual(len(expected[0][u"allow a_t b_t:file"]), 4)
+
+    def test_split_rule(self):
+        """Check that a rule spanning two segments is mapped sequentially."""
+        with open(self.path, u"ab") as policy_conf:
+            policy_conf.write(b"allow a_t\n#line 1 \"g.te\"\nc_t:dir read;\n")
+        expected = mapping_fields(self.get_mapping())
+        self.assertIn(u"allow a_t c_t:dir", expected[0])
+        with LogRecords(u"Mapper") as messages:
+            mapping = self.get_mapping(workers=4)
+        self.assertIn(u"Policy rule spans more than one file, mapping the "
+                      u"policy sequentially...", messages)
+        self.assertEqual(mapping_fields(mapping), expected)
+
+
+class FindTest(unittest.TestCase):
+    """Compare the indexed search of the rules with a linear scan."""
+
+    @staticmethod
+    def scan(mapping, rtype, source, target, tclass, perm, filename):
+        """Find the matching rules by scanning all of them."""
+        found = set()
+        for rutc, mapped_rules in iteritems(mapping.rules):
+            fields = rutc.replace(u":", u" ").split(u" ")
+            if any(x is not None and x != y for x, y in
+                   zip((rtype, source, target, tclass), fields)):
+                continue
+            perms = set()
+            files = set()
+            for mpr in mapped_rules:
+                files.add(Mapping.get_fileline_file(mpr.fileline))
+                if fields[0] in (u"allow", u"neverallow"):
+                    perms.update(mpr.rule[len(rutc) + 1:-1].strip(
+                        u"{} ").split(u" "))
+            if perm is not None and perm not in perms:
+                continue
+            if filename is not None and filename not in files:
+                continue
+            found.add(rutc)
+        return found
+
+    def test_find(self):
+        """Check every combination of the criteria."""
+        criteria = [
+            (None, u"allow", u"neverallow", u"allowxperm", u"bogus"),
+            (None, u"a_t", u"c_t", u"domain"),
+            (None, u"b_t", u"a_t"),
+            (None, u"file", u"dir", u"ioctl"),
+            (None, u"read", u"search", u"execute", u"ioctl"),
+            (None, u"a.te", u"b.te", u"c.te", u"d.te")]
+        combinations = [()]
+        for values in criteria:
+            combinations = [x + (y,) for x in combinations for y in values]
+        mapping = get_mapping()
+        for view in (mapping, mapping.without([u"neverallow"]),
+                     get_mapping(lazy=True)):
+            found = 0
+            for combination in combinations:
+                expected = self.scan(view, *combination)
+                self.assertEqual(view.find(*combination), expected,
+                                 u"Mismatch finding {}".format(combination))
+                found += bool(expected)
+            # Check that the criteria do select some rules
+            self.assertGreater(found, 100)
+
+
+class MappingFileTest(unittest.TestCase):
+    """Check that a mapping is saved and loaded back unchanged."""
+
+    def setUp(self):
+        self.mapping = get_mapping()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.mapping.save(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_round_trip(self):
+        """Compare the rules and lines of every rule and file/line."""
+        loaded = Mapping.load(self.path)
+        self.assertEqual(mapping_fields(loaded), mapping_fields(self.mapping))
+        self.assertEqual(list(loaded.rules), list(self.mapping.rules))
+        self.assertEqual(list(loaded.lines), list(self.mapping.lines))
+        for rutc, mapped_rules in iteritems(self.mapping.rules):
+            self.assertIn(rutc, loaded.rules)
+            self.assertEqual([str(x) for x in loaded.rules[rutc]],
+                             [str(x) for x in mapped_rules])
+        for rutc in (u"allowxperm a_t b_t:ioctl",
+                     u"neverallowxperm a_t b_t:ioctl",
+                     u"dontauditxperm c_t b_t:ioctl"):
+            self.assertEqual(loaded.xperms(rutc), self.mapping.xperms(rutc))
+        for filename in (u"a.te", u"b.te", u"c.te"):
+            self.assertEqual(
+                [str(x) for x in loaded.rules_from_file(filename)],
+                [str(x) for x in self.mapping.rules_from_file(filename)])
+        self.assertNotIn(u"allow b_t a_t:file", loaded.rules)
+        self.assertNotIn(u"b.te:2000", loaded.lines)
+
+    def write(self, data):
+        """Overwrite the mapping file."""
+        with open(self.path, u"wb") as mfile:
+            mfile.write(data)
+
+    def test_invalid(self):
+        """Check that truncated or corrupted files are rejected."""
+        with open(self.path, u"rb") as mfile:
+            content = mfile.read()
+        self.assertEqual(
+            mapping_fields(Mapping.load(self.path, verify=True)),
+            mapping_fields(self.mapping))
+        # Truncated and extended files, and a bit flipped in the magic, the
+        # version and a count, are rejected by the cheap checks
+        corrupted = [content[:length] for length in
+                     (0, 4, 40, len(content) // 2, len(content) - 1)]
+        corrupted.append(content + b"\0\0\0\0")
+        flipped = []
+        for offset in (0, 8, 16, 45, len(content) // 2, len(content) - 1):
+            byte = bytearray(content[offset:offset + 1])
+            byte[0] ^= 1
+            flipped.append(content[:offset] + bytes(byte) +
+                           content[offset + 1:])
+        for data in corrupted + flipped[:3]:
+            self.write(data)
+            self.assertRaises(ValueError, Mapping.load, self.path)
+        # A bit flipped in the data is only found by the checksum
+        for data in flipped:
+            self.write(data)
+            self.assertRaises(ValueError, Mapping.load, self.path,
+                              verify=True)
+
+    def test_checksum_chunks(self):
+        """Check the checksum computed over several chunks."""
+        with open(self.path, u"rb") as mfile:
+            content = mfile.read()
+        chunk = MappingFile.checksum_chunk
+        try:
+            MappingFile.checksum_chunk = 7
+            Mapping.load(self.path, verify=True)
+            self.write(content[:-1] + bytearray([content[-1] ^ 1]))
+            self.assertRaises(ValueError, Mapping.load, self.path,
+                              verify=True)
+        finally:
+            MappingFile.checksum_chunk = chunk
+
+
+class XpermSetTest(unittest.TestCase):
+    """Check the extended permission sets against sets of integers."""
+
+    @staticmethod
+    def values(xperms):
+        """Get the set of the extended permissions in an XpermSet."""
+        return set(x for first, last in xperms.intervals
+                   for x in range(first, last + 1))
+
+    def test_merge(self):
+        """Check that overlapping and adjacent intervals are merged."""
+        xperms = XpermSet([(0x20, 0x30), (0x1, 0x1), (0x10, 0x1f),
+                           (0x25, 0x28), (0x3, 0x4), (0x2, 0x2)])
+        self.assertEqual(xperms.intervals, ((0x1, 0x4), (0x10, 0x30)))
+        self.assertEqual(len(xperms), 4 + 0x21)
+        self.assertEqual(str(xperms), u"{ 0x0001-0x0004 0x0010-0x0030 }")
+        self.assertEqual(str(XpermSet([(0x8910, 0x8910)])), u"0x8910")
+        self.assertFalse(XpermSet())
+        for value in (0x0, 0x5, 0xf, 0x31):
+            self.assertNotIn(value, xperms)
+        for value in (0x1, 0x4, 0x10, 0x30):
+            self.assertIn(value, xperms)
+        for intervals in ([(2, 1)], [(-1, 0)], [(0, 0x10000)]):
+            self.assertRaises(ValueError, XpermSet, intervals)
+
+    def test_from_block(self):
+        """Check the parsing of single values, ranges and complements."""
+        self.assertEqual(XpermSet.from_block(u"0x8910").intervals,
+                         ((0x8910, 0x8910),))
+        self.assertEqual(
+            XpermSet.from_block(u"{ 0x8910 0x8900-0x8906 0x8907 }").intervals,
+            ((0x8900, 0x8907), (0x8910, 0x8910)))
+        self.assertEqual(
+            XpermSet.from_block(u"~{ 0x0-0x10 0xfff0 }").intervals,
+            ((0x11, 0xffef), (0xfff1, 0xffff)))
+        self.assertEqual(XpermSet.from_block(u"~0x0").intervals,
+                         ((0x1, 0xffff),))
+        self.assertEqual(XpermSet.from_block(u"~{ 0x0-0xffff }").intervals, ())
+        for block in (u"{ 0x10-0x5 }", u"read", u"0x10-", u"{ 0x10000 }"):
+            self.assertRaises(ValueError, XpermSet.from_block, block)
+
+    def test_operations(self):
+        """Compare the set operations with those of the integer sets."""
+        full = set(range(XpermSet.maximum + 1))
+        blocks = [u"0x0", u"0xffff", u"{ 0x0-0x10 0x20-0x30 }",
+                  u"{ 0x8-0x25 }", u"~{ 0x10-0x20 }", u"{ 0x11-0x1f }",
+                  u"{ 0x8900-0x8906 0x8910 }", u"~0x8910"]
+        sets = [XpermSet.from_block(x) for x in blocks] + [XpermSet()]
+        for xperms in sets:
+            self.assertEqual(self.values(xperms.complement()),
+                             full - self.values(xperms))
+            self.assertEqual(xperms.complement().complement(), xperms)
+            for other in sets:
+                mine, theirs = self.values(xperms), self.values(other)
+                self.assertEqual(self.values(xperms.union(other)),
+                                 mine | theirs)
+                self.assertEqual(self.values(xperms.intersection(other)),
+                                 mine & theirs)
+                self.assertEqual(self.values(xperms.difference(other)),
+                                 mine - theirs)
+                self.assertEqual(xperms.overlaps(other), bool(mine & theirs))
+                self.assertEqual(xperms.issubset(other), mine <= theirs)
+                self.assertEqual(xperms == other, mine == theirs)
+
+    def test_expand_xperms(self):
+        """Check the expansion of the xperm rules."""
+        mapper = Mapper(u"policy.conf", ATTRIBUTES, TYPES, CLASSES)
+        self.assertIs(mapper.expand_xperms(u"{ 0x1 0x2 }"),
+                      mapper.expand_xperms(u"{ 0x1 0x2 }"))
+        self.assertEqual(mapper.expand_rule(
+            u"allowxperm a_t { b_t c_t }:ioctl ioctl "
+            u"{ 0x10-0x20 0x15-0x30 0x31 };"),
+            {u"allowxperm a_t b_t:ioctl":
+             u"allowxperm a_t b_t:ioctl ioctl 0x0010-0x0031;",
+             u"allowxperm a_t c_t:ioctl":
+             u"allowxperm a_t c_t:ioctl ioctl 0x0010-0x0031;"})
+        self.assertEqual(mapper.expand_rule(
+            u"neverallowxperm a_t self:ioctl ioctl ~{ 0x0-0x7fff };"),
+            {u"neverallowxperm a_t a_t:ioctl":
+             u"neverallowxperm a_t a_t:ioctl ioctl 0x8000-0xffff;"})
+        rule = Mapper.rule_factory(
+            u"allowxperm a_t b_t:ioctl ioctl { 0x10-0x20 0x15 };")
+        self.assertEqual(rule.xtype, u"ioctl")
+        self.assertEqual(rule.xperms, XpermSet([(0x10, 0x20)]))
+        # The xperms of the rules on some types and class, if any
+        mapping = get_mapping()
+        self.assertEqual(mapping.xperms(u"neverallowxperm c_t b_t:ioctl"),
+                         XpermSet.from_block(u"~0x8900"))
+        self.assertEqual(mapping.xperms(u"allowxperm c_t b_t:ioctl"),
+                         XpermSet())
+
+
+class PermissionMasksTest(unittest.TestCase):
+    """Check the permission bitmasks against the sets of names."""
+
+    def setUp(self):
+        self.classes = dict(CLASSES)
+        # More permissions than fit in a 64 bit integer
+        self.classes[u"big"] = set(u"p{:03}".format(i) for i in range(100))
+        self.masks = PermissionMasks(self.classes)
+
+    def test_round_trip(self):
+        """Check that the names of a mask are the permissions masked."""
+        subsets = [[], [u"read"], [u"read", u"open", u"execute"],
+                   sorted(CLASSES[u"file"])]
+        for perms in subsets:
+            mask = self.masks.mask(u"file", perms)
+            self.assertEqual(sorted(self.masks.names(u"file", mask)),
+                             sorted(perms))
+            self.assertEqual(mask, self.masks.mask(u"file", reversed(perms)))
+        big = sorted(self.classes[u"big"])
+        for perms in (big, big[60:70], [big[0], big[63], big[64], big[99]]):
+            mask = self.masks.mask(u"big", perms)
+            self.assertEqual(self.masks.names(u"big", mask), perms)
+        self.assertGreaterEqual(self.masks.mask(u"big", [big[99]]), 2 ** 64)
+
+    def test_unknown(self):
+        """Check that unknown permissions and classes get their own bits."""
+        known = self.masks.mask(u"file", CLASSES[u"file"])
+        unknown = self.masks.mask(u"file", [u"bogus"])
+        self.assertFalse(known & unknown)
+        self.assertEqual(self.masks.names(u"file", unknown), [u"bogus"])
+        self.assertEqual(self.masks.mask(u"file", [u"bogus"]), unknown)
+        mask = self.masks.mask(u"nosuchclass", [u"a", u"b"])
+        self.assertEqual(sorted(self.masks.names(u"nosuchclass", mask)),
+                         [u"a", u"b"])
+        self.assertEqual(self.masks.names(u"nosuchclass2", 7), [])
+
+    def test_subset(self):
+        """Compare the subset checks with those of the sets of names."""
+        big = sorted(self.classes[u"big"])
+        for tclass, names in ((u"file", sorted(CLASSES[u"file"])),
+                              (u"big", big[:3] + big[62:66] + big[97:])):
+            subsets = [set(names[i:j]) for i in range(len(names))
+                       for j in range(i, len(names) + 1)]
+            subsets.extend(set(names[::k]) for k in (2, 3))
+            for perms in subsets:
+                mask = self.masks.mask(tclass, perms)
+                for other in subsets:
+                    other_mask = self.masks.mask(tclass, other)
+                    self.assertEqual(
+                        PermissionMasks.issubset(mask, other_mask),
+                        perms <= other)
+                    self.assertEqual(bool(mask & other_mask),
+                                     bool(perms & other))
+
+    def test_avrule(self):
+        """Check the masks of the AV rules."""
+        rule = Mapper.rule_factory(u"allow a_t b_t:file { read open };")
+        mask = rule.get_permmask(self.masks)
+        self.assertEqual(mask, self.masks.mask(u"file", [u"open", u"read"]))
+        self.assertEqual(rule.get_permmask(self.masks), mask)
+        other = PermissionMasks({u"file": set([u"open", u"read"])})
+        self.assertEqual(rule.get_permmask(other), 3)
+
+
+class LineIndexTest(unittest.TestCase):
+    """Check that the original rules are read back from the policy.conf."""
+
+    content = (b"allow a b:file read; allow a c:dir search;\n"
+               b"allow d e:fd use;\n")
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, u"wb") as policy_conf:
+            policy_conf.write(self.content)
+        self.index = LineIndex(self.path)
+        first = self.content.index(b"\n") + 1
+        self.index.add(u"a.te:1", 0, first, 0)
+        self.index.add(u"a.te:1", 0, first, 1)
+        self.index.add(u"b.te:5", first, len(self.content) - first, 0)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_lines(self):
+        """Check the rules of each file/line."""
+        self.assertEqual(sorted(self.index), [u"a.te:1", u"b.te:5"])
+        self.assertEqual(self.index[u"a.te:1"],
+                         [u"allow a b:file read;", u"allow a c:dir search;"])
+        self.assertEqual(self.index[u"b.te:5"], [u"allow d e:fd use;"])
+
+    def test_removed_file(self):
+        """Check that the rules are still read after the file is removed."""
+        os.remove(self.path)
+        self.assertEqual(self.index[u"b.te:5"], [u"allow d e:fd use;"])
+
+    def test_pickle(self):
+        """Check that an unpickled index reads the file at its new path."""
+        index = pickle.loads(pickle.dumps(self.index))
+        os.rename(self.path, self.path + u".new")
+        self.path += u".new"
+        index.path = self.path
+        self.assertEqual(index[u"a.te:1"],
+                         [u"allow a b:file read;", u"allow a c:dir search;"])
+
+
+def option_set(*options):
+    """Get the (tuple, frozenset) pair of a block expansion."""
+    return (options, frozenset(options))
+
+
+class LazyRulesTest(unittest.TestCase):
+    """Compare the lazy rules with the rules expanded in advance."""
+
+    def setUp(self):
+        domain = option_set(u"a", u"b", u"domain")
+        rules = [
+            LazyRule(u"allow", domain, option_set(u"c", u"d"), OrderedDict(
+                [(u"file", u" read;"), (u"dir", u" search;")])),
+            LazyRule(u"allow", option_set(u"a"), None,
+                     OrderedDict([(u"file", u" write;")])),
+            LazyRule(u"allow", domain, option_set(u"a", u"d"),
+                     OrderedDict([(u"file", u" open;")])),
+            LazyRule(u"neverallow", domain, None,
+                     OrderedDict([(u"file", u" execute;")])),
+            LazyRule(u"type_transition", domain, option_set(u"c"),
+                     OrderedDict([(u"file", u" e;"), (u"dir", u" e;")])),
+        ]
+        self.lazy = LazyRules()
+        # The rules expanded in advance, as the Mapper does without lazy
+        self.expanded = OrderedDict()
+        for n, rule in enumerate(rules):
+            rule.original_rule = u"rule {}".format(n)
+            rule.fileline = u"a.te:{}".format(n)
+            self.lazy.add(rule)
+            for base in rule.bases():
+                tail = rule.tails[base.split(u":")[1]]
+                self.expanded.setdefault(base, []).append(
+                    (base + tail, rule.original_rule, rule.fileline))
+
+    @staticmethod
+    def fields(mapped):
+        """Get the fields of a list of MappedRules."""
+        return [(x.rule, x.original_rule, x.fileline) for x in mapped]
+
+    def test_lookup(self):
+        """Check the bases and their rules."""
+        self.assertEqual(list(self.lazy), list(self.expanded))
+        self.assertEqual(len(self.lazy), len(self.expanded))
+        for base, mapped in iteritems(self.expanded):
+            self.assertIn(base, self.lazy)
+            self.assertEqual(self.fields(self.lazy[base]), mapped)
+        self.assertEqual(len(self.expanded[u"allow a a:file"]), 2)
+        self.assertEqual(len(self.expanded[u"allow a d:file"]), 2)
+        for base in (u"allow c a:file", u"allow b b:file", u"allow a c:blk",
+                     u"allow a c", u"bogus"):
+            self.assertNotIn(base, self.lazy)
+            self.assertIsNone(self.lazy.get(base))
+
+    def test_iteritems(self):
+        """Check the single pass over the items and values."""
+        self.assertEqual(
+            [(k, self.fields(v)) for k, v in iteritems(self.lazy)],
+            list(iteritems(self.expanded)))
+        self.assertEqual([self.fields(v) for v in itervalues(self.lazy)],
+                         list(itervalues(self.expanded)))
+        view = FilteredRules(self.lazy, (u"neverallow",))
+        self.assertEqual(
+            [(k, self.fields(v)) for k, v in iteritems(view)],
+            [x for x in iteritems(self.expanded)
+             if not x[0].startswith(u"neverallow")])
+
+
+if __name__ == u"__main__":
+    unittest.main()
@@ -0,0 +1,444 @@
+#
+#    Written by Filippo Bonazzi
+#    Copyright (C) 2016 Aalto University
+#
+#    This file is part of the policysource library.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this program.  If not, see
+#    <http://www.gnu.org/licenses/>.
+#
+"""Tests of the creation of the policy.conf file and of the policy cache.
+
+The policy.conf made by expanding each policy file separately must be the
+same as the one made by a single m4 run, even for files which do not end
+with a newline.
+A policy loaded from the cache must be the same as the one saved in it.
+The macros are identified by their name and defining file, without m4."""
+
+# Necessary for Python 2/3 compatibility
+from __future__ import absolute_import
+from future.utils import iteritems, itervalues
+
+import copy
+import logging
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import subprocess
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    # Python 2
+    import mock
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+try:
+    from policysource.policy import SourcePolicy
+    from policysource.mapping import LineIndex, Mapper
+except ImportError:
+    # setools is not installed
+    SourcePolicy = None
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           u"macros")
+MACRO_FILES = [u"global_macros", u"neverallow_macros", u"te_macros"]
+# Policy files, some of them without a final newline
+POLICY_FILES = [
+    (u"a.te", b"allow a_t b_t:file r_file_perms;\n"
+              b"domain_auto_trans(a_t, b_exec, b_t)"),
+    (u"b.te", b"allow a_t b_t:dir rw_dir_perms;\ndnl\n"
+              b"allow a_t b_t:file x_file_perms;\n"),
+    (u"c.te", b"dnl no newline"),
+    (u"d.te", b""),
+    (u"e.te", b"\n"),
+    (u"f.te", b"file_type_auto_trans(a_t, b_t, c_t)"),
+    (u"g.te", b"allow c_t b_t:file w_file_perms;\n"
+              b"allow c_t b_t:dir r_dir_perms;"),
+]
+# The symbols used by the policy files
+ATTRIBUTES = {u"domain": set([u"a_t", u"b_t"])}
+TYPES = set([u"a_t", u"b_t", u"b_exec", u"c_t"])
+PERMS = set([u"add_name", u"append", u"create", u"entrypoint", u"execute",
+             u"execute_no_trans", u"getattr", u"ioctl", u"lock", u"open",
+             u"read", u"remove_name", u"rename", u"reparent", u"rlimitinh",
+             u"rmdir", u"search", u"setattr", u"sigchld", u"siginh",
+             u"transition", u"unlink", u"write"])
+CLASSES = dict((x, PERMS) for x in (u"dir", u"fifo_file", u"file",
+                                    u"lnk_file", u"process", u"sock_file"))
+
+
+class PolicyTestCase(unittest.TestCase):
+    """Base class of the tests, working on a copy of the sample policy."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for name in MACRO_FILES:
+            self.files.append(os.path.join(self.tmpdir, name))
+            shutil.copyfile(os.path.join(SAMPLES_DIR, name), self.files[-1])
+        for name, content in POLICY_FILES:
+            self.files.append(os.path.join(self.tmpdir, name))
+            with open(self.files[-1], u"wb") as policy_file:
+                policy_file.write(content)
+        self.cache_dir = os.path.join(self.tmpdir, u"cache")
+        self.policies = []
+
+    def tearDown(self):
+        for policy in self.policies:
+            shutil.rmtree(policy._tmpdir)
+            # Nothing left to remove when the policy is deleted
+            policy._tmpdir = None
+        del self.policies
+        shutil.rmtree(self.tmpdir)
+
+    def new_policy(self, cache_dir=None, parallel_m4=False):
+        """Create an empty SourcePolicy for the policy files, without
+        parsing them."""
+        # pylint: disable=protected-access
+        policy = SourcePolicy.__new__(SourcePolicy)
+        policy.log = logging.getLogger(SourcePolicy.__name__)
+        policy._policyconf = None
+        policy._expander = None
+        policy._macro_defs = None
+        policy._macro_usages = None
+        policy._macros_by_file = None
+        policy._parent = None
+        policy.extra_defs = [u"target_build_variant=user"]
+        policy._cache_dir = cache_dir
+        policy._parallel_m4 = parallel_m4
+        policy._policy_files = self.files
+        policy._tmpdir = tempfile.mkdtemp()
+        self.policies.append(policy)
+        return policy
+
+
+@unittest.skipIf(SourcePolicy is None, u"setools is not installed")
+@unittest.skipUnless(which(u"m4"), u"GNU m4 is not installed")
+class PolicyConfTest(PolicyTestCase):
+    """Compare the policy.conf made by a single m4 run with the one made
+    by expanding each file separately."""
+
+    def policyconf(self, parallel_m4, cache_dir=None):
+        """Create the policy.conf, without parsing the rest of the policy.
+
+        Return its content."""
+        policy = self.new_policy(cache_dir, parallel_m4)
+        policyconf = policy.__create_policyconf__(self.files)
+        self.assertIsNotNone(policyconf)
+        with open(policyconf, u"rb") as pcf:
+            return pcf.read()
+
+    def test_parallel(self):
+        """Compare the outputs, with the files in different orders."""
+        orders = [self.files, self.files[:3] + self.files[:2:-1],
+                  self.files[:3] + self.files[4:] + self.files[3:4]]
+        for files in orders:
+            self.files = files
+            expected = self.policyconf(False)
+            self.assertIn(b"allow a_t b_t:process transition;", expected)
+            self.assertEqual(self.policyconf(True), expected)
+            self.assertEqual(self.policyconf(True, self.cache_dir), expected)
+            # The second time, the outputs are read from the cache
+            self.assertEqual(self.policyconf(True, self.cache_dir), expected)
+
+    def test_cache_invalidation(self):
+        """Check that the cached outputs are not used after a macro file
+        changes."""
+        expected = self.policyconf(False)
+        self.assertEqual(self.policyconf(True, self.cache_dir), expected)
+        cached = os.listdir(os.path.join(self.cache_dir, u"m4"))
+        with open(self.files[0], u"ab") as macro_file:
+            macro_file.write(b"define(`r_file_perms', `{ read }')\n")
+        changed = self.policyconf(False)
+        self.assertNotEqual(changed, expected)
+        self.assertIn(b"allow a_t b_t:file { read };", changed)
+        self.assertEqual(self.policyconf(True, self.cache_dir), changed)
+        # Every output depends on the first macro file
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.cache_dir, u"m4"))),
+            2 * len(cached))
+
+
+@unittest.skipIf(SourcePolicy is None, u"setools is not installed")
+@unittest.skipUnless(which(u"m4"), u"GNU m4 is not installed")
+class CacheTest(PolicyTestCase):
+    """Save the parsed policy in the cache and load it back."""
+
+    def parsed_policy(self):
+        """Parse the policy files, as the SourcePolicy constructor does,
+        with the sample symbols instead of those of the binary policy."""
+        # pylint: disable=protected-access
+        policy = self.new_policy(self.cache_dir)
+        policy._macro_defs = policy.__find_macro_defs__(self.files)
+        policy._macro_usages = policy.__find_macro_usages__(
+            self.files, policy._macro_defs)
+        policy.__prefetch_macro_expansions__(policy._macro_usages)
+        policy._policyconf = policy.__create_policyconf__(self.files)
+        policy._attributes = ATTRIBUTES
+        policy._types = TYPES
+        policy._classes = CLASSES
+        policy._mapping = Mapper(policy.policyconf, ATTRIBUTES, TYPES,
+                                 CLASSES).get_mapping()
+        self.assertTrue(policy.macro_usages)
+        self.assertTrue(policy.mapping.rules)
+        return policy
+
+    @staticmethod
+    def mapping_fields(mapping):
+        """Get the rules and lines of a mapping as plain dictionaries."""
+        rules = dict((k, [(x.rule, x.original_rule, x.fileline) for x in v])
+                     for k, v in iteritems(mapping.rules))
+        lines = dict((k, list(mapping.lines[k])) for k in mapping.lines)
+        return rules, lines
+
+    def test_round_trip(self):
+        """Check that the loaded policy is the same as the saved one."""
+        # pylint: disable=protected-access
+        saved = self.parsed_policy()
+        key = saved.__cache_key__(False, False)
+        saved.__save_cache__(self.cache_dir, key)
+        self.assertTrue(os.path.isdir(os.path.join(self.cache_dir, key)))
+        loaded = self.new_policy(self.cache_dir)
+        self.assertTrue(loaded.__load_cache__(self.cache_dir, key))
+        # The mapping reads the lines from the loaded policy.conf
+        self.assertNotEqual(loaded.policyconf, saved.policyconf)
+        self.assertIsInstance(loaded.mapping.lines, LineIndex)
+        self.assertEqual(loaded.mapping.lines.path, loaded.policyconf)
+        with open(loaded.policyconf, u"rb") as lpc:
+            with open(saved.policyconf, u"rb") as spc:
+                self.assertEqual(lpc.read(), spc.read())
+        self.assertEqual(self.mapping_fields(loaded.mapping),
+                         self.mapping_fields(saved.mapping))
+        self.assertEqual(
+            (loaded.attributes, loaded.types, loaded.classes),
+            (ATTRIBUTES, TYPES, CLASSES))
+        self.assertEqual(
+            [(str(x), x.file_used, x.line_used, x.expansion)
+             for x in loaded.macro_usages],
+            [(str(x), x.file_used, x.line_used, x.expansion)
+             for x in saved.macro_usages])
+        self.assertEqual(sorted(loaded.macro_defs),
+                         sorted(saved.macro_defs))
+        # The loaded macros expand with a new expander
+        args = [u"x_t", u"y_exec", u"y_t"]
+        for name in (u"domain_auto_trans", u"r_file_perms"):
+            self.assertEqual(loaded.macro_defs[name].expand(args),
+                             saved.macro_defs[name].expand(args))
+        dynamic = loaded.macro_defs[u"domain_auto_trans"]
+        self.assertIsNot(dynamic._expander,
+                         saved.macro_defs[u"domain_auto_trans"]._expander)
+
+    def test_corrupt(self):
+        """Check that a truncated entry is not loaded, and is removed."""
+        saved = self.parsed_policy()
+        key = saved.__cache_key__(False, False)
+        saved.__save_cache__(self.cache_dir, key)
+        pickled = os.path.join(self.cache_dir, key, u"policy.pickle")
+        with open(pickled, u"rb") as cfile:
+            content = cfile.read()
+        with open(pickled, u"wb") as cfile:
+            cfile.write(content[:len(content) // 2])
+        loaded = self.new_policy(self.cache_dir)
+        self.assertFalse(loaded.__load_cache__(self.cache_dir, key))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, key)))
+
+    def test_cache_key(self):
+        """Check that the key changes with the options and the content of
+        the policy files."""
+        policy = self.new_policy(self.cache_dir)
+        key = policy.__cache_key__(False, False)
+        self.assertTrue(policy.regex_cache_key.match(key))
+        self.assertEqual(policy.__cache_key__(False, False), key)
+        keys = set([key, policy.__cache_key__(True, False),
+                    policy.__cache_key__(False, True)])
+        policy.extra_defs = [u"target_build_variant=eng"]
+        keys.add(policy.__cache_key__(False, False))
+        policy.extra_defs = []
+        keys.add(policy.__cache_key__(False, False))
+        with open(self.files[-1], u"ab") as policy_file:
+            policy_file.write(b"\n")
+        keys.add(policy.__cache_key__(False, False))
+        self.assertEqual(len(keys), 6)
+
+    def test_prune(self):
+        """Check that only the most recently used entries are kept."""
+        policy = self.new_policy(self.cache_dir)
+        os.makedirs(self.cache_dir)
+        entries = [u"{:064x}".format(i) for i in range(10)]
+        others = [u"m4", u"tmpabcdef", u"{:063x}".format(0)]
+        now = time.time()
+        for i, name in enumerate(entries + others):
+            path = os.path.join(self.cache_dir, name)
+            os.mkdir(path)
+            # Older entries first
+            os.utime(path, (now - 1000 + i, now - 1000 + i))
+        # A recently used entry is kept
+        os.utime(os.path.join(self.cache_dir, entries[0]), None)
+        policy.__prune_cache__(self.cache_dir, policy.cache_entries)
+        kept = [entries[0]] + entries[-policy.cache_entries + 1:]
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted(kept + others))
+
+
+@unittest.skipIf(SourcePolicy is None, u"setools is not installed")
+class PipelineTest(unittest.TestCase):
+    """Run stub construction stages through the pipeline."""
+
+    def setUp(self):
+        # pylint: disable=protected-access
+        self.policy = SourcePolicy.__new__(SourcePolicy)
+        self.policy.log = logging.getLogger(SourcePolicy.__name__)
+        # There is nothing to clean up on deletion, as for a view
+        self.policy._parent = self.policy
+        self.called = []
+
+    def stage(self, name, result):
+        """Get a stage function recording its call and arguments."""
+        def function(*args):
+            """Record the call, and return the result."""
+            self.called.append((name, args))
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return function
+
+    def test_dependencies(self):
+        """Check that the stages get the results of their dependencies, and
+        that the stages depending on a failed stage are skipped."""
+        results = self.policy.__run_pipeline__([
+            (u"a", self.stage(u"a", 1), []),
+            (u"b", self.stage(u"b", 2), [u"a"]),
+            (u"c", self.stage(u"c", 3), [u"a", u"b"]),
+            (u"independent", self.stage(u"independent", 4), []),
+            (u"failed", self.stage(u"failed", None), []),
+            (u"skipped", self.stage(u"skipped", 5), [u"a", u"failed"])])
+        self.assertEqual(results, {u"a": 1, u"b": 2, u"c": 3,
+                                   u"independent": 4, u"failed": None,
+                                   u"skipped": None})
+        self.assertEqual(sorted(self.called), [
+            (u"a", ()), (u"b", (1,)), (u"c", (1, 2)), (u"failed", ()),
+            (u"independent", ())])
+
+    def test_exception(self):
+        """Check that an exception raised by a stage reaches the caller,
+        after the other stages are done."""
+        error = ValueError(u"stage error")
+        with self.assertRaises(ValueError) as context:
+            self.policy.__run_pipeline__([
+                (u"a", self.stage(u"a", 1), []),
+                (u"raises", self.stage(u"raises", error), [u"a"]),
+                (u"after", self.stage(u"after", 2), [u"raises"]),
+                (u"independent", self.stage(u"independent", 3), [])])
+        self.assertIs(context.exception, error)
+        self.assertEqual(sorted(self.called), [
+            (u"a", ()), (u"independent", ()), (u"raises", (1,))])
+
+
+@unittest.skipIf(SourcePolicy is None, u"setools is not installed")
+@unittest.skipUnless(which(u"m4"), u"GNU m4 is not installed")
+class MacroRegistryTest(PolicyTestCase):
+    """Check the identity of the macros and the registry of the macros by
+    defining file."""
+
+    def parsed_macros(self):
+        """Parse the macro definitions, and create a SourcePolicy with them.
+
+        Return the SourcePolicy."""
+        # pylint: disable=protected-access
+        policy = self.new_policy()
+        policy._macro_defs = policy.__find_macro_defs__(self.files)
+        self.assertTrue(policy.macro_defs)
+        return policy
+
+    def test_identity(self):
+        """Check that the macros parsed twice are equal, without running
+        m4."""
+        # pylint: disable=protected-access
+        first = self.parsed_macros()
+        second = self.parsed_macros()
+        with mock.patch.object(subprocess, u"Popen",
+                               side_effect=AssertionError(u"m4 was run")):
+            for name, macro in iteritems(first.macro_defs):
+                other = second.macro_defs[name]
+                self.assertIsNot(macro, other)
+                self.assertEqual(hash(macro), hash(other))
+                self.assertEqual(macro, other)
+                self.assertIn(other, set([macro]))
+            # A macro with the same name in another file is a different one
+            macro = first.macro_defs[u"r_file_perms"]
+            moved = copy.copy(macro)
+            moved._file_defined = macro.file_defined + u".moved"
+            self.assertNotEqual(hash(moved), hash(macro))
+            self.assertNotIn(moved, set(itervalues(first.macro_defs)))
+
+    def test_macros_defined_in(self):
+        """Check the macros registered by defining file, and their set
+        membership, without running m4."""
+        policy = self.parsed_macros()
+        other = self.parsed_macros()
+        with mock.patch.object(subprocess, u"Popen",
+                               side_effect=AssertionError(u"m4 was run")):
+            for name in (u"te_macros", u"global_macros", u"no_macros"):
+                selected = policy.macros_defined_in(name)
+                self.assertEqual(
+                    selected,
+                    set(x for x in itervalues(policy.macro_defs)
+                        if x.file_defined.endswith(name)))
+                for macro in itervalues(other.macro_defs):
+                    self.assertEqual(macro in selected,
+                                     macro.file_defined.endswith(name))
+            self.assertEqual(
+                sum(len(x) for x in itervalues(policy.macros_by_file)),
+                len(policy.macro_defs))
+        self.assertTrue(policy.macros_defined_in(u"te_macros"))
+
+
+@unittest.skipIf(SourcePolicy is None, u"setools is not installed")
+class ViewTest(unittest.TestCase):
+    """Check the data shared by a policy and its view without
+    neverallows."""
+
+    def test_permission_masks(self):
+        """Check that the view uses the permission masks of the policy."""
+        # pylint: disable=protected-access
+        policy = SourcePolicy.__new__(SourcePolicy)
+        policy.log = logging.getLogger(SourcePolicy.__name__)
+        policy._parent = None
+        policy._classes = CLASSES
+        policy._permission_masks = None
+        policy._mapping = Mapper(u"policy.conf", ATTRIBUTES, TYPES,
+                                 CLASSES).get_mapping(lines=[
+                                     u"allow a_t b_t:file read;\n",
+                                     u"neverallow a_t b_t:file write;\n"])
+        view = policy.without_neverallows()
+        self.assertIs(view.permission_masks, policy.permission_masks)
+        self.assertEqual(list(view.mapping.rules),
+                         [u"allow a_t b_t:file"])
+        # Nothing to clean up on deletion
+        policy._parent = policy
+
+
+if __name__ == u"__main__":
+    unittest.main()
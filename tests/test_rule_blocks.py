@@ -0,0 +1,195 @@
+#
+#    Written by Filippo Bonazzi
+#    Copyright (C) 2016 Aalto University
+#
+#    This file is part of the policysource library.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this program.  If not, see
+#    <http://www.gnu.org/licenses/>.
+#
+"""Differential tests of Mapper.get_rule_blocks against the character by
+character rule parser, which it used for every rule before tokenizing the
+common rules with a regex.
+
+The rules are hand-written corner cases, fuzzed rules, and the rules of the
+sample macros in tests/macros, or the rules of the policy.conf named by the
+SELINT_POLICY_CONF environment variable, e.g. one written by
+"selint --dumppolicyconf"."""
+
+# Necessary for Python 2/3 compatibility
+from __future__ import absolute_import
+from builtins import range
+from io import open
+
+import os
+import os.path
+import random
+import re
+import sys
+import unittest
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from policysource.macro import M4MacroExpander
+from policysource.mapping import Mapper
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           u"macros")
+SAMPLE_FILES = [os.path.join(SAMPLES_DIR, x) for x in
+                (u"global_macros", u"neverallow_macros", u"te_macros")]
+
+# Corner cases of the rule syntax, valid and invalid
+RULES = [
+    u"allow a b:file { read write };",
+    u"allow a b:file read;",
+    u"allow a self:capability { chown  dac_override };",
+    u"allow {a b} {c}:d *;",
+    u"allow a { b { c d } }:e f;",
+    u"allow a b:c {};",
+    u"allow a b:c { };",
+    u"allow a\tb:c d;",
+    u"allow a b:c d",
+    u"allow a b:c d;;",
+    u"allow a b : c d;",
+    u"allow a ~b:c d;",
+    u"allow a b:c ~;",
+    u"allow a b:c ~{ d e };",
+    u"allow a b}:c {d;",
+    u"allow a b:c { d } e;",
+    u"allow a b:{ c d } { e f };",
+    u"allowa b:c d;",
+    u"allow",
+    u"neverallow { domain -init } ~{ a b }:{ file dir } ~{ read };",
+    u"neverallow { domain { -init -kernel } } self:process *;",
+    u"neverallow a { b ~c }:d e;",
+    u"type_transition a b:file c;",
+    u"type_transition a b:file c \"name\";",
+    u"type_transition a b:{ file dir } c name;",
+    u"allowxperm a b:ioctl { 0x8910 0x8912-0x8915 };",
+    u"allowxperm a b:ioctl ~{ 0x8910 };",
+]
+
+# Characters of the fuzzed rules
+FUZZ_ALPHABET = u"ab {}~;:\t-*"
+
+regex_define = re.compile(r"define\(`([a-zA-Z_][a-zA-Z0-9_]*)'")
+
+
+def reference_rule_blocks(rule):
+    """Split a rule in blocks like get_rule_blocks did before the regex
+    tokenizer, parsing every rule character by character."""
+    if rule.count(u"{") != rule.count(u"}"):
+        raise ValueError(u"Mismatched separators in \"{}\"".format(rule))
+    rule_type, rule_early_split = rule.split(u" ", 1)
+    # pylint: disable=protected-access
+    return Mapper._Mapper__parse_rule_blocks(
+        rule, rule_type, rule_early_split.rstrip(u";").replace(u":", u" "))
+
+
+def rule_blocks(function, rule):
+    """Split a rule in blocks with a function.
+
+    Return the blocks, or the type and message of the exception raised."""
+    try:
+        return function(rule)
+    except ValueError as e:
+        return (type(e), str(e))
+
+
+def fuzzed_rules(count, seed=1):
+    """Generate random rules from the characters of the rule syntax."""
+    rng = random.Random(seed)
+    rules = []
+    for _ in range(count):
+        rules.append(u"allow " + u"".join(
+            rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(0, 14))))
+    return rules
+
+
+def policy_rules(lines):
+    """Get the supported rules of some policy.conf lines.
+
+    A rule starts on a line beginning with a supported rule type, and may
+    continue on the following lines up to a line ending with a semicolon."""
+    rules = []
+    group = []
+    for line in lines:
+        stripped = line.split(u"#")[0].strip()
+        if not group and not stripped.startswith(Mapper.supported_rules):
+            continue
+        group.append(line)
+        if stripped.endswith(u";"):
+            rules.extend(x for x in Mapper.split_group(group)
+                         if x.startswith(Mapper.supported_rules))
+            group = []
+    return rules
+
+
+def sample_rules():
+    """Get the rules of the sample macros, expanded with m4."""
+    with open(SAMPLE_FILES[-1], u"r", encoding=u"utf-8") as mfile:
+        names = regex_define.findall(mfile.read())
+    expander = M4MacroExpander(SAMPLE_FILES, None,
+                               [u"target_build_variant=eng"],
+                               coprocess=False, interpreter=False)
+    texts = [u"{}(a, b, c, d, e, f)".format(x) for x in names]
+    texts.append(u"".join(u"allow a b:{} {};\n".format(x, y) for x, y in (
+        (u"file_class_set", u"create_file_perms"),
+        (u"socket_class_set", u"create_socket_perms"),
+        (u"dir_file_class_set", u"rwx_file_perms"),
+        (u"capability_class_set", u"*"))))
+    return policy_rules(expander.expand(u"\n".join(texts)).splitlines())
+
+
+class RuleBlocksTest(unittest.TestCase):
+    """Compare get_rule_blocks with the character by character parser."""
+
+    def check(self, rules):
+        """Split the rules with both parsers, and compare the blocks."""
+        self.assertTrue(rules)
+        for rule in rules:
+            self.assertEqual(rule_blocks(Mapper.get_rule_blocks, rule),
+                             rule_blocks(reference_rule_blocks, rule),
+                             u"Mismatch splitting \"{}\"".format(rule))
+
+    def test_corner_cases(self):
+        """Split valid and invalid corner cases."""
+        self.check(RULES)
+
+    def test_fuzzed_rules(self):
+        """Split random rules."""
+        self.check(fuzzed_rules(20000))
+
+    @unittest.skipUnless(which(u"m4"), u"GNU m4 is not installed")
+    def test_sample_rules(self):
+        """Split the rules of the sample macros."""
+        self.check(sample_rules())
+
+    @unittest.skipUnless(os.environ.get(u"SELINT_POLICY_CONF"),
+                         u"SELINT_POLICY_CONF is not set")
+    def test_policy_conf(self):
+        """Split every rule of a policy.conf."""
+        with open(os.environ[u"SELINT_POLICY_CONF"], u"r",
+                  encoding=u"utf-8") as policy_conf:
+            self.check(policy_rules(policy_conf))
+
+
+if __name__ == u"__main__":
+    unittest.main()
@@ -0,0 +1,532 @@
+#
+#    Written by Filippo Bonazzi
+#    Copyright (C) 2016 Aalto University
+#
+#    This file is part of the policysource library.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this program.  If not, see
+#    <http://www.gnu.org/licenses/>.
+#
+"""Tests of the te_macros plugin.
+
+The rules found by the rule index are checked on a small policy.
+The suggestions of the join matcher are compared with those of the worklist
+matcher on a policy made of usages of the sample macros in tests/macros:
+complete usages, usages missing some rules, and usages repeating the same
+argument; and on fuzzed macros and usages.
+The rule index is compared with setools on the binary policy compiled from
+the same small policy, where setools is installed.
+The subset pruning is compared with the pairwise comparison of random
+suggestions."""
+
+# Necessary for Python 2/3 compatibility
+from __future__ import absolute_import
+from future.utils import itervalues
+
+import logging
+import os
+import os.path
+import random
+import re
+import sys
+import tempfile
+import unittest
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import policysource.mapping
+from policysource.macro_plugins import M4MacroParser
+try:
+    import setools.policyrep
+    import plugins.te_macros as te_macros
+except ImportError:
+    # setools is not installed
+    te_macros = None
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           u"macros")
+SAMPLE_FILES = [os.path.join(SAMPLES_DIR, x) for x in
+                (u"global_macros", u"neverallow_macros", u"te_macros")]
+
+# Thresholds to compare the matchers with
+THRESHOLDS = (0.8, 0.5)
+
+# Placeholder rules of the fuzzed macros
+FUZZ_TEMPLATES = [
+    u"allow @@ARG0@@ @@ARG1@@:file { open read };",
+    u"allow @@ARG0@@ @@ARG1@@:dir search;",
+    u"type_transition @@ARG0@@ @@ARG1@@:file @@ARG2@@;",
+    u"allow @@ARG0@@ @@ARG2@@:file create;",
+    u"allow @@ARG2@@ @@ARG1@@:file entrypoint;",
+    u"allow @@ARG0@@ @@ARG2@@:process transition;",
+    u"allow @@ARG0@@ @@ARG0@@_tmpfs:file execute;",
+    u"allow @@ARG1@@ @@ARG0@@:fd use;",
+    u"allow @@ARG0@@ @@ARG1@@:file { open read write };",
+]
+
+regex_placeholder = re.compile(r"@@ARG([0-9]+)@@")
+
+
+class FuzzedMacro(object):
+    """The parts of a M4Macro used by the suggestions."""
+
+    def __init__(self, name, nargs):
+        self.name = name
+        self.nargs = nargs
+
+
+class Policy(object):
+    """The parts of a SourcePolicy used by the te_macros plugin."""
+
+    def __init__(self, attributes, types, classes, lines):
+        self.attributes = attributes
+        self.types = types
+        self.classes = classes
+        self.permission_masks = policysource.mapping.PermissionMasks(classes)
+        mapper = policysource.mapping.Mapper(u"policy.conf", attributes,
+                                             types, classes)
+        self.mapping = mapper.get_mapping(lines=lines)
+
+
+def policy_symbols(lines):
+    """Get the types, classes and permissions used by some policy lines.
+
+    Return a tuple (set(types), {class: set(perms)})."""
+    types = set()
+    classes = {}
+    for line in lines:
+        line = line.strip()
+        if not line.startswith(policysource.mapping.ONLY_MAP_RULES):
+            continue
+        blocks = policysource.mapping.Mapper.get_rule_blocks(line)
+        perms = set()
+        if blocks[0] in policysource.mapping.AVRULES:
+            perms.update(x for x in blocks[4].strip(u"{}").split()
+                         if x not in u"~*")
+            type_blocks = blocks[1:3]
+        else:
+            type_blocks = blocks[1:3] + blocks[4:5]
+        for block in type_blocks:
+            types.update(x.lstrip(u"~-") for x in block.strip(u"~{}").split()
+                         if x != u"self")
+        for cls in blocks[3].strip(u"{}").split():
+            classes.setdefault(cls, set()).update(perms)
+    return (types, classes)
+
+
+def sample_policy(macros):
+    """Write a policy made of usages of the macros.
+
+    Return the policy.conf lines."""
+    lines = [u"#line 1 \"usages.te\"\n"]
+    for k, m in enumerate(sorted(macros, key=lambda x: x.name)):
+        if not m.nargs:
+            continue
+        usages = [
+            # Complete usages, sharing their first argument
+            ([u"m{}_a{}".format(k, i) for i in range(m.nargs)], 1),
+            ([u"m{}_a0".format(k)] + [u"m{}_b{}".format(k, i)
+                                      for i in range(1, m.nargs)], 1),
+            # A usage missing every other rule
+            ([u"m{}_c{}".format(k, i) for i in range(m.nargs)], 2),
+            # A usage repeating the same argument
+            ([u"m{}_d".format(k)] * m.nargs, 1),
+        ]
+        for args, step in usages:
+            expansion = [x for x in m.expand(args).splitlines()
+                         if x.strip().startswith(
+                             policysource.mapping.ONLY_MAP_RULES)]
+            lines.extend(x + u"\n" for x in expansion[::step])
+    return lines
+
+
+def fuzzed_usages(rng, templates):
+    """Get the rules of random usages of some placeholder rules, some of
+    them missing or granting extra permissions."""
+    values = [[u"{}{}".format(x, i) for i in range(rng.randint(1, 3))]
+              for x in u"dtn"]
+    rules = []
+    for _ in range(rng.randint(1, 4)):
+        args = [rng.choice(x) for x in values]
+        for template in templates:
+            if rng.random() < 0.15:
+                continue
+            rule = regex_placeholder.sub(lambda x: args[int(x.group(1))],
+                                         template)
+            if rng.random() < 0.3:
+                rule = rule.replace(u"{ open read }", u"{ getattr open read }")
+            if rule not in rules:
+                rules.append(rule)
+    rng.shuffle(rules)
+    return rules
+
+
+def final(suggestions):
+    """Get the suggestions kept by the plugin, as comparable tuples.
+
+    Two suggestions are the same if they fill the same placeholder rules of
+    the same macro (see MacroSuggestion.__eq__): when several policy rules
+    can fill a placeholder rule, the matchers may pick different ones."""
+    suggestions = set(suggestions)
+    for x in te_macros.find_subsets(suggestions):
+        suggestions.remove(x)
+    return sorted((x.usage, x.score, sorted(x.filled_placeholder_rules))
+                  for x in suggestions)
+
+
+@unittest.skipIf(te_macros is None, u"setools is not installed")
+@unittest.skipUnless(which(u"m4"), u"GNU m4 is not installed")
+class SuggestionMatcherTest(unittest.TestCase):
+    """Compare the join and worklist suggestion matchers."""
+
+    def setUp(self):
+        self.parser = M4MacroParser(extra_defs=[])
+        self.macros = [x for x in itervalues(self.parser.parse(SAMPLE_FILES))
+                       if x.file_defined == SAMPLE_FILES[-1]]
+        self.assertTrue(self.macros)
+        lines = sample_policy(self.macros)
+        types, classes = policy_symbols(lines)
+        self.policy = Policy({u"domain": set()}, types, classes, lines)
+        # Setup the plugin globals, as main() does
+        self.threshold = te_macros.plugin_conf.SUGGESTION_THRESHOLD
+        te_macros.LOG = logging.getLogger(te_macros.__name__)
+        te_macros.MAPPER = policysource.mapping.Mapper(
+            u"policy.conf", self.policy.attributes, types, classes)
+        te_macros.PERMISSION_MASKS = self.policy.permission_masks
+        self.index = te_macros.RuleIndex(self.policy)
+
+    def tearDown(self):
+        te_macros.plugin_conf.SUGGESTION_THRESHOLD = self.threshold
+
+    def check(self, m, initial, overall_rules):
+        """Run both matchers, and compare the suggestions.
+
+        Return the number of suggestions."""
+        worklist = te_macros.fit_suggestions(
+            set([te_macros.MacroSuggestion(m, initial.placeholder_rules)]),
+            list(overall_rules))
+        join = te_macros.join_suggestions(initial, overall_rules)
+        self.assertEqual(final(join), final(worklist),
+                         u"Mismatch on \"{}\"".format(m.name))
+        return len(join)
+
+    def test_sample_macros(self):
+        """Compare the suggestions for the sample macros."""
+        found = 0
+        for threshold in THRESHOLDS:
+            te_macros.plugin_conf.SUGGESTION_THRESHOLD = threshold
+            for m in self.macros:
+                rules, suggestions = te_macros.process_macro(
+                    m, te_macros.MAPPER)
+                overall_rules = []
+                for r in itervalues(rules):
+                    overall_rules.extend(self.index.query(r) or [])
+                found += self.check(m, suggestions.pop(), overall_rules)
+        self.assertTrue(found)
+
+    def test_fuzzed_macros(self):
+        """Compare the suggestions for random macros and usages."""
+        rng = random.Random(1)
+        for n in range(600):
+            te_macros.plugin_conf.SUGGESTION_THRESHOLD = THRESHOLDS[n % 2]
+            templates = rng.sample(FUZZ_TEMPLATES, rng.randint(2, 6))
+            if rng.random() < 0.2:
+                # A macro repeating a rule
+                templates.append(templates[0])
+            nargs = max(int(x) for t in templates
+                        for x in regex_placeholder.findall(t)) + 1
+            m = FuzzedMacro(u"m{}".format(n), nargs)
+            initial = te_macros.MacroSuggestion(m, templates)
+            rules = [te_macros.IndexedRule(te_macros.MAPPER.rule_factory(x))
+                     for x in fuzzed_usages(rng, templates)]
+            # Like the policy queries, find the rules once per placeholder
+            overall_rules = []
+            for e in itervalues(initial.extractors):
+                overall_rules.extend(x for x in rules if e.match_rule(x))
+            self.check(m, initial, overall_rules)
+
+
+@unittest.skipIf(te_macros is None, u"setools is not installed")
+class FindSubsetsTest(unittest.TestCase):
+    """Compare the subset pruning through the rule index with the pairwise
+    comparison of the suggestions."""
+
+    @staticmethod
+    def pairwise_subsets(suggestions):
+        """Find the suggestions which are a strict subset of another with an
+        equal or greater score, comparing every pair."""
+        return [x for x in suggestions
+                if any(x < y for y in suggestions if x.score <= y.score)]
+
+    def test_random_suggestions(self):
+        """Compare the subsets found among random suggestions."""
+        rng = random.Random(1)
+        found = 0
+        for n in range(300):
+            macros = []
+            for i in range(rng.randint(1, 3)):
+                templates = rng.sample(FUZZ_TEMPLATES, rng.randint(1, 5))
+                nargs = max(int(x) for t in templates
+                            for x in regex_placeholder.findall(t)) + 1
+                macros.append((FuzzedMacro(u"m{}".format(i), nargs),
+                               templates))
+            suggestions = []
+            for _ in range(rng.randint(1, 40)):
+                m, templates = rng.choice(macros)
+                # The suggestions are filled directly, without extractors
+                sug = te_macros.MacroSuggestion(m, templates, {})
+                # Fill some of the rules, with some of the arguments
+                filled = rng.sample(templates,
+                                    rng.randint(0, len(templates)))
+                args = dict((u"arg{}".format(i), u"a{}_t".format(i))
+                            for i in range(m.nargs) if rng.random() < 0.7)
+                if filled:
+                    sug.fill(dict((r, r) for r in filled), args)
+                suggestions.append(sug)
+            expected = self.pairwise_subsets(suggestions)
+            subsets = te_macros.find_subsets(suggestions)
+            self.assertEqual([id(x) for x in subsets],
+                             [id(x) for x in expected])
+            found += len(subsets)
+        self.assertTrue(found)
+
+
+# The policy of the rule index tests
+INDEX_POLICY = u"""#line 1 "index.te"
+allow a_t b_t:file { read open };
+allow a_t b_t:file getattr;
+allow { a_t c_t } b_t:dir search;
+allow domain b_t:fd use;
+allow domain self:process fork;
+allow { domain -c_t } d_t:file write;
+allow ~a_t e_t:file read;
+dontaudit a_t b_t:file write;
+type_transition a_t b_t:file f_t;
+type_transition a_t b_t:file g_t "name";
+type_transition a_t b_t:dir f_t;
+type_transition domain b_t:process f_t;
+neverallow a_t b_t:file execute;
+"""
+
+
+@unittest.skipIf(te_macros is None, u"setools is not installed")
+class RuleIndexTest(unittest.TestCase):
+    """Check the rules found by the rule index, which must be those setools
+    would find in the binary policy."""
+
+    def setUp(self):
+        lines = INDEX_POLICY.splitlines(True)
+        types, classes = policy_symbols(lines)
+        types.discard(u"domain")
+        self.policy = Policy({u"domain": set([u"a_t", u"c_t"])}, types,
+                             classes, lines)
+        te_macros.MAPPER = policysource.mapping.Mapper(
+            u"policy.conf", self.policy.attributes, types, classes)
+        te_macros.PERMISSION_MASKS = self.policy.permission_masks
+        self.index = te_macros.RuleIndex(self.policy)
+
+    def query(self, rule):
+        """Query the index with a rule, whose "@" fields match any
+        argument."""
+        rule = rule.replace(u"@", te_macros.VALID_ARG_R)
+        results = self.index.query(te_macros.MAPPER.rule_factory(rule))
+        return sorted(str(x) for x in results)
+
+    def test_permissions(self):
+        """Check that the permissions of the same rule are merged."""
+        self.assertEqual(self.query(u"allow a_t b_t:file { open read };"),
+                         [u"allow a_t b_t:file { getattr open read };"])
+        self.assertEqual(self.query(u"allow a_t b_t:file getattr;"),
+                         [u"allow a_t b_t:file { getattr open read };"])
+        self.assertEqual(self.query(u"allow a_t b_t:file { read write };"),
+                         [])
+        # The rule types are kept apart, and neverallows are not indexed
+        self.assertEqual(self.query(u"dontaudit @ @:file write;"),
+                         [u"dontaudit a_t b_t:file write;"])
+        self.assertEqual(self.query(u"allow a_t b_t:file execute;"), [])
+        rule = self.index.query(te_macros.MAPPER.rule_factory(
+            u"allow a_t b_t:file read;"))[0]
+        self.assertEqual(rule.perms, frozenset([u"getattr", u"open",
+                                                u"read"]))
+        self.assertEqual(rule.permmask, self.policy.permission_masks.mask(
+            u"file", rule.perms))
+
+    def test_sets(self):
+        """Check that sets are split, and attributes kept."""
+        self.assertEqual(self.query(u"allow @ b_t:dir search;"),
+                         [u"allow a_t b_t:dir search;",
+                          u"allow c_t b_t:dir search;"])
+        self.assertEqual(self.query(u"allow @ b_t:fd use;"),
+                         [u"allow domain b_t:fd use;"])
+        self.assertEqual(self.query(u"allow a_t b_t:fd use;"), [])
+
+    def test_self(self):
+        """Check that "self" is expanded to each type of the source."""
+        expected = [u"allow a_t a_t:process fork;",
+                    u"allow c_t c_t:process fork;"]
+        self.assertEqual(self.query(u"allow @ self:process fork;"), expected)
+        self.assertEqual(self.query(u"allow @ @:process fork;"), expected)
+        self.assertEqual(self.query(u"allow domain self:process fork;"), [])
+
+    def test_complements(self):
+        """Check that complements and subtractions are expanded to types."""
+        self.assertEqual(self.query(u"allow @ d_t:file write;"),
+                         [u"allow a_t d_t:file write;"])
+        self.assertEqual(
+            self.query(u"allow @ e_t:file read;"),
+            [u"allow {} e_t:file read;".format(x) for x in
+             (u"b_t", u"c_t", u"d_t", u"e_t", u"f_t", u"g_t")])
+
+    def test_type_transitions(self):
+        """Check the type transitions, with and without object name."""
+        self.assertEqual(self.query(u"type_transition a_t b_t:file @;"),
+                         [u"type_transition a_t b_t:file f_t;",
+                          u"type_transition a_t b_t:file g_t \"name\";"])
+        self.assertEqual(self.query(u"type_transition @ @:dir f_t;"),
+                         [u"type_transition a_t b_t:dir f_t;"])
+        rules = self.index.query(te_macros.MAPPER.rule_factory(
+            u"type_transition a_t b_t:file g_t;"))
+        self.assertEqual([x.filename for x in rules], [u"name"])
+        self.assertEqual(rules[0].default, u"g_t")
+        self.assertIsNone(rules[0].perms)
+        rules = self.index.query(te_macros.MAPPER.rule_factory(
+            u"type_transition a_t b_t:file f_t;"))
+        self.assertRaises(ValueError, getattr, rules[0], u"filename")
+
+    def test_type_transition_attributes(self):
+        """Check that the attributes of the type transitions are expanded
+        to their types."""
+        self.assertEqual(self.query(u"type_transition @ b_t:process f_t;"),
+                         [u"type_transition a_t b_t:process f_t;",
+                          u"type_transition c_t b_t:process f_t;"])
+        self.assertEqual(
+            self.query(u"type_transition domain b_t:process f_t;"), [])
+
+    def test_duplicate_type_transitions(self):
+        """Check that a type transition found in several places is indexed
+        once."""
+        lines = [u"#line 1 \"dup.te\"\n",
+                 u"type_transition a_t b_t:process f_t;\n",
+                 u"type_transition { a_t c_t } b_t:process f_t;\n",
+                 u"type_transition domain b_t:process f_t;\n"]
+        types, classes = policy_symbols(lines)
+        types.discard(u"domain")
+        policy = Policy({u"domain": set([u"a_t", u"c_t"])}, types, classes,
+                        lines)
+        self.assertEqual(
+            len(policy.mapping.rules[u"type_transition a_t b_t:process"]), 3)
+        index = te_macros.RuleIndex(policy)
+        results = index.query(te_macros.MAPPER.rule_factory(
+            u"type_transition @ b_t:process f_t;".replace(
+                u"@", te_macros.VALID_ARG_R)))
+        self.assertEqual(sorted(str(x) for x in results),
+                         [u"type_transition a_t b_t:process f_t;",
+                          u"type_transition c_t b_t:process f_t;"])
+
+
+def compilable_policy(lines, attributes, types, classes):
+    """Add to some policy lines the declarations and the users which
+    checkpolicy needs to compile them, without MLS.
+
+    Return the lines of the complete policy.conf."""
+    conf = [u"#line 1 \"declarations\"\n"]
+    conf.extend(u"class {}\n".format(x) for x in sorted(classes))
+    conf.append(u"sid kernel\n")
+    conf.extend(u"class {} {{ {} }}\n".format(x, u" ".join(sorted(y)))
+                for x, y in sorted(classes.items()))
+    conf.extend(u"attribute {};\n".format(x) for x in sorted(attributes))
+    for tpe in sorted(types):
+        conf.append(u"type {};\n".format(u", ".join(
+            [tpe] + sorted(x for x in attributes if tpe in attributes[x]))))
+    conf.extend(lines)
+    conf.append(u"#line 1 \"users\"\n")
+    conf.append(u"role r types {{ {} }};\n".format(u" ".join(sorted(types))))
+    conf.append(u"user u roles { r };\n")
+    conf.append(u"sid kernel u:r:{}\n".format(sorted(types)[0]))
+    return conf
+
+
+@unittest.skipIf(te_macros is None, u"setools is not installed")
+class SetoolsComparisonTest(unittest.TestCase):
+    """Compare the rules found by the rule index with those setools finds in
+    the binary policy compiled from the same policy.conf."""
+
+    def setUp(self):
+        rules = INDEX_POLICY.splitlines(True)
+        types, classes = policy_symbols(rules)
+        types.discard(u"domain")
+        attributes = {u"domain": set([u"a_t", u"c_t"])}
+        lines = compilable_policy(rules, attributes, types, classes)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, u"w") as policy_conf:
+            policy_conf.writelines(lines)
+        self.policy = Policy(attributes, types, classes, lines)
+        self.policy.policy = setools.policyrep.SELinuxPolicy(self.path)
+        te_macros.MAPPER = policysource.mapping.Mapper(
+            self.path, attributes, types, classes)
+        te_macros.PERMISSION_MASKS = self.policy.permission_masks
+        self.index = te_macros.RuleIndex(self.policy)
+        self.types = sorted(types)
+        self.attributes = sorted(attributes)
+        self.classes = classes
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    @staticmethod
+    def normalize(results):
+        """Get the rules found by a query in a comparable form."""
+        return sorted(str(te_macros.MAPPER.rule_factory(str(x)))
+                      for x in results)
+
+    def queries(self):
+        """Generate query rules with fields matching any argument, a given
+        type or attribute, or "self".
+
+        The default types are never attributes, which setools rejects."""
+        arg = te_macros.VALID_ARG_R
+        names = [arg] + self.types + self.attributes
+        for tclass, perms in sorted(self.classes.items()):
+            for source in names:
+                for target in names + [u"self"]:
+                    for rtype in (u"allow", u"dontaudit"):
+                        for perm in sorted(perms):
+                            yield u"{} {} {}:{} {};".format(
+                                rtype, source, target, tclass, perm)
+                    for default in [arg] + self.types:
+                        yield u"type_transition {} {}:{} {};".format(
+                            source, target, tclass, default)
+
+    def test_queries(self):
+        """Compare the results of every query."""
+        found = 0
+        for query in self.queries():
+            rule = te_macros.MAPPER.rule_factory(query)
+            expected = self.normalize(
+                te_macros.query_setools(self.policy, rule))
+            self.assertEqual(self.normalize(self.index.query(rule)),
+                             expected,
+                             u"Mismatch on \"{}\"".format(query))
+            found += len(expected)
+        self.assertTrue(found)
+
+
+if __name__ == u"__main__":
+    unittest.main()